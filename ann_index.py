@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+@description: Approximate nearest neighbour backends of the ChatPDF vector index.
+
+A backend maps a query to candidate rows of `VectorIndex`, which re-scores them exactly:
+- ivf: inverted file in numpy. Rows are grouped by their nearest k-means centroid (cosine), a
+  query scans the rows of its `nprobe` nearest groups. Rows added later are assigned to the
+  existing centroids; the centroids are retrained once the index outgrew its training set.
+- hnsw: hierarchical navigable small world graph of `hnswlib` (pip install hnswlib).
+
+Backends persist their state next to the index with the number of chunks it covered; an index
+changed behind their back (or a crash between the two saves) is rebuilt on load.
+"""
+import json
+import os
+from typing import List, Optional
+
+import numpy as np
+from loguru import logger
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+
+class IVFIndex:
+    """Inverted file index with a spherical k-means coarse quantizer."""
+
+    def __init__(
+            self,
+            index_dir: str,
+            nlist: Optional[int] = None,
+            nprobe: int = 8,
+            min_train_rows: int = 4096,
+            max_train_rows: int = 65536,
+            retrain_growth: float = 4.0,
+            kmeans_iterations: int = 10,
+            seed: int = 0,
+    ):
+        """
+        :param nlist: number of groups, default about sqrt(rows) at training time
+        :param nprobe: groups scanned per query, more is slower and closer to exact search
+        :param min_train_rows: below this many rows the index is not trained and search is exact
+        :param max_train_rows: rows sampled to train the centroids
+        :param retrain_growth: retrain once the index holds this many times its rows at training time
+        """
+        self.path = os.path.join(index_dir, 'ivf.npz')
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_train_rows = min_train_rows
+        self.max_train_rows = max_train_rows
+        self.retrain_growth = retrain_growth
+        self.kmeans_iterations = kmeans_iterations
+        self.seed = seed
+        self.centroids: Optional[np.ndarray] = None
+        # row -> group, -1 for rows not in the index
+        self.assignments = np.full(0, -1, dtype=np.int32)
+        self.lists: List[List[int]] = []
+        self.num_trained_rows = 0
+        self.num_chunks = -1
+        if os.path.exists(self.path):
+            state = np.load(self.path)
+            self.centroids = state['centroids']
+            self.assignments = state['assignments']
+            self.num_trained_rows = int(state['num_trained_rows'])
+            self.num_chunks = int(state['num_chunks'])
+            self._build_lists()
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    def _build_lists(self):
+        self.lists = [[] for _ in range(len(self.centroids))]
+        order = np.argsort(self.assignments, kind='stable')
+        counts = np.bincount(self.assignments[self.assignments >= 0], minlength=len(self.centroids))
+        start = int((self.assignments < 0).sum())
+        for group, count in enumerate(counts):
+            self.lists[group] = order[start:start + count].tolist()
+            start += count
+
+    def consistent(self, num_chunks: int) -> bool:
+        """Whether the saved state covers an index of `num_chunks` chunks."""
+        return not self.trained or self.num_chunks == num_chunks
+
+    def needs_training(self, num_chunks: int) -> bool:
+        if not self.trained:
+            return num_chunks >= self.min_train_rows
+        return num_chunks > self.retrain_growth * self.num_trained_rows
+
+    def reset(self):
+        self.centroids = None
+        self.assignments = np.full(0, -1, dtype=np.int32)
+        self.lists = []
+        self.num_trained_rows = 0
+        self.num_chunks = -1
+
+    def train(self, vectors: np.ndarray, num_rows: int):
+        """k-means on (a sample of) the normalized `vectors`, out of `num_rows` indexed rows."""
+        rng = np.random.default_rng(self.seed)
+        nlist = self.nlist or int(np.clip(np.sqrt(num_rows), 16, 4096))
+        nlist = min(nlist, len(vectors))
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+        for _ in range(self.kmeans_iterations):
+            assign = self._nearest(vectors, centroids)
+            counts = np.bincount(assign, minlength=nlist)
+            order = np.argsort(assign, kind='stable')
+            nonempty = counts > 0
+            starts = (np.cumsum(counts) - counts)[nonempty]
+            sums = np.zeros_like(centroids)
+            sums[nonempty] = np.add.reduceat(vectors[order], starts)
+            # empty groups restart from random vectors
+            sums[~nonempty] = vectors[rng.choice(len(vectors), int((~nonempty).sum()))]
+            centroids = _normalize(sums)
+        self.centroids = centroids
+        self.assignments = np.full(0, -1, dtype=np.int32)
+        self.lists = [[] for _ in range(nlist)]
+        self.num_trained_rows = num_rows
+
+    @staticmethod
+    def _nearest(vectors: np.ndarray, centroids: np.ndarray, block_rows: int = 16384) -> np.ndarray:
+        assign = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), block_rows):
+            assign[start:start + block_rows] = np.argmax(vectors[start:start + block_rows] @ centroids.T, axis=1)
+        return assign
+
+    def add(self, rows: np.ndarray, vectors: np.ndarray):
+        if not self.trained:
+            return
+        rows = np.asarray(rows)
+        if rows.max() >= len(self.assignments):
+            grown = np.full(max(rows.max() + 1, 2 * len(self.assignments)), -1, dtype=np.int32)
+            grown[:len(self.assignments)] = self.assignments
+            self.assignments = grown
+        groups = self._nearest(np.asarray(vectors, dtype=np.float32), self.centroids)
+        self.assignments[rows] = groups
+        for row, group in zip(rows.tolist(), groups.tolist()):
+            self.lists[group].append(row)
+
+    def remove(self, rows: List[int]):
+        # list entries of removed rows are skipped at search time and dropped at the next save
+        rows = [row for row in rows if row < len(self.assignments)]
+        self.assignments[rows] = -1
+
+    def candidates(self, query: np.ndarray, topn: int) -> Optional[np.ndarray]:
+        """Rows of the `nprobe` groups nearest to the normalized query, None when not trained."""
+        if not self.trained:
+            return None
+        nprobe = min(self.nprobe, len(self.centroids))
+        groups = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        rows = np.fromiter((row for group in groups for row in self.lists[group]), dtype=np.int64)
+        # rows removed, or reassigned to another group since they were listed
+        rows = rows[self.assignments[rows] == np.repeat(groups, [len(self.lists[g]) for g in groups])]
+        return np.unique(rows)
+
+    def save(self, num_chunks: int):
+        self.num_chunks = num_chunks
+        if not self.trained:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        self._build_lists()
+        tmp_path = self.path + '.tmp.npz'
+        np.savez(tmp_path, centroids=self.centroids, assignments=self.assignments,
+                 num_trained_rows=self.num_trained_rows, num_chunks=num_chunks)
+        os.replace(tmp_path, self.path)
+
+    def stats(self):
+        return {
+            'backend': 'ivf',
+            'trained': self.trained,
+            'nlist': len(self.centroids) if self.trained else 0,
+            'nprobe': self.nprobe,
+            'num_trained_rows': self.num_trained_rows,
+        }
+
+
+class HNSWIndex:
+    """HNSW graph of hnswlib over the index rows, removed rows are marked deleted."""
+
+    def __init__(self, index_dir: str, m: int = 16, ef_construction: int = 200, ef_search: int = 64):
+        """
+        :param m: graph degree, more is more accurate and uses more memory
+        :param ef_construction: candidate list size while inserting
+        :param ef_search: candidate list size while searching, at least topn
+        """
+        import hnswlib  # optional dependency
+
+        self.hnswlib = hnswlib
+        self.path = os.path.join(index_dir, 'hnsw.bin')
+        self.meta_path = os.path.join(index_dir, 'hnsw.json')
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.graph = None
+        self.num_chunks = -1
+        self.dim = None
+        if os.path.exists(self.path) and os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            self.num_chunks, self.dim = meta['num_chunks'], meta['dim']
+            self.graph = hnswlib.Index(space='ip', dim=self.dim)
+            self.graph.load_index(self.path, max_elements=meta['max_elements'])
+
+    @property
+    def trained(self) -> bool:
+        return self.graph is not None
+
+    def consistent(self, num_chunks: int) -> bool:
+        return self.num_chunks == num_chunks if self.graph is not None else num_chunks == 0
+
+    def needs_training(self, num_chunks: int) -> bool:
+        # the graph grows with every insertion, it is never retrained
+        return False
+
+    def reset(self):
+        self.graph = None
+        self.num_chunks = -1
+
+    def train(self, vectors: np.ndarray, num_rows: int):
+        self.dim = vectors.shape[1]
+        self.graph = self.hnswlib.Index(space='ip', dim=self.dim)
+        self.graph.init_index(max_elements=max(num_rows, 1024), ef_construction=self.ef_construction, M=self.m)
+
+    def add(self, rows: np.ndarray, vectors: np.ndarray):
+        if self.graph is None:
+            self.train(vectors, len(rows))
+        needed = self.graph.get_current_count() + len(rows)
+        if needed > self.graph.get_max_elements():
+            self.graph.resize_index(max(needed, 2 * self.graph.get_max_elements()))
+        # a label marked deleted is restored and updated when a freed row is reused
+        self.graph.add_items(np.asarray(vectors, dtype=np.float32), np.asarray(rows))
+
+    def remove(self, rows: List[int]):
+        if self.graph is None:
+            return
+        for row in rows:
+            try:
+                self.graph.mark_deleted(row)
+            except RuntimeError:  # not in the graph, or already deleted
+                pass
+
+    def candidates(self, query: np.ndarray, topn: int) -> Optional[np.ndarray]:
+        """Labels of the `topn` nearest rows, `topn` must not exceed the number of rows in the graph."""
+        if self.graph is None:
+            return None
+        if topn <= 0:
+            return np.empty(0, dtype=np.int64)
+        self.graph.set_ef(max(self.ef_search, topn))
+        labels, _ = self.graph.knn_query(query.reshape(1, -1).astype(np.float32), k=topn)
+        return labels[0].astype(np.int64)
+
+    def save(self, num_chunks: int):
+        self.num_chunks = num_chunks
+        if self.graph is None:
+            return
+        self.graph.save_index(self.path)
+        with open(self.meta_path, 'w', encoding='utf-8') as f:
+            json.dump({'num_chunks': num_chunks, 'dim': self.dim,
+                       'max_elements': self.graph.get_max_elements()}, f)
+
+    def stats(self):
+        return {'backend': 'hnsw', 'trained': self.trained, 'm': self.m, 'ef_search': self.ef_search}
+
+
+ANN_BACKENDS = {
+    'ivf': IVFIndex,
+    'hnsw': HNSWIndex,
+}
+
+
+def create_ann_index(backend: str, index_dir: str, **kwargs):
+    if backend not in ANN_BACKENDS:
+        raise ValueError(f'Unknown ANN backend {backend}, choose from {list(ANN_BACKENDS)}')
+    logger.debug(f'Using the {backend} ANN backend in {index_dir}')
+    return ANN_BACKENDS[backend](index_dir, **kwargs)
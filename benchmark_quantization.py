@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+@description: Compare fp32 and int8/int4 weight-only quantized CPU inference of one checkpoint.
+
+Every mode runs in its own process, so the reported RSS is that of a single model:
+load time, tensor memory of the model, RSS once the weights were used (weights are memory-mapped
+and paged in lazily) and its increase over the process before loading, peak RSS, prefill and
+decode speed.
+
+usage:
+python benchmark_quantization.py --base_model Qwen/Qwen1.5-0.5B-Chat --modes fp32 int8 int4
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from quantization import load_quantized_model, model_memory_bytes
+
+
+def rss_bytes() -> int:
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def run_mode(args) -> dict:
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+    tokenizer = AutoTokenizer.from_pretrained(args.base_model, trust_remote_code=True)
+    rss_before_load = rss_bytes()
+    start = time.time()
+    if args.mode == 'fp32':
+        model = AutoModelForCausalLM.from_pretrained(
+            args.base_model, torch_dtype=torch.float32, device_map='cpu', trust_remote_code=True)
+    else:
+        model = load_quantized_model(
+            args.base_model,
+            bits=8 if args.mode == 'int8' else 4,
+            group_size=args.group_size,
+            cache_dir=args.cache_dir,
+            compute_dtype=torch.bfloat16 if args.compute_dtype == 'bf16' else torch.float32,
+            torch_dtype=torch.float32,
+            trust_remote_code=True,
+        )
+    model.eval()
+    load_time = time.time() - start
+
+    input_ids = tokenizer(args.prompt, return_tensors='pt').input_ids
+    input_ids = input_ids.repeat(1, max(1, args.prompt_tokens // input_ids.shape[1] + 1))[:, :args.prompt_tokens]
+    with torch.inference_mode():
+        model.generate(input_ids, max_new_tokens=2, do_sample=False)  # warmup
+        start = time.time()
+        model(input_ids)
+        prefill_time = time.time() - start
+        start = time.time()
+        output = model.generate(input_ids, max_new_tokens=args.max_new_tokens, min_new_tokens=args.max_new_tokens,
+                                do_sample=False)
+        generate_time = time.time() - start
+    rss_after_generate = rss_bytes()
+    num_new_tokens = output.shape[1] - input_ids.shape[1]
+    return {
+        'mode': args.mode,
+        'load_seconds': load_time,
+        'model_mib': model_memory_bytes(model) / 2 ** 20,
+        'rss_mib': rss_after_generate / 2 ** 20,
+        'model_rss_mib': (rss_after_generate - rss_before_load) / 2 ** 20,
+        'peak_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10,
+        'prefill_tokens_per_second': input_ids.shape[1] / prefill_time,
+        # generate() includes one prefill, subtract it to get the decode speed
+        'decode_tokens_per_second': (num_new_tokens - 1) / max(generate_time - prefill_time, 1e-9),
+        'output': tokenizer.decode(output[0, input_ids.shape[1]:], skip_special_tokens=True),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--base_model', default=None, type=str, required=True)
+    parser.add_argument('--modes', default=['fp32', 'int8', 'int4'], nargs='+', choices=['fp32', 'int8', 'int4'])
+    parser.add_argument('--group_size', default=128, type=int, help="int4 quantization group size")
+    parser.add_argument('--cache_dir', default=None, type=str, help="Quantized weights cache dir")
+    parser.add_argument('--compute_dtype', default='bf16', choices=['bf16', 'fp32'],
+                        help="Activation dtype of the quantized kernels")
+    parser.add_argument('--prompt', default="Tell me about the treatment of hypertension.", type=str)
+    parser.add_argument('--prompt_tokens', default=128, type=int)
+    parser.add_argument('--max_new_tokens', default=64, type=int)
+    parser.add_argument('--threads', default=0, type=int, help="torch threads, 0 for the torch default")
+    parser.add_argument('--repeat_load', action='store_true',
+                        help="Run every quantized mode twice, the second run loads from the cache")
+    parser.add_argument('--mode', default=None, type=str, help=argparse.SUPPRESS)  # single mode, in a subprocess
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run_mode(args), ensure_ascii=False))
+        return
+
+    results = []
+    for mode in args.modes:
+        for _ in range(2 if args.repeat_load and mode != 'fp32' else 1):
+            command = [sys.executable, os.path.abspath(__file__), *sys.argv[1:], '--mode', mode]
+            stdout = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+            results.append(json.loads(stdout.strip().splitlines()[-1]))
+
+    header = (f"{'mode':<6}{'load s':>9}{'model MiB':>11}{'RSS MiB':>10}{'+RSS MiB':>10}{'peak MiB':>10}"
+              f"{'prefill tok/s':>15}{'decode tok/s':>14}")
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{r['mode']:<6}{r['load_seconds']:>9.2f}{r['model_mib']:>11.1f}{r['rss_mib']:>10.1f}"
+              f"{r['model_rss_mib']:>10.1f}{r['peak_rss_mib']:>10.1f}{r['prefill_tokens_per_second']:>15.1f}{r['decode_tokens_per_second']:>14.1f}")
+    for r in results:
+        print(f"{r['mode']}: {r['output']!r}")
+
+
+if __name__ == '__main__':
+    main()
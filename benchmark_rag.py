@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+@description: Throughput of ChatPDF.predict_batch versus a loop over ChatPDF.predict.
+
+Answers the same questions both ways and reports retrieval and end-to-end time, queries per second
+and generated tokens per second. Questions are read from a file (one per line) or made from the
+first lines of the corpus.
+
+usage:
+python benchmark_rag.py --gen_model Qwen/Qwen2.5-0.5B-Instruct --corpus_files data/rag/medical_corpus.txt \
+    --num_queries 64 --batch_size 16 --max_length 64
+"""
+import argparse
+import json
+import time
+from typing import List
+
+from chatpdf import ChatPDF
+from similarities import BertSimilarity
+
+
+def load_queries(args) -> List[str]:
+    if args.queries_file:
+        with open(args.queries_file, "r", encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+    else:
+        queries = []
+        for file_path in args.corpus_files.split(","):
+            with open(file_path, "r", encoding="utf-8") as f:
+                queries.extend(line.strip()[:args.query_chars] for line in f if line.strip())
+            if len(queries) >= args.num_queries:
+                break
+    return queries[:args.num_queries]
+
+
+def count_tokens(model: ChatPDF, responses: List[str]) -> int:
+    return sum(len(model.tokenizer(r, add_special_tokens=False).input_ids) for r in responses)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sim_model", type=str, default="shibing624/text2vec-base-multilingual")
+    parser.add_argument("--gen_model_type", type=str, default="auto")
+    parser.add_argument("--gen_model", type=str, default="01-ai/Yi-6B-Chat")
+    parser.add_argument("--corpus_files", type=str, default="data/rag/medical_corpus.txt")
+    parser.add_argument("--index_dir", type=str, default=None)
+    parser.add_argument("--device", type=str, default=None)
+    parser.add_argument("--queries_file", type=str, default=None, help="One question per line")
+    parser.add_argument("--num_queries", type=int, default=64)
+    parser.add_argument("--query_chars", type=int, default=30, help="Characters of a corpus line made a question")
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--topn", type=int, default=5)
+    parser.add_argument("--max_length", type=int, default=64, help="Max new tokens per answer")
+    parser.add_argument("--context_len", type=int, default=2048)
+    parser.add_argument("--temperature", type=float, default=0.7, help="predict always samples, keep it above 0")
+    parser.add_argument("--output", default=None, type=str, help="Write the JSON report to this file")
+    args = parser.parse_args()
+    print(args)
+
+    model = ChatPDF(
+        similarity_model=BertSimilarity(model_name_or_path=args.sim_model, device=args.device),
+        generate_model_type=args.gen_model_type,
+        generate_model_name_or_path=args.gen_model,
+        corpus_files=args.corpus_files.split(","),
+        device=args.device,
+        index_dir=args.index_dir,
+    )
+    queries = load_queries(args)
+    gen_kwargs = dict(topn=args.topn, max_length=args.max_length, context_len=args.context_len,
+                      temperature=args.temperature)
+    model.predict_batch(queries[:2], batch_size=2, **gen_kwargs)  # warmup
+
+    reports = {}
+    start = time.perf_counter()
+    for query in queries:
+        model._retrieve(query, topn=args.topn)
+    loop_retrieval = time.perf_counter() - start
+    start = time.perf_counter()
+    responses = [model.predict(query, **gen_kwargs)[0] for query in queries]
+    seconds = time.perf_counter() - start
+    reports["predict loop"] = {"retrieval_seconds": loop_retrieval, "seconds": seconds,
+                               "tokens": count_tokens(model, responses)}
+
+    start = time.perf_counter()
+    model._retrieve_batch(queries, topn=args.topn)
+    batch_retrieval = time.perf_counter() - start
+    start = time.perf_counter()
+    responses = [response for response, _ in model.predict_batch(queries, batch_size=args.batch_size, **gen_kwargs)]
+    seconds = time.perf_counter() - start
+    reports[f"predict_batch {args.batch_size}"] = {"retrieval_seconds": batch_retrieval, "seconds": seconds,
+                                                   "tokens": count_tokens(model, responses)}
+
+    header = f"{'mode':<20}{'retrieval s':>13}{'total s':>10}{'queries/s':>11}{'tokens/s':>10}"
+    print(header)
+    print("-" * len(header))
+    for mode, r in reports.items():
+        r["queries_per_second"] = len(queries) / r["seconds"]
+        r["tokens_per_second"] = r["tokens"] / r["seconds"]
+        print(f"{mode:<20}{r['retrieval_seconds']:>13.3f}{r['seconds']:>10.2f}{r['queries_per_second']:>11.2f}"
+              f"{r['tokens_per_second']:>10.1f}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": reports}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+@description: Recall@k and latency of the approximate search backends of the ChatPDF vector index.
+
+Fills a `VectorIndex` with synthetic clustered embeddings (or the rows of a .npy file), then
+compares every backend with the exact search: recall@k of the exact top k, query latency
+percentiles and build time. Once the backends are built the index is extended with a new
+document, to measure them after incremental additions too.
+
+usage:
+python benchmark_retrieval.py --num_chunks 200000 --dim 384 --nprobe 4 8 16 32
+python benchmark_retrieval.py --embeddings corpus_embs.npy --backends ivf hnsw --output retrieval.json
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from vector_index import VectorIndex
+
+PERCENTILES = (50, 90, 99)
+
+
+def synthetic_embeddings(num_rows: int, dim: int, num_clusters: int, seed: int) -> np.ndarray:
+    """Gaussian clusters of uneven sizes, like the topics of a corpus."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(num_clusters, dim)).astype(np.float32)
+    sizes = rng.dirichlet(np.ones(num_clusters))
+    labels = rng.choice(num_clusters, size=num_rows, p=sizes)
+    return centers[labels] + 0.5 * rng.normal(size=(num_rows, dim)).astype(np.float32)
+
+
+def fill_index(index: VectorIndex, embeddings: np.ndarray, doc_id: str, offset: int, doc_size: int):
+    for start in range(0, len(embeddings), doc_size):
+        block = embeddings[start:start + doc_size]
+        texts = [f"chunk {offset + start + i}" for i in range(len(block))]
+        lookup = dict(zip(texts, block))
+        index.update_document(f"{doc_id}-{start}", doc_id, texts, lambda batch: np.stack([lookup[t] for t in batch]))
+
+
+def run_queries(index: VectorIndex, queries: np.ndarray, topk: int, exact: bool) -> Tuple[List[List[str]], List[float]]:
+    results, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        hits = index.search(query, topk, exact=exact)
+        latencies.append(time.perf_counter() - start)
+        results.append([text for text, _ in hits])
+    return results, latencies
+
+
+def summarize(name: str, results, latencies, truth, build_seconds: float) -> Dict:
+    recall = np.mean([len(set(r) & set(t)) / max(len(t), 1) for r, t in zip(results, truth)])
+    latencies_ms = 1000 * np.asarray(latencies)
+    report = {"backend": name, "recall": float(recall), "build_seconds": build_seconds,
+              "mean_ms": float(latencies_ms.mean())}
+    for p in PERCENTILES:
+        report[f"p{p}_ms"] = float(np.percentile(latencies_ms, p))
+    return report
+
+
+def benchmark(index_dir: str, args, embeddings: np.ndarray, extra: np.ndarray, queries: np.ndarray) -> List[Dict]:
+    reports = []
+    start = time.perf_counter()
+    index = VectorIndex(index_dir, dtype=args.index_dtype, model_id="benchmark")
+    fill_index(index, embeddings, "base", 0, args.doc_size)
+    build_seconds = time.perf_counter() - start
+    truth, latencies = run_queries(index, queries, args.topk, exact=True)
+    reports.append(summarize("exact", truth, latencies, truth, build_seconds))
+
+    for backend in args.backends:
+        if backend == "hnsw":
+            try:
+                import hnswlib  # noqa: F401
+            except ImportError:
+                print("hnswlib is not installed, skipping hnsw")
+                continue
+            configs = [("hnsw", {"ef_search": ef}) for ef in args.ef_search]
+        else:
+            configs = [("ivf", {"nprobe": nprobe}) for nprobe in args.nprobe]
+        # the backend is built from the stored vectors once, then only its search parameter changes
+        start = time.perf_counter()
+        ann_index = VectorIndex(index_dir, dtype=args.index_dtype, model_id="benchmark", ann=backend,
+                                ann_kwargs={"min_train_rows": 0} if backend == "ivf" else None)
+        build_seconds = time.perf_counter() - start
+        for name, params in configs:
+            for key, value in params.items():
+                setattr(ann_index.ann, key, value)
+            results, latencies = run_queries(ann_index, queries, args.topk, exact=False)
+            label = f"{name} {' '.join(f'{k}={v}' for k, v in params.items())}"
+            reports.append(summarize(label, results, latencies, truth, build_seconds))
+        # incremental addition: rows of the new document are merged into the built backend
+        if len(extra):
+            start = time.perf_counter()
+            fill_index(ann_index, extra, "extra", len(embeddings), args.doc_size)
+            ann_index.save_ann()
+            add_seconds = time.perf_counter() - start
+            extra_truth, _ = run_queries(ann_index, queries, args.topk, exact=True)
+            results, latencies = run_queries(ann_index, queries, args.topk, exact=False)
+            label = f"{configs[-1][0]} {' '.join(f'{k}={v}' for k, v in configs[-1][1].items())} +{len(extra)} added"
+            reports.append(summarize(label, results, latencies, extra_truth, add_seconds))
+            for start in range(0, len(extra), args.doc_size):
+                ann_index.remove_document(f"extra-{start}")
+            ann_index.save_ann()
+        for path in ("ivf.npz", "hnsw.bin", "hnsw.json"):
+            if os.path.exists(os.path.join(index_dir, path)):
+                os.remove(os.path.join(index_dir, path))
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--embeddings", default=None, type=str, help=".npy of corpus embeddings, synthetic if not set")
+    parser.add_argument("--num_chunks", default=200000, type=int, help="Synthetic embeddings")
+    parser.add_argument("--dim", default=384, type=int, help="Synthetic embedding dimension")
+    parser.add_argument("--num_clusters", default=1000, type=int, help="Topics of the synthetic embeddings")
+    parser.add_argument("--num_queries", default=200, type=int)
+    parser.add_argument("--extra_fraction", default=0.1, type=float,
+                        help="Part of the rows added after the backend is built, 0 to skip")
+    parser.add_argument("--doc_size", default=10000, type=int, help="Chunks per document added to the index")
+    parser.add_argument("--topk", default=10, type=int)
+    parser.add_argument("--index_dtype", default="float16", choices=["float16", "int8"])
+    parser.add_argument("--backends", default=["ivf", "hnsw"], nargs="+", choices=["ivf", "hnsw"])
+    parser.add_argument("--nprobe", default=[4, 8, 16, 32], type=int, nargs="+", help="ivf groups scanned per query")
+    parser.add_argument("--ef_search", default=[32, 64, 128], type=int, nargs="+", help="hnsw search list size")
+    parser.add_argument("--index_dir", default=None, type=str, help="Index dir, a temporary one if not set")
+    parser.add_argument("--seed", default=42, type=int)
+    parser.add_argument("--output", default=None, type=str, help="Write the JSON report to this file")
+    args = parser.parse_args()
+    print(args)
+
+    if args.embeddings:
+        data = np.load(args.embeddings).astype(np.float32)
+    else:
+        data = synthetic_embeddings(args.num_chunks + args.num_queries, args.dim, args.num_clusters, args.seed)
+    rng = np.random.default_rng(args.seed)
+    data = data[rng.permutation(len(data))]
+    queries, data = data[:args.num_queries], data[args.num_queries:]
+    num_extra = int(len(data) * args.extra_fraction)
+    embeddings, extra = data[:len(data) - num_extra], data[len(data) - num_extra:]
+
+    index_dir = args.index_dir or tempfile.mkdtemp(prefix="retrieval_bench_")
+    try:
+        reports = benchmark(index_dir, args, embeddings, extra, queries)
+    finally:
+        if not args.index_dir:
+            shutil.rmtree(index_dir, ignore_errors=True)
+
+    header = f"{'backend':<36}{'recall@' + str(args.topk):>10}{'mean ms':>10}" + \
+             "".join(f"{'p' + str(p) + ' ms':>10}" for p in PERCENTILES) + f"{'build s':>10}"
+    print(header)
+    print("-" * len(header))
+    for r in reports:
+        print(f"{r['backend']:<36}{r['recall']:>10.3f}{r['mean_ms']:>10.2f}" +
+              "".join(f"{r[f'p{p}_ms']:>10.2f}" for p in PERCENTILES) + f"{r['build_seconds']:>10.2f}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": reports}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
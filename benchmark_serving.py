@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""
+@description: Load test of the OpenAI-compatible API (openai_api.py).
+
+Replays a request file or synthetic requests at a target request rate (Poisson arrivals) and/or
+a max concurrency, against /v1/chat/completions in stream or non-stream mode, and reports
+time to first token, inter-token latency, time per output token and end-to-end latency
+percentiles, with request and token throughput, as JSON. A previous report can be given as
+baseline to flag regressions.
+
+The request file is JSON lines: an OpenAI chat request body (with `messages`), or an object with
+a `prompt` / `query` / `body` / `text` string sent as one user message.
+
+usage:
+# start a server with a tiny model on CPU, run 64 synthetic requests at 4 req/s, stop the server
+python benchmark_serving.py --launch_model Qwen/Qwen2.5-0.5B-Instruct --num_requests 64 --qps 4 --stream
+
+# check that requests cut by their timeout leave the server healthy, then run the load
+python benchmark_serving.py --launch_model Qwen/Qwen2.5-0.5B-Instruct --check_timeouts --num_requests 16
+
+# against a running server, compare with a saved report
+python benchmark_serving.py --base_url http://localhost:8000 --request_file requests.jsonl \
+    --concurrency 8 --output report.json --baseline baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+import httpx
+import numpy as np
+
+# percentiles reported for every latency metric
+PERCENTILES = (50, 90, 95, 99)
+# metrics compared against a baseline: higher is better for throughputs, lower for latencies
+THROUGHPUT_METRICS = ("request_throughput", "output_token_throughput")
+LATENCY_METRICS = ("ttft", "itl", "tpot", "e2e_latency")
+
+SYNTHETIC_WORDS = (
+    "the patient reports mild fever headache and fatigue for three days what treatment options "
+    "are recommended considering the medical history of hypertension and diabetes please explain "
+    "dosage side effects and follow up care in simple terms"
+).split()
+
+
+def load_requests(args) -> List[Dict]:
+    """Chat request bodies (without model and stream), from the request file or synthetic."""
+    rng = random.Random(args.seed)
+    requests = []
+    if args.request_file:
+        with open(args.request_file, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if "messages" in record:
+                    body = {k: v for k, v in record.items() if k not in ("model", "stream")}
+                else:
+                    text = next((record[k] for k in ("prompt", "query", "body", "text") if isinstance(record.get(k), str)),
+                                None)
+                    if text is None:
+                        continue
+                    body = {"messages": [{"role": "user", "content": text}]}
+                requests.append(body)
+        if not requests:
+            raise ValueError(f"No requests in {args.request_file}")
+        if args.num_requests:
+            requests = [requests[i % len(requests)] for i in range(args.num_requests)]
+    else:
+        for _ in range(args.num_requests or 32):
+            num_words = rng.randint(args.input_len_min, args.input_len_max)
+            content = " ".join(rng.choice(SYNTHETIC_WORDS) for _ in range(num_words))
+            requests.append({
+                "messages": [{"role": "user", "content": content}],
+                "max_tokens": rng.randint(args.output_len_min, args.output_len_max),
+            })
+    for body in requests:
+        if args.max_tokens is not None:
+            body["max_tokens"] = args.max_tokens
+        if args.temperature is not None:
+            body["temperature"] = args.temperature
+    return requests
+
+
+async def send_request(client: httpx.AsyncClient, body: Dict, stream: bool) -> Dict:
+    """Send one chat request, return its timings."""
+    result = {"success": False, "ttft": None, "itl": [], "e2e_latency": None, "completion_tokens": 0,
+              "prompt_tokens": 0, "error": None}
+    start = time.perf_counter()
+    try:
+        if stream:
+            last_chunk_time = None
+            async with client.stream("POST", "/v1/chat/completions", json=dict(body, stream=True)) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    result["error"] = f"HTTP {response.status_code}: {response.text[:200]}"
+                    return result
+                async for line in response.aiter_lines():
+                    if not line.startswith("data: ") or line == "data: [DONE]":
+                        continue
+                    chunk = json.loads(line[len("data: "):])
+                    delta = chunk["choices"][0]["delta"] if chunk.get("choices") else {}
+                    if delta.get("content") or delta.get("function_call"):
+                        now = time.perf_counter()
+                        if last_chunk_time is None:
+                            result["ttft"] = now - start
+                        else:
+                            result["itl"].append(now - last_chunk_time)
+                        last_chunk_time = now
+                    if chunk.get("usage"):
+                        result["completion_tokens"] = chunk["usage"].get("completion_tokens", 0)
+                        result["prompt_tokens"] = chunk["usage"].get("prompt_tokens", 0)
+        else:
+            response = await client.post("/v1/chat/completions", json=dict(body, stream=False))
+            if response.status_code != 200:
+                result["error"] = f"HTTP {response.status_code}: {response.text[:200]}"
+                return result
+            usage = response.json().get("usage") or {}
+            result["completion_tokens"] = usage.get("completion_tokens", 0)
+            result["prompt_tokens"] = usage.get("prompt_tokens", 0)
+    except (httpx.HTTPError, json.JSONDecodeError) as e:
+        result["error"] = repr(e)
+        return result
+    result["e2e_latency"] = time.perf_counter() - start
+    if result["ttft"] is None:  # non-stream, or nothing was generated
+        result["ttft"] = result["e2e_latency"]
+    result["success"] = True
+    return result
+
+
+async def run_benchmark(args, requests: List[Dict]) -> List[Dict]:
+    auth = httpx.BasicAuth(*args.api_auth.split(":", 1)) if args.api_auth else None
+    limits = httpx.Limits(max_connections=args.concurrency or None, max_keepalive_connections=args.concurrency or None)
+    rng = random.Random(args.seed)
+    semaphore = asyncio.Semaphore(args.concurrency) if args.concurrency else None
+
+    async with httpx.AsyncClient(base_url=args.base_url, auth=auth, limits=limits,
+                                 timeout=httpx.Timeout(args.request_timeout)) as client:
+        async def limited(body):
+            if semaphore is None:
+                return await send_request(client, body, args.stream)
+            async with semaphore:
+                return await send_request(client, body, args.stream)
+
+        tasks = []
+        for body in requests:
+            tasks.append(asyncio.create_task(limited(dict(body, model=args.model))))
+            if args.qps > 0:
+                # Poisson arrivals at the target rate
+                await asyncio.sleep(rng.expovariate(args.qps))
+        return await asyncio.gather(*tasks)
+
+
+async def check_timeouts(args, rounds: int = 5) -> List[str]:
+    """
+    Regression check of request deadlines: requests cut by a short `timeout` while others are running must
+    leave the server able to answer the next request. Returns the failures.
+    """
+    auth = httpx.BasicAuth(*args.api_auth.split(":", 1)) if args.api_auth else None
+    body = {"model": args.model, "messages": [{"role": "user", "content": " ".join(SYNTHETIC_WORDS)}]}
+    failures = []
+    timeout = httpx.Timeout(args.request_timeout)
+    async with httpx.AsyncClient(base_url=args.base_url, auth=auth, timeout=timeout) as client:
+        # keeps a sequence decoding while the others expire
+        background = asyncio.create_task(send_request(client, dict(body, max_tokens=4096), False))
+        for i in range(rounds):
+            expiring = asyncio.gather(*(send_request(client, dict(body, max_tokens=4096, timeout=timeout), stream)
+                                        for timeout in (0.05, 0.1, 0.2, 0.4) for stream in (False, True)))
+            try:
+                # the expiring requests hang too when the engine is stuck
+                await asyncio.wait_for(expiring, args.check_timeout_wait)
+                result = await asyncio.wait_for(send_request(client, dict(body, max_tokens=8), False),
+                                                args.check_timeout_wait)
+            except asyncio.TimeoutError:
+                result = {"success": False, "error": f"no answer within {args.check_timeout_wait}s"}
+            if not result["success"]:
+                failures.append(f"round {i}: request after expired ones failed: {result['error']}")
+                break
+        background.cancel()
+    return failures
+
+
+def summarize(values: List[float]) -> Optional[Dict[str, float]]:
+    """Mean and percentiles in milliseconds."""
+    if not values:
+        return None
+    values = np.asarray(values) * 1000
+    summary = {"mean_ms": float(values.mean())}
+    for p in PERCENTILES:
+        summary[f"p{p}_ms"] = float(np.percentile(values, p))
+    return summary
+
+
+def build_report(args, results: List[Dict], duration: float) -> Dict:
+    succeeded = [r for r in results if r["success"]]
+    output_tokens = sum(r["completion_tokens"] for r in succeeded)
+    prompt_tokens = sum(r["prompt_tokens"] for r in succeeded)
+    tpot = [(r["e2e_latency"] - r["ttft"]) / (r["completion_tokens"] - 1)
+            for r in succeeded if r["completion_tokens"] > 1 and args.stream]
+    errors = {}
+    for r in results:
+        if r["error"]:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    return {
+        "config": {
+            "base_url": args.base_url,
+            "model": args.model,
+            "stream": args.stream,
+            "qps": args.qps,
+            "concurrency": args.concurrency,
+            "num_requests": len(results),
+            "request_file": args.request_file,
+            "launch_model": args.launch_model,
+        },
+        "duration_s": duration,
+        "completed": len(succeeded),
+        "failed": len(results) - len(succeeded),
+        "errors": errors,
+        "request_throughput": len(succeeded) / duration,
+        "output_token_throughput": output_tokens / duration,
+        "total_token_throughput": (prompt_tokens + output_tokens) / duration,
+        "prompt_tokens": prompt_tokens,
+        "output_tokens": output_tokens,
+        # non-stream requests have no first token before the whole answer, ttft equals e2e latency
+        "ttft": summarize([r["ttft"] for r in succeeded]),
+        "itl": summarize([t for r in succeeded for t in r["itl"]]),
+        "tpot": summarize(tpot),
+        "e2e_latency": summarize([r["e2e_latency"] for r in succeeded]),
+    }
+
+
+def compare_reports(report: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """Print the relative change of every metric, return the regressions beyond `threshold`."""
+    regressions = []
+    print(f"{'metric':<32}{'baseline':>12}{'current':>12}{'change':>10}")
+    rows = [(name, baseline.get(name), report.get(name), True) for name in THROUGHPUT_METRICS]
+    for name in LATENCY_METRICS:
+        for stat in ("mean_ms", "p50_ms", "p99_ms"):
+            rows.append((f"{name}.{stat}", (baseline.get(name) or {}).get(stat), (report.get(name) or {}).get(stat),
+                         False))
+    for name, old, new, higher_is_better in rows:
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        regressed = change < -threshold if higher_is_better else change > threshold
+        print(f"{name:<32}{old:>12.2f}{new:>12.2f}{change:>+10.1%}{'  REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def launch_server(args) -> subprocess.Popen:
+    """Start openai_api.py serving `args.launch_model` on CPU on a free port, wait until /health is ready."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "openai_api.py"),
+               "--checkpoint-path", args.launch_model, "--cpu-only", "--server-port", str(port),
+               *args.server_args.split()]
+    print(f"Starting {' '.join(command)}")
+    process = subprocess.Popen(command)
+    args.base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + args.launch_timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            if httpx.get(f"{args.base_url}/health", timeout=2).status_code == 200:
+                return process
+        except httpx.HTTPError:
+            pass
+        time.sleep(1)
+    process.terminate()
+    raise TimeoutError(f"Server not ready after {args.launch_timeout}s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base_url", default="http://localhost:8000", type=str)
+    parser.add_argument("--api_auth", default=None, type=str, help="user:password of the server --api-auth")
+    parser.add_argument("--model", default="gpt-3.5-turbo", type=str, help="Model id sent in the requests")
+    parser.add_argument("--launch_model", default=None, type=str,
+                        help="Start openai_api.py with this checkpoint on CPU for the run, e.g. a tiny model")
+    parser.add_argument("--server_args", default="", type=str,
+                        help="Extra command line of the launched server, e.g. --server_args=\"--max-batch-size 4\"")
+    parser.add_argument("--launch_timeout", default=600, type=float, help="Seconds to wait for the launched server")
+    parser.add_argument("--request_file", default=None, type=str, help="JSON lines requests, synthetic if not set")
+    parser.add_argument("--num_requests", default=0, type=int,
+                        help="Requests to send, the request file is cycled; default 32 synthetic or the whole file")
+    parser.add_argument("--input_len_min", default=16, type=int, help="Min words of a synthetic prompt")
+    parser.add_argument("--input_len_max", default=256, type=int, help="Max words of a synthetic prompt")
+    parser.add_argument("--output_len_min", default=16, type=int, help="Min max_tokens of a synthetic request")
+    parser.add_argument("--output_len_max", default=128, type=int, help="Max max_tokens of a synthetic request")
+    parser.add_argument("--max_tokens", default=None, type=int, help="Override max_tokens of every request")
+    parser.add_argument("--temperature", default=None, type=float, help="Override temperature of every request")
+    parser.add_argument("--stream", action="store_true", help="Stream responses, needed for TTFT and ITL")
+    parser.add_argument("--qps", default=0, type=float, help="Request rate with Poisson arrivals, 0 to send all at once")
+    parser.add_argument("--concurrency", default=0, type=int, help="Max requests in flight, 0 for no limit")
+    parser.add_argument("--request_timeout", default=600, type=float)
+    parser.add_argument("--seed", default=42, type=int)
+    parser.add_argument("--output", default=None, type=str, help="Write the JSON report to this file")
+    parser.add_argument("--baseline", default=None, type=str, help="JSON report of a previous run to compare with")
+    parser.add_argument("--regression_threshold", default=0.1, type=float,
+                        help="Relative change of a metric counted as a regression, exit code 1 if any")
+    parser.add_argument("--check_timeouts", action="store_true",
+                        help="Check first that requests cut by their timeout do not stall the server")
+    parser.add_argument("--check_timeout_wait", default=60, type=float,
+                        help="Seconds the request following the expired ones may take")
+    args = parser.parse_args()
+
+    requests = load_requests(args)
+    server = launch_server(args) if args.launch_model else None
+    try:
+        if args.check_timeouts:
+            failures = asyncio.run(check_timeouts(args))
+            if failures:
+                print("Timeout check failed:\n" + "\n".join(failures))
+                sys.exit(1)
+            print("Timeout check passed")
+        start = time.perf_counter()
+        results = asyncio.run(run_benchmark(args, requests))
+        duration = time.perf_counter() - start
+    finally:
+        if server is not None:
+            server.terminate()
+            try:
+                server.wait(timeout=30)
+            except subprocess.TimeoutExpired:  # e.g. stuck on the requests of a dead engine
+                server.kill()
+                server.wait()
+    report = build_report(args, results, duration)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_reports(report, baseline, args.regression_threshold)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
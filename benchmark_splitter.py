@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+@description: Throughput and chunk sizes of the ChatPDF text splitter modes.
+
+Splits a text file with every SentenceSplitter mode and reports the split time, throughput in
+characters per second, and the chunk lengths in characters and, with a tokenizer, in tokens with
+the share of chunks longer than the embedding model window (--max_tokens).
+
+usage:
+python benchmark_splitter.py --file data/pretrain/tianlongbabu.txt --tokenizer shibing624/text2vec-base-chinese
+"""
+import argparse
+import json
+import time
+from typing import List, Tuple
+
+import numpy as np
+
+from text_splitter import SentenceSplitter
+
+
+def run(splitter: SentenceSplitter, text: str, repeats: int) -> Tuple[List[str], float]:
+    splitter.split_text(text[:1000])  # warmup, e.g. the jieba dictionary
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        chunks = splitter.split_text(text)
+        seconds.append(time.perf_counter() - start)
+    return chunks, min(seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file", default="data/pretrain/tianlongbabu.txt", type=str)
+    parser.add_argument("--tokenizer", default=None, type=str,
+                        help="Tokenizer of the embedding model, for the tokens mode and the token lengths")
+    parser.add_argument("--chunk_size", default=250, type=int, help="Chunk characters of the chars and spans modes")
+    parser.add_argument("--chunk_overlap", default=50, type=int)
+    parser.add_argument("--chunk_tokens", default=200, type=int, help="Chunk tokens of the tokens mode")
+    parser.add_argument("--overlap_tokens", default=32, type=int)
+    parser.add_argument("--max_tokens", default=256, type=int, help="Embedding model window, longer chunks are cut")
+    parser.add_argument("--repeats", default=3, type=int)
+    parser.add_argument("--output", default=None, type=str, help="Write the JSON report to this file")
+    args = parser.parse_args()
+    print(args)
+
+    with open(args.file, "r", encoding="utf-8") as f:
+        text = f.read()
+    tokenizer = None
+    if args.tokenizer:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    splitters = {
+        "chars": SentenceSplitter(args.chunk_size, args.chunk_overlap),
+        "spans": SentenceSplitter(args.chunk_size, args.chunk_overlap, mode="spans"),
+    }
+    if tokenizer is not None:
+        splitters["tokens"] = SentenceSplitter(args.chunk_tokens, args.overlap_tokens, mode="tokens",
+                                               tokenizer=tokenizer)
+
+    reports = []
+    for mode, splitter in splitters.items():
+        chunks, seconds = run(splitter, text, args.repeats)
+        chars = np.array([len(c) for c in chunks])
+        report = {
+            "mode": mode,
+            "seconds": seconds,
+            "chars_per_second": len(text) / seconds,
+            "chunks": len(chunks),
+            "mean_chars": float(chars.mean()),
+            "max_chars": int(chars.max()),
+        }
+        if tokenizer is not None:
+            tokens = np.array([len(ids) for ids in tokenizer(chunks, add_special_tokens=False)["input_ids"]])
+            report.update({
+                "mean_tokens": float(tokens.mean()),
+                "max_tokens": int(tokens.max()),
+                "overflow": float((tokens > args.max_tokens).mean()),
+            })
+        reports.append(report)
+
+    header = f"{'mode':<8}{'seconds':>9}{'Mchars/s':>10}{'chunks':>8}{'mean chars':>12}{'max chars':>11}"
+    if tokenizer is not None:
+        header += f"{'mean tok':>10}{'max tok':>9}{'> ' + str(args.max_tokens):>8}"
+    print(header)
+    print("-" * len(header))
+    for r in reports:
+        line = (f"{r['mode']:<8}{r['seconds']:>9.3f}{r['chars_per_second'] / 1e6:>10.2f}{r['chunks']:>8}"
+                f"{r['mean_chars']:>12.1f}{r['max_chars']:>11}")
+        if tokenizer is not None:
+            line += f"{r['mean_tokens']:>10.1f}{r['max_tokens']:>9}{r['overflow']:>8.1%}"
+        print(line)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": reports}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,13 +7,13 @@ pip install similarities PyPDF2 -U
 import argparse
 import hashlib
 import os
-import re
 from threading import Thread
-from typing import Union, List
+from typing import Dict, List, Tuple, Union
 
-import jieba
+import numpy as np
 import torch
 from loguru import logger
+from tqdm import tqdm
 from peft import PeftModel
 from similarities import (
     EnsembleSimilarity,
@@ -31,9 +31,22 @@ from transformers import (
     LlamaForCausalLM,
     TextIteratorStreamer,
     GenerationConfig,
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
 )
 
-jieba.setLogLevel("ERROR")
+from ingestion import (
+    extract_text_from_docx,
+    extract_text_from_markdown,
+    extract_text_from_pdf,
+    extract_text_from_txt,
+    iter_chunks,
+)
+from model_loader import DEFAULT_WARMUP_LENGTHS, load_model_and_tokenizer, warmup_model
+from speculative_decoding import PromptLookupProposer, prompt_lookup_generate
+from text_splitter import SentenceSplitter
+from vector_index import VectorIndex
 
 MODEL_CLASSES = {
     "bloom": (BloomForCausalLM, BloomTokenizerFast),
@@ -53,70 +66,6 @@ Q:
 """
 
 
-class SentenceSplitter:
-    def __init__(self, chunk_size: int = 250, chunk_overlap: int = 50):
-        self.chunk_size = chunk_size
-        self.chunk_overlap = chunk_overlap
-
-    def split_text(self, text: str) -> List[str]:
-        if self._is_has_chinese(text):
-            return self._split_chinese_text(text)
-        else:
-            return self._split_english_text(text)
-
-    def _split_chinese_text(self, text: str) -> List[str]:
-        sentence_endings = {'\n', '。', '！', '？', '；', '…'}  
-        chunks, current_chunk = [], ''
-        for word in jieba.cut(text):
-            if len(current_chunk) + len(word) > self.chunk_size:
-                chunks.append(current_chunk.strip())
-                current_chunk = word
-            else:
-                current_chunk += word
-            if word[-1] in sentence_endings and len(current_chunk) > self.chunk_size - self.chunk_overlap:
-                chunks.append(current_chunk.strip())
-                current_chunk = ''
-        if current_chunk:
-            chunks.append(current_chunk.strip())
-        if self.chunk_overlap > 0 and len(chunks) > 1:
-            chunks = self._handle_overlap(chunks)
-        return chunks
-
-    def _split_english_text(self, text: str) -> List[str]:
-       
-        sentences = re.split(r'(?<=[.!?])\s+', text.replace('\n', ' '))
-        chunks, current_chunk = [], ''
-        for sentence in sentences:
-            if len(current_chunk) + len(sentence) <= self.chunk_size or not current_chunk:
-                current_chunk += (' ' if current_chunk else '') + sentence
-            else:
-                chunks.append(current_chunk)
-                current_chunk = sentence
-        if current_chunk:  # Add the last chunk
-            chunks.append(current_chunk)
-
-        if self.chunk_overlap > 0 and len(chunks) > 1:
-            chunks = self._handle_overlap(chunks)
-
-        return chunks
-
-    def _is_has_chinese(self, text: str) -> bool:
-        # check if contains chinese characters
-        if any("\u4e00" <= ch <= "\u9fff" for ch in text):
-            return True
-        else:
-            return False
-
-    def _handle_overlap(self, chunks: List[str]) -> List[str]:
-        
-        overlapped_chunks = []
-        for i in range(len(chunks) - 1):
-            chunk = chunks[i] + ' ' + chunks[i + 1][:self.chunk_overlap]
-            overlapped_chunks.append(chunk.strip())
-        overlapped_chunks.append(chunks[-1])
-        return overlapped_chunks
-
-
 class ChatPDF:
     def __init__(
             self,
@@ -132,6 +81,15 @@ class ChatPDF:
             chunk_size: int = 250,
             chunk_overlap: int = 30,
             prompt_template_name: str = None,
+            prompt_lookup_num_tokens: int = 0,
+            index_dir: str = None,
+            index_dtype: str = "float16",
+            ann_backend: str = None,
+            ann_kwargs: Dict = None,
+            ingest_workers: int = None,
+            embed_batch_size: int = 256,
+            split_mode: str = "chars",
+            chunk_tokenizer: str = None,
     ):
         """
         Init RAG model.
@@ -147,6 +105,19 @@ class ChatPDF:
         :param chunk_size: chunk size, default 250
         :param chunk_overlap: chunk overlap, default 50
         :param prompt_template_name: prompt template name, default None, if set, inplace tokenizer.apply_chat_template
+        :param prompt_lookup_num_tokens: draft tokens copied from the prompt (RAG context) per decoding step,
+            default 0, disable prompt lookup decoding
+        :param index_dir: persistent vector index dir, default None, embed the corpus in memory on every start;
+            if set, only the chunks of new or modified files are embedded
+        :param index_dtype: embedding storage of the index, float16 or int8, default float16
+        :param ann_backend: approximate search of the index, ivf or hnsw, default None, exact search;
+            worth it from about 100k chunks
+        :param ann_kwargs: parameters of the ann backend, e.g. {"nprobe": 16} for ivf
+        :param ingest_workers: processes extracting the text of corpus files, default None, the number of CPUs
+        :param embed_batch_size: chunks embedded per batch, small files are grouped to fill batches, default 256
+        :param split_mode: text splitter mode, chars/spans/tokens (see SentenceSplitter), default chars;
+            tokens sizes chunk_size and chunk_overlap in tokens of the embedding model
+        :param chunk_tokenizer: tokenizer name or path of the tokens split mode, default None, the similarity model's
         """
         if torch.cuda.is_available():
             default_device = torch.device(0)
@@ -155,7 +126,8 @@ class ChatPDF:
         else:
             default_device = torch.device('cpu')
         self.device = device or default_device
-        self.text_splitter = SentenceSplitter(chunk_size, chunk_overlap)
+        self.ingest_workers = ingest_workers
+        self.embed_batch_size = embed_batch_size
         if similarity_model is not None:
             self.sim_model = similarity_model
         else:
@@ -163,6 +135,33 @@ class ChatPDF:
             m2 = BM25Similarity()
             default_sim_model = EnsembleSimilarity(similarities=[m1, m2], weights=[0.5, 0.5], c=2)
             self.sim_model = default_sim_model
+        splitter_tokenizer = None
+        if split_mode == "tokens":
+            members = getattr(self.sim_model, 'similarities', None) or [self.sim_model]
+            chunk_tokenizer = chunk_tokenizer or next(
+                (m.model_name_or_path for m in members if getattr(m, 'model_name_or_path', None)), None)
+            if chunk_tokenizer is None:
+                raise ValueError(f"split_mode tokens needs chunk_tokenizer, no model name in {self.sim_model}")
+            splitter_tokenizer = AutoTokenizer.from_pretrained(chunk_tokenizer)
+        self.text_splitter = SentenceSplitter(chunk_size, chunk_overlap, mode=split_mode, tokenizer=splitter_tokenizer)
+        self.vector_index = None
+        self.dense_model = None
+        self.sparse_model = None
+        if ann_backend and not index_dir:
+            raise ValueError("ann_backend needs the persistent index, set index_dir")
+        if index_dir:
+            # the index replaces the embeddings of the similarity model, a BM25 part is rebuilt from its chunks
+            members = getattr(self.sim_model, 'similarities', None) or [self.sim_model]
+            self.dense_model = next((m for m in members if hasattr(m, 'get_embeddings')), None)
+            if self.dense_model is None:
+                raise ValueError(f"index_dir needs an embedding similarity model, got {self.sim_model}")
+            if any(isinstance(m, BM25Similarity) for m in members):
+                self.sparse_model = BM25Similarity()
+            model_id = getattr(self.dense_model, 'model_name_or_path', None) or str(self.dense_model)
+            self.vector_index = VectorIndex(
+                index_dir, dtype=index_dtype, model_id=model_id, ann=ann_backend, ann_kwargs=ann_kwargs
+            )
+            self._rebuild_sparse_model()
         self.gen_model, self.tokenizer = self._init_gen_model(
             generate_model_type,
             generate_model_name_or_path,
@@ -176,6 +175,8 @@ class ChatPDF:
             self.add_corpus(corpus_files)
         self.save_corpus_emb_dir = save_corpus_emb_dir
         self.prompt_template_name = prompt_template_name
+        self.prompt_lookup_num_tokens = prompt_lookup_num_tokens
+        self.prompt_lookup_stats = {'num_steps': 0, 'num_tokens': 0, 'num_draft_tokens': 0, 'num_accepted_tokens': 0}
 
     def __str__(self):
         return f"Similarity model: {self.sim_model}, Generate model: {self.gen_model}"
@@ -194,9 +195,11 @@ class ChatPDF:
         else:
             device_map = "auto"
         model_class, tokenizer_class = MODEL_CLASSES[gen_model_type]
-        tokenizer = tokenizer_class.from_pretrained(gen_model_name_or_path, trust_remote_code=True)
-        model = model_class.from_pretrained(
+        # weights are memory-mapped on CPU, the tokenizer loads meanwhile
+        model, tokenizer = load_model_and_tokenizer(
             gen_model_name_or_path,
+            tokenizer_class=tokenizer_class,
+            model_class=model_class,
             load_in_8bit=int8 if gen_model_type not in ['baichuan', 'chatglm'] else False,
             load_in_4bit=int4 if gen_model_type not in ['baichuan', 'chatglm'] else False,
             torch_dtype="auto",
@@ -224,15 +227,16 @@ class ChatPDF:
         model.eval()
         return model, tokenizer
 
-    def _get_chat_input(self):
+    def _get_chat_input(self, history: List[List[str]] = None):
+        history = self.history if history is None else history
         messages = []
         if self.prompt_template_name:
             from template import get_conv_template
             prompt_template = get_conv_template(self.prompt_template_name)
-            prompt = prompt_template.get_prompt(messages=self.history)
+            prompt = prompt_template.get_prompt(messages=history)
             input_ids = self.tokenizer(prompt, return_tensors='pt').input_ids
         else:
-            for conv in self.history:
+            for conv in history:
                 if conv and len(conv) > 0 and conv[0]:
                     messages.append({'role': 'user', 'content': conv[0]})
                 if conv and len(conv) > 1 and conv[1]:
@@ -241,7 +245,8 @@ class ChatPDF:
                 conversation=messages,
                 tokenize=True,
                 add_generation_prompt=True,
-                return_tensors='pt'
+                return_tensors='pt',
+                return_dict=False,
             )
         return input_ids.to(self.gen_model.device)
 
@@ -251,12 +256,28 @@ class ChatPDF:
             max_new_tokens=512,
             temperature=0.7,
             repetition_penalty=1.0,
-            context_len=2048
+            context_len=2048,
+            prompt_lookup_num_tokens=None,
     ):
+        """
+        Stream the answer to the last history turn.
+        :param prompt_lookup_num_tokens: draft tokens per step copied from the prompt by n-gram lookup,
+            default None, use the value given at init; 0 runs plain `generate`
+        """
         streamer = TextIteratorStreamer(self.tokenizer, timeout=60.0, skip_prompt=True, skip_special_tokens=True)
         input_ids = self._get_chat_input()
         max_src_len = context_len - max_new_tokens - 8
         input_ids = input_ids[-max_src_len:]
+        if prompt_lookup_num_tokens is None:
+            prompt_lookup_num_tokens = self.prompt_lookup_num_tokens
+        if prompt_lookup_num_tokens > 0:
+            thread = Thread(
+                target=self._prompt_lookup_generate,
+                args=(input_ids, max_new_tokens, temperature, repetition_penalty, prompt_lookup_num_tokens, streamer),
+            )
+            thread.start()
+            yield from streamer
+            return
         generation_kwargs = dict(
             input_ids=input_ids,
             max_new_tokens=max_new_tokens,
@@ -270,37 +291,166 @@ class ChatPDF:
 
         yield from streamer
 
+    def _prompt_lookup_generate(
+            self,
+            input_ids,
+            max_new_tokens,
+            temperature,
+            repetition_penalty,
+            num_speculative_tokens,
+            streamer,
+    ):
+        """Generate with prompt lookup decoding, the answer copies spans of the retrieved references."""
+        logits_processor = LogitsProcessorList()
+        if repetition_penalty != 1.0:
+            logits_processor.append(RepetitionPenaltyLogitsProcessor(penalty=repetition_penalty))
+        if temperature > 0 and temperature != 1.0:
+            logits_processor.append(TemperatureLogitsWarper(temperature))
+        eos_token_id = self.gen_model.generation_config.eos_token_id
+        eos_token_ids = list(eos_token_id) if isinstance(eos_token_id, (list, tuple)) else [eos_token_id]
+        eos_token_ids.append(self.tokenizer.eos_token_id)
+        stats = prompt_lookup_generate(
+            self.gen_model,
+            input_ids,
+            max_new_tokens,
+            PromptLookupProposer(num_speculative_tokens),
+            logits_processor=logits_processor,
+            greedy=temperature <= 0,
+            eos_token_ids=eos_token_ids,
+            streamer=streamer,
+        )
+        for k, v in stats.items():
+            self.prompt_lookup_stats[k] += v
+        logger.debug(f"prompt lookup decoding: {stats['num_tokens']} tokens in {stats['num_steps']} steps, "
+                     f"{stats['num_tokens'] / max(stats['num_steps'], 1):.2f} tokens/step, accepted "
+                     f"{stats['num_accepted_tokens']}/{stats['num_draft_tokens']} draft tokens")
+
+    def _iter_chunk_groups(self, files: List[str]):
+        """
+        Lists of (file, chunks) of at least `embed_batch_size` chunks (or the last files), in file order.
+        Text extraction, chunking and the caller's embedding overlap, see `ingestion.iter_chunks`.
+        """
+        group, group_chunks, num_chunks = [], 0, 0
+        with tqdm(total=len(files), desc="Ingesting", unit="file", disable=len(files) <= 1) as progress:
+            for doc_file, chunks in iter_chunks(files, self.text_splitter.split_text, num_workers=self.ingest_workers):
+                group.append((doc_file, chunks))
+                group_chunks += len(chunks)
+                num_chunks += len(chunks)
+                progress.update(1)
+                progress.set_postfix(chunks=num_chunks)
+                if group_chunks >= self.embed_batch_size:
+                    yield group
+                    group, group_chunks = [], 0
+            if group:
+                yield group
+
     def add_corpus(self, files: Union[str, List[str]]):
         """Load document files."""
         if isinstance(files, str):
             files = [files]
-        for doc_file in files:
-            if doc_file.endswith('.pdf'):
-                corpus = self.extract_text_from_pdf(doc_file)
-            elif doc_file.endswith('.docx'):
-                corpus = self.extract_text_from_docx(doc_file)
-            elif doc_file.endswith('.md'):
-                corpus = self.extract_text_from_markdown(doc_file)
-            else:
-                corpus = self.extract_text_from_txt(doc_file)
-            full_text = '\n'.join(corpus)
-            chunks = self.text_splitter.split_text(full_text)
-            self.sim_model.add_corpus(chunks)
+        if self.vector_index is not None:
+            self._add_corpus_to_index(files)
+            self.corpus_files = files
+            return
+        for group in self._iter_chunk_groups(files):
+            self.sim_model.add_corpus([chunk for _, chunks in group for chunk in chunks])
         self.corpus_files = files
         logger.debug(f"files: {files}, corpus size: {len(self.sim_model.corpus)}, top3: "
                      f"{list(self.sim_model.corpus.values())[:3]}")
 
+    def _add_corpus_to_index(self, files: List[str]):
+        """Index new and modified files, unchanged files are neither read nor embedded."""
+        for doc_id in self.vector_index.documents():
+            if not os.path.exists(doc_id):
+                self.vector_index.remove_document(doc_id)
+                logger.debug(f"Removed deleted file {doc_id} from the index")
+        file_hashes = {}
+        for doc_file in files:
+            # chunks depend on the splitter settings as much as on the file
+            file_hash = f"{self.get_file_hash(doc_file)}-{self.text_splitter.signature}"
+            if self.vector_index.document_hash(os.path.abspath(doc_file)) != file_hash:
+                file_hashes[doc_file] = file_hash
+        num_embedded = 0
+        for group in self._iter_chunk_groups(list(file_hashes)):
+            # the new chunks of small files are embedded together, large files in batches of their own
+            missing = self.vector_index.missing_chunks([chunk for _, chunks in group for chunk in chunks])
+            embeddings = {}
+            if len(group) > 1:
+                for i in range(0, len(missing), self.embed_batch_size):
+                    batch = missing[i:i + self.embed_batch_size]
+                    embeddings.update(zip(batch, self._embed(batch)))
+            for doc_file, chunks in group:
+                embed_fn = (lambda texts: np.stack([embeddings[t] for t in texts])) if embeddings else self._embed
+                num_embedded += self.vector_index.update_document(
+                    os.path.abspath(doc_file), file_hashes[doc_file], chunks, embed_fn, batch_size=self.embed_batch_size
+                )
+        self.vector_index.save_ann()
+        self._rebuild_sparse_model()
+        logger.debug(f"files: {files}, embedded {num_embedded} new chunks, index: {self.vector_index.stats()}")
+
+    def remove_corpus(self, files: Union[str, List[str]]):
+        """Remove document files from the persistent index."""
+        if self.vector_index is None:
+            raise ValueError("Removing files needs the persistent index, set index_dir")
+        if isinstance(files, str):
+            files = [files]
+        for doc_file in files:
+            self.vector_index.remove_document(os.path.abspath(doc_file))
+        self.vector_index.save_ann()
+        self._rebuild_sparse_model()
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        return np.asarray(self.dense_model.get_embeddings(texts), dtype=np.float32)
+
+    def _rebuild_sparse_model(self):
+        # BM25 only tokenizes, rebuilding it from the indexed chunks is cheap
+        if self.sparse_model is not None:
+            self.sparse_model = BM25Similarity()
+            texts = self.vector_index.texts()
+            if texts:
+                self.sparse_model.add_corpus(texts)
+
+    def _has_corpus(self) -> bool:
+        if self.vector_index is not None:
+            return len(self.vector_index) > 0
+        return bool(self.sim_model.corpus)
+
+    def _retrieve(self, query: str, topn: int = 5) -> List[str]:
+        """Texts of the `topn` chunks most relevant to the query."""
+        return self._retrieve_batch([query], topn=topn)[0]
+
+    def _retrieve_batch(self, queries: List[str], topn: int = 5) -> List[List[str]]:
+        """`_retrieve` of many queries: queries are embedded in one batch and scored with one matrix search."""
+        if self.vector_index is None:
+            sim_contents = self.sim_model.most_similar(queries, topn=topn)
+            return [[self.sim_model.corpus[corpus_id] for corpus_id in id_score_dict]
+                    for id_score_dict in sim_contents.values()]
+        dense = [[text for text, _ in hits] for hits in self.vector_index.search_batch(self._embed(queries), topn=topn)]
+        if self.sparse_model is None:
+            return dense
+        sim_contents = self.sparse_model.most_similar(queries, topn=topn)
+        sparse = [[self.sparse_model.corpus[corpus_id] for corpus_id in id_score_dict]
+                  for id_score_dict in sim_contents.values()]
+        results = []
+        for ranks in zip(dense, sparse):
+            # reciprocal rank fusion, as the default EnsembleSimilarity (equal weights, c=2)
+            scores = {}
+            for ranked in ranks:
+                for rank, text in enumerate(ranked):
+                    scores[text] = scores.get(text, 0.0) + 0.5 / (rank + 2)
+            results.append(sorted(scores, key=scores.get, reverse=True)[:topn])
+        return results
+
     @staticmethod
     def get_file_hash(fpaths):
         hasher = hashlib.md5()
-        target_file_data = bytes()
         if isinstance(fpaths, str):
             fpaths = [fpaths]
         for fpath in fpaths:
             with open(fpath, 'rb') as file:
-                chunk = file.read(1024 * 1024)  # read only first 1MB
-                hasher.update(chunk)
-                target_file_data += chunk
+                # the whole file, an edit anywhere changes the hash
+                for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                    hasher.update(chunk)
 
         hash_name = hasher.hexdigest()[:32]
         return hash_name
@@ -308,50 +458,22 @@ class ChatPDF:
     @staticmethod
     def extract_text_from_pdf(file_path: str):
         """Extract text content from a PDF file."""
-        import PyPDF2
-        contents = []
-        with open(file_path, 'rb') as f:
-            pdf_reader = PyPDF2.PdfReader(f)
-            for page in pdf_reader.pages:
-                page_text = page.extract_text().strip()
-                raw_text = [text.strip() for text in page_text.splitlines() if text.strip()]
-                new_text = ''
-                for text in raw_text:
-                    new_text += text
-                    if text[-1] in ['.', '!', '?', '。', '！', '？', '…', ';', '；', ':', '：', '”', '’', '）', '】', '》', '」',
-                                    '』', '〕', '〉', '》', '〗', '〞', '〟', '»', '"', "'", ')', ']', '}']:
-                        contents.append(new_text)
-                        new_text = ''
-                if new_text:
-                    contents.append(new_text)
-        return contents
+        return extract_text_from_pdf(file_path)
 
     @staticmethod
     def extract_text_from_txt(file_path: str):
         """Extract text content from a TXT file."""
-        with open(file_path, 'r', encoding='utf-8') as f:
-            contents = [text.strip() for text in f.readlines() if text.strip()]
-        return contents
+        return extract_text_from_txt(file_path)
 
     @staticmethod
     def extract_text_from_docx(file_path: str):
         """Extract text content from a DOCX file."""
-        import docx
-        document = docx.Document(file_path)
-        contents = [paragraph.text.strip() for paragraph in document.paragraphs if paragraph.text.strip()]
-        return contents
+        return extract_text_from_docx(file_path)
 
     @staticmethod
     def extract_text_from_markdown(file_path: str):
         """Extract text content from a Markdown file."""
-        import markdown
-        from bs4 import BeautifulSoup
-        with open(file_path, 'r', encoding='utf-8') as f:
-            markdown_text = f.read()
-        html = markdown.markdown(markdown_text)
-        soup = BeautifulSoup(html, 'html.parser')
-        contents = [text.strip() for text in soup.get_text().splitlines() if text.strip()]
-        return contents
+        return extract_text_from_markdown(file_path)
 
     @staticmethod
     def _add_source_numbers(lst):
@@ -369,12 +491,9 @@ class ChatPDF:
         """Generate predictions stream."""
         reference_results = []
         stop_str = self.tokenizer.eos_token if self.tokenizer.eos_token else "</s>"
-        if self.sim_model.corpus:
-            sim_contents = self.sim_model.most_similar(query, topn=topn)
+        if self._has_corpus():
             # Get reference results
-            for query_id, id_score_dict in sim_contents.items():
-                for corpus_id, s in id_score_dict.items():
-                    reference_results.append(self.sim_model.corpus[corpus_id])
+            reference_results = self._retrieve(query, topn=topn)
             if not reference_results:
                 yield 'no more info', reference_results
             self.history = []
@@ -407,12 +526,9 @@ class ChatPDF:
     ):
         """Query from corpus."""
         reference_results = []
-        if self.sim_model.corpus:
-            sim_contents = self.sim_model.most_similar(query, topn=topn)
+        if self._has_corpus():
             # Get reference results
-            for query_id, id_score_dict in sim_contents.items():
-                for corpus_id, s in id_score_dict.items():
-                    reference_results.append(self.sim_model.corpus[corpus_id])
+            reference_results = self._retrieve(query, topn=topn)
             if not reference_results:
                 return 'Not providing sufficient relevant information', reference_results
             self.history = []
@@ -438,7 +554,64 @@ class ChatPDF:
         self.history[-1][1] = response
         return response, reference_results
 
+    @torch.inference_mode()
+    def predict_batch(
+            self,
+            queries: List[str],
+            topn: int = 5,
+            max_length: int = 512,
+            context_len: int = 2048,
+            temperature: float = 0.7,
+            batch_size: int = 8,
+    ) -> List[Tuple[str, List[str]]]:
+        """
+        Query from corpus, many queries at once: retrieval for all the queries in one batch, then generation of
+        `batch_size` left-padded prompts per `generate` call, prompts sorted by length to limit padding.
+        The chat history is neither used nor changed; temperature 0 decodes greedily.
+        :return: (response, reference results) of every query, in order
+        """
+        results: List[Tuple[str, List[str]]] = [None] * len(queries)
+        has_corpus = self._has_corpus()
+        retrieved = self._retrieve_batch(queries, topn=topn) if has_corpus else [[] for _ in queries]
+        max_src_len = context_len - max_length - 8
+        inputs = []
+        for i, (query, reference_results) in enumerate(zip(queries, retrieved)):
+            if has_corpus:
+                if not reference_results:
+                    results[i] = ('Not providing sufficient relevant information', reference_results)
+                    continue
+                reference_results = self._add_source_numbers(reference_results)
+                context_str = '\n'.join(reference_results)[:(context_len - len(RAG_PROMPT))]
+                prompt = RAG_PROMPT.format(context_str=context_str, query_str=query)
+            else:
+                prompt = query
+            input_ids = self._get_chat_input(history=[[prompt, '']])[0, -max_src_len:]
+            inputs.append((i, input_ids, reference_results))
+
+        pad_token_id = self.tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = self.tokenizer.eos_token_id
+        generation_kwargs = dict(max_new_tokens=max_length, do_sample=temperature > 0, pad_token_id=pad_token_id)
+        if temperature > 0:
+            generation_kwargs['temperature'] = temperature
+        inputs.sort(key=lambda x: len(x[1]))
+        for start in range(0, len(inputs), batch_size):
+            batch = inputs[start:start + batch_size]
+            width = max(len(ids) for _, ids, _ in batch)
+            input_ids = torch.full((len(batch), width), pad_token_id, dtype=torch.long, device=self.gen_model.device)
+            attention_mask = torch.zeros_like(input_ids)
+            for row, (_, ids, _) in enumerate(batch):
+                input_ids[row, width - len(ids):] = ids
+                attention_mask[row, width - len(ids):] = 1
+            outputs = self.gen_model.generate(input_ids=input_ids, attention_mask=attention_mask, **generation_kwargs)
+            responses = self.tokenizer.batch_decode(outputs[:, width:], skip_special_tokens=True)
+            for (i, _, reference_results), response in zip(batch, responses):
+                results[i] = (response.strip(), reference_results)
+        return results
+
     def save_corpus_emb(self):
+        if self.vector_index is not None:  # persisted as it is built
+            return self.vector_index.index_dir
         dir_name = self.get_file_hash(self.corpus_files)
         save_dir = os.path.join(self.save_corpus_emb_dir, dir_name)
         if hasattr(self.sim_model, 'save_corpus_embeddings'):
@@ -466,6 +639,22 @@ if __name__ == "__main__":
     parser.add_argument("--int8", action='store_true', help="use int8 quantization")
     parser.add_argument("--chunk_size", type=int, default=100)
     parser.add_argument("--chunk_overlap", type=int, default=5)
+    parser.add_argument("--prompt_lookup_num_tokens", type=int, default=0,
+                        help="Draft tokens copied from the RAG context per decoding step, 0 to disable.")
+    parser.add_argument("--index_dir", type=str, default=None,
+                        help="Persistent vector index dir, only new or modified files are embedded on start.")
+    parser.add_argument("--index_dtype", type=str, default="float16", choices=["float16", "int8"])
+    parser.add_argument("--ann_backend", type=str, default=None, choices=["ivf", "hnsw"],
+                        help="Approximate search of the index (needs --index_dir), hnsw needs hnswlib.")
+    parser.add_argument("--ann_nprobe", type=int, default=8,
+                        help="Groups scanned per query by the ivf backend, more is slower and more accurate.")
+    parser.add_argument("--ingest_workers", type=int, default=None,
+                        help="Processes extracting the text of corpus files, default the number of CPUs.")
+    parser.add_argument("--embed_batch_size", type=int, default=256)
+    parser.add_argument("--split_mode", type=str, default="chars", choices=["chars", "spans", "tokens"],
+                        help="Chunk sizes in characters (chars, spans) or in tokens of the similarity model (tokens).")
+    parser.add_argument("--warmup_lengths", type=int, nargs='*', default=list(DEFAULT_WARMUP_LENGTHS),
+                        help="Prompt lengths generated for before the first query, none to skip.")
     args = parser.parse_args()
     print(args)
     sim_model = BertSimilarity(model_name_or_path=args.sim_model, device=args.device)
@@ -481,7 +670,16 @@ if __name__ == "__main__":
         chunk_overlap=args.chunk_overlap,
         corpus_files=args.corpus_files.split(','),
         prompt_template_name=args.prompt_template_name,
+        prompt_lookup_num_tokens=args.prompt_lookup_num_tokens,
+        index_dir=args.index_dir,
+        index_dtype=args.index_dtype,
+        ann_backend=args.ann_backend,
+        ann_kwargs={"nprobe": args.ann_nprobe} if args.ann_backend == "ivf" else None,
+        ingest_workers=args.ingest_workers,
+        embed_batch_size=args.embed_batch_size,
+        split_mode=args.split_mode,
     )
+    warmup_model(m.gen_model, m.tokenizer, args.warmup_lengths)
     query = [
         "维胺酯维E乳膏能治理什么疾病",
         "天雄的药用植物栽培是什么",
@@ -493,3 +691,7 @@ if __name__ == "__main__":
         print(f"Input: {i}")
         print(f"Reference: {reference_results}")
         print(f"Output: {response}")
+    if args.prompt_lookup_num_tokens > 0:
+        stats = m.prompt_lookup_stats
+        print(f"Prompt lookup: {stats['num_tokens'] / max(stats['num_steps'], 1):.2f} accepted tokens per step, "
+              f"{stats}")
@@ -15,11 +15,14 @@ curl -X 'POST' 'http://0.0.0.0:8008/chat' \
 
 import argparse
 import os
-from threading import Thread
+import time
+from threading import Lock, Thread
+from typing import Optional
 
 import torch
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse
 from loguru import logger
 from peft import PeftModel
 from pydantic import BaseModel, Field
@@ -32,10 +35,13 @@ from transformers import (
     BloomTokenizerFast,
     LlamaTokenizer,
     LlamaForCausalLM,
+    MaxTimeCriteria,
+    StoppingCriteriaList,
     TextIteratorStreamer,
     GenerationConfig,
 )
 
+from model_loader import DEFAULT_WARMUP_LENGTHS, load_model_and_tokenizer, warmup_model
 from template import get_conv_template
 
 MODEL_CLASSES = {
@@ -58,7 +64,11 @@ def stream_generate_answer(
         repetition_penalty=1.0,
         context_len=2048,
         stop_str="</s>",
+        deadline=None,
 ):
+    """
+    :param deadline: `time.time()` by which generation must end, None for no limit
+    """
     streamer = TextIteratorStreamer(tokenizer, timeout=60.0, skip_prompt=True, skip_special_tokens=True)
     input_ids = tokenizer(prompt).input_ids
     max_src_len = context_len - max_new_tokens - 8
@@ -70,6 +80,9 @@ def stream_generate_answer(
         repetition_penalty=repetition_penalty,
         streamer=streamer,
     )
+    if deadline is not None:
+        # counted from now, the time spent waiting for the model is already gone
+        generation_kwargs['stopping_criteria'] = StoppingCriteriaList([MaxTimeCriteria(deadline - time.time())])
     thread = Thread(target=model.generate, kwargs=generation_kwargs)
     thread.start()
 
@@ -92,6 +105,8 @@ def stream_generate_answer(
 
 class Item(BaseModel):
     input: str = Field(..., max_length=2048)
+    # seconds the request may take, waiting for the model included
+    timeout: Optional[float] = Field(None, gt=0)
 
 
 def main():
@@ -108,6 +123,10 @@ def main():
     parser.add_argument('--gpus', default="0", type=str)
     parser.add_argument('--only_cpu', action='store_true', help='only use CPU for inference')
     parser.add_argument('--port', default=8008, type=int)
+    parser.add_argument('--max_request_time', default=None, type=float,
+                        help="Max seconds per request, also the default of the request timeout")
+    parser.add_argument('--warmup_lengths', default=list(DEFAULT_WARMUP_LENGTHS), type=int, nargs='*',
+                        help="Prompt lengths generated for at startup before /health reports ready, none to skip")
     args = parser.parse_args()
     print(args)
 
@@ -115,18 +134,22 @@ def main():
         if args.only_cpu is True:
             args.gpus = ""
         os.environ["CUDA_VISIBLE_DEVICES"] = args.gpus
-        load_type = torch.float16
         if torch.cuda.is_available():
             device = torch.device(0)
+            load_type = torch.float16
         else:
             device = torch.device('cpu')
+            load_type = torch.float32
         if args.tokenizer_path is None:
             args.tokenizer_path = args.base_model
 
         model_class, tokenizer_class = MODEL_CLASSES[args.model_type]
-        tokenizer = tokenizer_class.from_pretrained(args.tokenizer_path, trust_remote_code=True)
-        base_model = model_class.from_pretrained(
+        # weights are memory-mapped on CPU, the tokenizer loads meanwhile
+        base_model, tokenizer = load_model_and_tokenizer(
             args.base_model,
+            args.tokenizer_path,
+            tokenizer_class=tokenizer_class,
+            model_class=model_class,
             torch_dtype=load_type,
             low_cpu_mem_usage=True,
             device_map='auto',
@@ -168,8 +191,20 @@ def main():
     model, tokenizer, device = load_model(args)
     prompt_template = get_conv_template(args.template_name)
     stop_str = tokenizer.eos_token if tokenizer.eos_token else prompt_template.stop_str
+    # one generation at a time, requests wait for the model in a worker thread
+    model_lock = Lock()
+    server_state = {'status': 'warming_up'}
 
-    def predict(sentence):
+    def warmup():
+        # holds the model until warm, requests arriving meanwhile wait for it
+        with model_lock:
+            try:
+                warmup_model(model, tokenizer, args.warmup_lengths)
+            except Exception as e:
+                logger.warning(f"Warmup failed: {e}")
+        server_state['status'] = 'ready'
+
+    def predict(sentence, deadline=None):
         history = [[sentence, '']]
         prompt = prompt_template.get_prompt(messages=history)
         response = stream_generate_answer(
@@ -181,6 +216,7 @@ def main():
             max_new_tokens=args.max_new_tokens,
             repetition_penalty=args.repetition_penalty,
             stop_str=stop_str,
+            deadline=deadline,
         )
         return response.strip()
 
@@ -188,17 +224,31 @@ def main():
     async def index():
         return {"message": "index, docs url: /docs"}
 
+    @app.get('/health')
+    async def health():
+        return JSONResponse(server_state, status_code=200 if server_state['status'] == 'ready' else 503)
+
     @app.post('/chat')
-    async def chat(item: Item):
+    def chat(item: Item):
+        timeout = item.timeout or args.max_request_time
+        if timeout and args.max_request_time:
+            timeout = min(timeout, args.max_request_time)
+        deadline = time.time() + timeout if timeout else None
+        if not model_lock.acquire(timeout=timeout or -1):
+            # still waiting for the model at the deadline, give up instead of queueing forever
+            raise HTTPException(status_code=503, detail="Request deadline exceeded while waiting for the model")
         try:
-            response = predict(item.input)
+            response = predict(item.input, deadline)
             result_dict = {'response': response}
             logger.debug(f"Successfully get result, q:{item.input}")
             return result_dict
         except Exception as e:
             logger.error(e)
             return None
+        finally:
+            model_lock.release()
 
+    Thread(target=warmup, daemon=True).start()
     uvicorn.run(app=app, host='0.0.0.0', port=args.port, workers=1)
 
 
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+@description: Memory-pressure driven garbage collection for the API servers.
+
+A full `gc.collect()` plus `torch.cuda.empty_cache()` after every response costs tens of
+milliseconds of tail latency and makes the CUDA caching allocator re-allocate blocks it just
+gave back. `AdaptiveGC` only collects when
+- the memory reserved by the CUDA allocator crosses a watermark of the device memory,
+- the Python heap grew by more than a number of allocated blocks since the last collection,
+- or the server has been idle for a while and something was allocated since.
+"""
+import gc
+import sys
+import time
+from typing import Callable, Dict, Optional
+
+import torch
+from loguru import logger
+
+from serving_metrics import Counter, Histogram
+
+GC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class AdaptiveGC:
+    def __init__(
+            self,
+            cuda_memory_watermark: float = 0.9,
+            heap_growth_blocks: int = 1_000_000,
+            idle_seconds: float = 5.0,
+            is_idle: Optional[Callable[[], bool]] = None,
+            enabled: bool = True,
+    ):
+        """
+        :param cuda_memory_watermark: release cached CUDA blocks once reserved memory exceeds this share of the device
+        :param heap_growth_blocks: run `gc.collect()` once this many more Python memory blocks are allocated
+        :param idle_seconds: collect after this long without requests, 0 to disable
+        :param is_idle: returns whether no request is queued or running
+        :param enabled: False collects only when forced (`--disable-gc`)
+        """
+        self.cuda_memory_watermark = cuda_memory_watermark
+        self.heap_growth_blocks = heap_growth_blocks
+        self.idle_seconds = idle_seconds
+        self.is_idle = is_idle or (lambda: True)
+        self.enabled = enabled
+        self.last_activity = time.monotonic()
+        self.heap_blocks = sys.getallocatedblocks()
+        self.dirty = False
+        self.collections = Counter('llm_gc_collections_total', 'Garbage collections run, by trigger.', 'reason')
+        self.durations = Histogram('llm_gc_duration_seconds', 'Time spent in garbage collection.', GC_BUCKETS)
+
+    @property
+    def metrics(self):
+        return [self.collections, self.durations]
+
+    def freeze(self):
+        """Move everything allocated so far (model, tokenizer) out of the collector's sight."""
+        gc.collect()
+        gc.freeze()
+        self.heap_blocks = sys.getallocatedblocks()
+
+    @staticmethod
+    def _cuda_pressure() -> float:
+        if not torch.cuda.is_available():
+            return 0.0
+        pressure = 0.0
+        for device in range(torch.cuda.device_count()):
+            total = torch.cuda.get_device_properties(device).total_memory
+            pressure = max(pressure, torch.cuda.memory_reserved(device) / total)
+        return pressure
+
+    def _trigger(self) -> Optional[str]:
+        if self._cuda_pressure() > self.cuda_memory_watermark:
+            return 'cuda_watermark'
+        if sys.getallocatedblocks() - self.heap_blocks > self.heap_growth_blocks:
+            return 'heap_growth'
+        return None
+
+    def request_finished(self):
+        """Cheap check after every response, collects only above a watermark."""
+        self.last_activity = time.monotonic()
+        self.dirty = True
+        if self.enabled:
+            reason = self._trigger()
+            if reason is not None:
+                self.collect(reason)
+
+    def on_idle_tick(self):
+        """Called periodically, collects once per idle gap if anything was allocated since the last run."""
+        if not self.enabled or not self.idle_seconds or not self.dirty:
+            return
+        if not self.is_idle():
+            self.last_activity = time.monotonic()
+        elif time.monotonic() - self.last_activity >= self.idle_seconds:
+            self.collect('idle')
+
+    def collect(self, reason: str = 'forced'):
+        start = time.perf_counter()
+        reserved = sum(torch.cuda.memory_reserved(i) for i in range(torch.cuda.device_count())) \
+            if torch.cuda.is_available() else 0
+        num_objects = gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+            reserved -= sum(torch.cuda.memory_reserved(i) for i in range(torch.cuda.device_count()))
+        duration = time.perf_counter() - start
+        self.collections.inc(label=reason)
+        self.durations.observe(duration)
+        self.heap_blocks = sys.getallocatedblocks()
+        self.dirty = False
+        logger.debug(f'gc ({reason}): {num_objects} objects collected, '
+                     f'{reserved / 2 ** 20:.1f} MiB CUDA cache released in {duration * 1000:.1f} ms')
+
+    def stats(self) -> Dict:
+        return {
+            'enabled': self.enabled,
+            'collections': dict(self.collections.values),
+            'total_seconds': self.durations.sum,
+            'cuda_memory_pressure': self._cuda_pressure(),
+            'heap_growth_blocks': sys.getallocatedblocks() - self.heap_blocks,
+        }
@@ -22,6 +22,8 @@ from transformers import (
     GenerationConfig,
 )
 
+from model_loader import DEFAULT_WARMUP_LENGTHS, load_model_and_tokenizer, warmup_model
+
 MODEL_CLASSES = {
     "bloom": (BloomForCausalLM, BloomTokenizerFast),
     "chatglm": (AutoModel, AutoTokenizer),
@@ -38,6 +40,8 @@ def main():
     parser.add_argument('--gpus', default="0", type=str)
     parser.add_argument('--only_cpu', action='store_true', help='only use CPU for inference')
     parser.add_argument('--resize_emb', action='store_true', help='Whether to resize model token embeddings')
+    parser.add_argument('--warmup_lengths', default=list(DEFAULT_WARMUP_LENGTHS), type=int, nargs='*',
+                        help="Prompt lengths generated for before the demo starts, none to skip")
     args = parser.parse_args()
     if args.only_cpu is True:
         args.gpus = ""
@@ -64,11 +68,12 @@ def main():
         repetition_penalty=1.1,
         max_new_tokens=400
     )
-    load_type = torch.float16
     if torch.cuda.is_available():
         device = torch.device(0)
+        load_type = torch.float16
     else:
         device = torch.device('cpu')
+        load_type = torch.float32
 
     if args.tokenizer_path is None and os.path.exists(
             os.path.join(args.lora_model, "tokenizer_config.json")):
@@ -76,9 +81,12 @@ def main():
     else:
         args.tokenizer_path = args.base_model
     model_class, tokenizer_class = MODEL_CLASSES[args.model_type]
-    tokenizer = tokenizer_class.from_pretrained(args.tokenizer_path, trust_remote_code=True)
-    base_model = model_class.from_pretrained(
+    # weights are memory-mapped on CPU, the tokenizer loads meanwhile
+    base_model, tokenizer = load_model_and_tokenizer(
         args.base_model,
+        args.tokenizer_path,
+        tokenizer_class=tokenizer_class,
+        model_class=model_class,
         load_in_8bit=False,
         torch_dtype=load_type,
         low_cpu_mem_usage=True,
@@ -103,6 +111,8 @@ def main():
         model.float()
 
     model.eval()
+    # the first chat does not pay for kernel selection and allocator growth
+    warmup_model(model, tokenizer, args.warmup_lengths)
 
     def reset_user_input():
         return gr.update(value='')
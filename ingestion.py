@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+@description: Parallel document ingestion of ChatPDF.
+
+Files stream through three concurrent stages:
+1. extraction: a process pool reads the text of the files, PDFs by page ranges so a single large
+   PDF keeps every worker busy;
+2. chunking: a thread joins the text of each file in page order and splits it into chunks;
+3. embedding: the caller consumes the chunks of every file, in file order, as they are ready.
+Extraction tasks in flight and chunked files waiting for the caller are bounded, so memory stays
+bounded whatever the size of the corpus.
+"""
+import multiprocessing
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from loguru import logger
+
+# a PDF line ending with one of these ends a paragraph
+PDF_PARAGRAPH_ENDINGS = {
+    '.', '!', '?', '。', '！', '？', '…', ';', '；', ':', '：', '”', '’', '）', '】', '》', '」',
+    '』', '〕', '〉', '〗', '〞', '〟', '»', '"', "'", ')', ']', '}'
+}
+
+
+def extract_text_from_pdf(file_path: str, start_page: int = 0, end_page: Optional[int] = None) -> List[str]:
+    """Extract text content from pages [start_page, end_page) of a PDF file."""
+    import PyPDF2
+    contents = []
+    with open(file_path, 'rb') as f:
+        pdf_reader = PyPDF2.PdfReader(f)
+        for page in pdf_reader.pages[start_page:end_page]:
+            page_text = page.extract_text().strip()
+            raw_text = [text.strip() for text in page_text.splitlines() if text.strip()]
+            new_text = ''
+            for text in raw_text:
+                new_text += text
+                if text[-1] in PDF_PARAGRAPH_ENDINGS:
+                    contents.append(new_text)
+                    new_text = ''
+            if new_text:
+                contents.append(new_text)
+    return contents
+
+
+def pdf_num_pages(file_path: str) -> int:
+    import PyPDF2
+    with open(file_path, 'rb') as f:
+        return len(PyPDF2.PdfReader(f).pages)
+
+
+def extract_text_from_txt(file_path: str) -> List[str]:
+    """Extract text content from a TXT file."""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        contents = [text.strip() for text in f.readlines() if text.strip()]
+    return contents
+
+
+def extract_text_from_docx(file_path: str) -> List[str]:
+    """Extract text content from a DOCX file."""
+    import docx
+    document = docx.Document(file_path)
+    contents = [paragraph.text.strip() for paragraph in document.paragraphs if paragraph.text.strip()]
+    return contents
+
+
+def extract_text_from_markdown(file_path: str) -> List[str]:
+    """Extract text content from a Markdown file."""
+    import markdown
+    from bs4 import BeautifulSoup
+    with open(file_path, 'r', encoding='utf-8') as f:
+        markdown_text = f.read()
+    html = markdown.markdown(markdown_text)
+    soup = BeautifulSoup(html, 'html.parser')
+    contents = [text.strip() for text in soup.get_text().splitlines() if text.strip()]
+    return contents
+
+
+def extract_text(file_path: str) -> List[str]:
+    if file_path.endswith('.pdf'):
+        return extract_text_from_pdf(file_path)
+    elif file_path.endswith('.docx'):
+        return extract_text_from_docx(file_path)
+    elif file_path.endswith('.md'):
+        return extract_text_from_markdown(file_path)
+    else:
+        return extract_text_from_txt(file_path)
+
+
+class _InlineExecutor:
+    """Runs the tasks in the calling thread, for a single worker."""
+
+    def submit(self, fn, *args) -> Future:
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait: bool = True, cancel_futures: bool = False):
+        pass
+
+
+def _extraction_tasks(files: List[str], pages_per_task: int) -> Iterator[Tuple[str, int, Callable, tuple]]:
+    """(file, number of tasks of the file, function, args) of every extraction task, in file order."""
+    for file_path in files:
+        num_pages = pdf_num_pages(file_path) if file_path.endswith('.pdf') else 0
+        if num_pages > pages_per_task:
+            starts = range(0, num_pages, pages_per_task)
+            for start in starts:
+                yield file_path, len(starts), extract_text_from_pdf, (file_path, start, start + pages_per_task)
+        else:
+            yield file_path, 1, extract_text, (file_path,)
+
+
+def extract_files(
+        files: List[str],
+        executor,
+        pages_per_task: int = 16,
+        max_pending_tasks: int = 8,
+) -> Iterator[Tuple[str, List[str]]]:
+    """(file, text lines) of every file in order, at most `max_pending_tasks` extraction tasks in flight."""
+    pending = deque()
+    lines, num_done = [], 0
+
+    def collect():
+        nonlocal lines, num_done
+        file_path, num_tasks, future = pending.popleft()
+        lines.extend(future.result())
+        num_done += 1
+        if num_done == num_tasks:
+            done, lines, num_done = (file_path, lines), [], 0
+            return done
+        return None
+
+    for file_path, num_tasks, fn, args in _extraction_tasks(files, pages_per_task):
+        while len(pending) >= max_pending_tasks:
+            done = collect()
+            if done:
+                yield done
+        pending.append((file_path, num_tasks, executor.submit(fn, *args)))
+    while pending:
+        done = collect()
+        if done:
+            yield done
+
+
+def iter_chunks(
+        files: List[str],
+        split_fn: Callable[[str], List[str]],
+        num_workers: Optional[int] = None,
+        pages_per_task: int = 16,
+        max_pending_files: int = 4,
+) -> Iterator[Tuple[str, List[str]]]:
+    """
+    (file, chunks) of every file in order, extracted by `num_workers` processes and split with `split_fn`
+    in a background thread.
+    :param num_workers: extraction processes, default the number of CPUs, 1 extracts in the chunking thread
+    :param pages_per_task: PDF pages extracted per task
+    :param max_pending_files: chunked files waiting for the caller before chunking pauses
+    """
+    num_workers = num_workers or os.cpu_count() or 1
+    # process workers only run the extraction: the splitter may hold a tokenizer or jieba state.
+    # They are spawned, forking a process running torch threads (and this chunking thread) can deadlock.
+    if num_workers > 1 and len(files) > 0:
+        executor = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('spawn'))
+    else:
+        executor = _InlineExecutor()
+    chunked = queue.Queue(maxsize=max_pending_files)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                chunked.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def chunk_files():
+        try:
+            for file_path, lines in extract_files(files, executor, pages_per_task, max_pending_tasks=2 * num_workers):
+                if not put((file_path, split_fn('\n'.join(lines)), None)):
+                    return
+        except Exception as e:
+            put((None, None, e))
+            return
+        put((None, None, None))
+
+    thread = threading.Thread(target=chunk_files, name='chunk_files', daemon=True)
+    thread.start()
+    try:
+        while True:
+            file_path, chunks, error = chunked.get()
+            if error is not None:
+                raise error
+            if file_path is None:
+                break
+            yield file_path, chunks
+    finally:
+        stop.set()
+        thread.join()
+        executor.shutdown(wait=True, cancel_futures=True)
+        logger.debug(f"Ingested {len(files)} files with {num_workers} extraction workers")
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+@description: Block-allocated (paged) KV cache for the batching engine.
+
+All sequences share one pool of fixed-size blocks per layer. A sequence owns a block table
+(list of block ids), grows one block at a time and gives its blocks back to the free list as
+soon as it finishes, so sequences of different lengths never fragment memory.
+
+Full blocks can additionally be kept in a `PrefixCache` (a trie keyed on the token ids of each
+block), so requests sharing a system prompt or chat history skip prefill for that prefix.
+"""
+import heapq
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+try:
+    from transformers import DynamicCache
+except ImportError:  # transformers < 4.36 only knows the legacy tuple format
+    DynamicCache = None
+
+
+def to_legacy_cache(past_key_values):
+    """Convert model cache output to a tuple of (key, value) pairs, one per layer."""
+    if past_key_values is None or isinstance(past_key_values, (tuple, list)):
+        return past_key_values
+    if hasattr(past_key_values, 'to_legacy_cache'):
+        return past_key_values.to_legacy_cache()
+    return tuple((layer.keys, layer.values) for layer in past_key_values.layers)
+
+
+def from_legacy_cache(past_key_values):
+    """Convert a tuple of (key, value) pairs into whatever cache object the model expects."""
+    if DynamicCache is None or past_key_values is None:
+        return past_key_values
+    if hasattr(DynamicCache, 'from_legacy_cache'):
+        return DynamicCache.from_legacy_cache(past_key_values)
+    return DynamicCache(past_key_values)
+
+
+class PagedKVCache:
+    """
+    Free-list allocator over a pool of KV blocks.
+
+    The pool tensors are created lazily from the first prefill output, so the layer count,
+    head layout, dtype and device of every layer come from the model itself
+    (works with `device_map='auto'` placing layers on different devices).
+    """
+
+    def __init__(self, num_blocks: int = 1024, block_size: int = 16):
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.key_blocks: List[torch.Tensor] = []
+        self.value_blocks: List[torch.Tensor] = []
+        self.free_blocks = deque(range(num_blocks))
+        self.ref_counts = [0] * num_blocks
+        self.block_tables: Dict[int, List[int]] = {}
+        self.seq_lengths: Dict[int, int] = {}
+        self.prefix_cache: Optional['PrefixCache'] = None
+
+    @property
+    def initialized(self) -> bool:
+        return bool(self.key_blocks)
+
+    def num_blocks_for(self, num_tokens: int) -> int:
+        return (num_tokens + self.block_size - 1) // self.block_size
+
+    @property
+    def block_bytes(self) -> int:
+        """Memory taken by one block over all layers (0 until the pool is created)."""
+        return sum(
+            (k.element_size() + v.element_size()) * k[0].numel() * self.block_size
+            for k, v in zip(self.key_blocks, self.value_blocks)
+        )
+
+    def num_free_blocks(self) -> int:
+        """Free blocks, counting the ones the prefix cache would give up on demand."""
+        evictable = self.prefix_cache.num_evictable() if self.prefix_cache is not None else 0
+        return len(self.free_blocks) + evictable
+
+    def blocks_needed(self, seq_id: int, num_tokens: int = 1) -> int:
+        """New blocks taken from the free list to store `num_tokens` more tokens for `seq_id`."""
+        length = self.seq_lengths[seq_id]
+        return max(0, self.num_blocks_for(length + num_tokens) - len(self.block_tables[seq_id]))
+
+    def _init_pool(self, past_key_values):
+        for k, v in past_key_values:
+            _, num_heads, _, head_dim = k.shape
+            shape = (self.num_blocks * self.block_size, num_heads, head_dim)
+            self.key_blocks.append(torch.zeros(shape, dtype=k.dtype, device=k.device))
+            self.value_blocks.append(torch.zeros(shape, dtype=v.dtype, device=v.device))
+
+    def _slots(self, seq_id: int, start: int, end: int) -> List[int]:
+        table = self.block_tables[seq_id]
+        return [table[i // self.block_size] * self.block_size + i % self.block_size for i in range(start, end)]
+
+    def _reserve(self, seq_id: int, num_tokens: int):
+        table = self.block_tables.setdefault(seq_id, [])
+        needed = self.num_blocks_for(num_tokens) - len(table)
+        if needed > len(self.free_blocks) and self.prefix_cache is not None:
+            self.prefix_cache.evict(needed - len(self.free_blocks))
+        if needed > len(self.free_blocks):
+            raise RuntimeError(f'KV cache out of blocks: need {needed}, free {len(self.free_blocks)}')
+        for _ in range(needed):
+            block = self.free_blocks.popleft()
+            self.ref_counts[block] = 1
+            table.append(block)
+
+    def share(self, seq_id: int, blocks: List[int]):
+        """Start the block table of `seq_id` with already filled (full) `blocks`."""
+        for block in blocks:
+            self.ref_counts[block] += 1
+        self.block_tables[seq_id] = list(blocks)
+        self.seq_lengths[seq_id] = len(blocks) * self.block_size
+
+    def release(self, block: int):
+        self.ref_counts[block] -= 1
+        if self.ref_counts[block] == 0:
+            self.free_blocks.append(block)
+
+    def write(self, seq_id: int, past_key_values, start: int = 0):
+        """
+        Store the positions `start:` of a batch-1 legacy cache for `seq_id`.
+        :param past_key_values: tuple of (key, value) per layer, shaped [1, heads, length, head_dim]
+        :param start: number of tokens of this sequence already stored in the pool
+        """
+        if not self.initialized:
+            self._init_pool(past_key_values)
+        end = past_key_values[0][0].shape[2]
+        self._reserve(seq_id, end)
+        self.seq_lengths[seq_id] = end
+        slots = self._slots(seq_id, start, end)
+        for layer, (k, v) in enumerate(past_key_values):
+            index = torch.tensor(slots, device=k.device)
+            self.key_blocks[layer][index] = k[0, :, start:].transpose(0, 1)
+            self.value_blocks[layer][index] = v[0, :, start:].transpose(0, 1)
+
+    def append(self, seq_ids: List[int], past_key_values, num_tokens: Optional[List[int]] = None, window: int = 1):
+        """
+        Store the last positions of a batched legacy cache, row `i` belonging to `seq_ids[i]`.
+        :param num_tokens: per row, how many of the last `window` positions to keep (default all),
+            speculative decoding drops the positions of rejected draft tokens this way
+        :param window: number of new positions at the end of every row
+        """
+        num_tokens = num_tokens or [window] * len(seq_ids)
+        slots, rows, cols = [], [], []
+        for row, (seq_id, count) in enumerate(zip(seq_ids, num_tokens)):
+            length = self.seq_lengths[seq_id]
+            self._reserve(seq_id, length + count)
+            slots.extend(self._slots(seq_id, length, length + count))
+            self.seq_lengths[seq_id] = length + count
+            rows.extend([row] * count)
+            cols.extend(range(-window, -window + count))
+        for layer, (k, v) in enumerate(past_key_values):
+            index = torch.tensor(slots, device=k.device)
+            row_index = torch.tensor(rows, device=k.device)
+            col_index = torch.tensor(cols, device=k.device) + k.shape[2]
+            self.key_blocks[layer][index] = k[row_index, :, col_index]
+            self.value_blocks[layer][index] = v[row_index, :, col_index]
+
+    def gather(self, seq_ids: List[int]) -> Tuple[tuple, List[int]]:
+        """
+        Materialize a left-padded batch cache for `seq_ids`.
+
+        HF attention needs contiguous keys/values, so the blocks are copied into one
+        [batch, heads, max_len, head_dim] tensor per layer for the forward pass.
+        :return: legacy cache tuple and per-sequence lengths
+        """
+        lengths = [self.seq_lengths[seq_id] for seq_id in seq_ids]
+        max_len = max(lengths)
+        slots = []
+        for seq_id, length in zip(seq_ids, lengths):
+            # padding positions point at slot 0, they are masked out by the attention mask
+            slots.extend([0] * (max_len - length) + self._slots(seq_id, 0, length))
+        past_key_values = []
+        for key_blocks, value_blocks in zip(self.key_blocks, self.value_blocks):
+            index = torch.tensor(slots, device=key_blocks.device)
+            k = key_blocks[index].view(len(seq_ids), max_len, *key_blocks.shape[1:]).transpose(1, 2)
+            v = value_blocks[index].view(len(seq_ids), max_len, *value_blocks.shape[1:]).transpose(1, 2)
+            past_key_values.append((k, v))
+        return tuple(past_key_values), lengths
+
+    def free(self, seq_id: int):
+        """Drop `seq_id`, its blocks go back to the free list unless the prefix cache still holds them."""
+        for block in self.block_tables.pop(seq_id, []):
+            self.release(block)
+        self.seq_lengths.pop(seq_id, None)
+
+    def stats(self) -> Dict[str, float]:
+        used_blocks = self.num_blocks - len(self.free_blocks)
+        used_tokens = sum(self.seq_lengths.values())
+        if self.prefix_cache is not None:
+            # cached blocks that no sequence references are full, count their tokens too
+            used_tokens += self.prefix_cache.num_evictable() * self.block_size
+        return {
+            'num_blocks': self.num_blocks,
+            'block_size': self.block_size,
+            'used_blocks': used_blocks,
+            'free_blocks': len(self.free_blocks),
+            'block_utilization': used_blocks / self.num_blocks if self.num_blocks else 0.0,
+            # share of the slots in allocated blocks that actually hold a token (1 - internal fragmentation)
+            'slot_utilization': used_tokens / (used_blocks * self.block_size) if used_blocks else 0.0,
+            'num_sequences': len(self.block_tables),
+        }
+
+
+class _PrefixNode:
+    __slots__ = ('key', 'block', 'parent', 'children', 'last_access')
+
+    def __init__(self, key: Tuple[int, ...] = (), block: int = -1, parent: '_PrefixNode' = None):
+        self.key = key
+        self.block = block
+        self.parent = parent
+        self.children: Dict[Tuple[int, ...], '_PrefixNode'] = {}
+        self.last_access = time.monotonic()
+
+
+class PrefixCache:
+    """
+    Trie over token ids with one full KV block per edge.
+
+    Finished sequences insert their full blocks, new requests reuse the blocks of their longest
+    cached prefix. The cache holds a reference on each of its blocks; blocks that no running
+    sequence references are evicted least-recently-used first, when the cache grows past
+    `max_blocks` or when the pool needs free blocks.
+    """
+
+    def __init__(self, kv_cache: PagedKVCache, max_blocks: int):
+        self.kv_cache = kv_cache
+        self.block_size = kv_cache.block_size
+        self.max_blocks = max_blocks
+        # one trie per namespace: KV computed with different LoRA adapters is not interchangeable
+        self.roots: Dict[Optional[str], _PrefixNode] = {}
+        self.nodes: Dict[int, _PrefixNode] = {}
+        self.num_queries = 0
+        self.num_hits = 0
+        self.num_query_tokens = 0
+        self.num_hit_tokens = 0
+        self.num_evicted = 0
+        kv_cache.prefix_cache = self
+
+    def _keys(self, token_ids: List[int]):
+        for i in range(len(token_ids) // self.block_size):
+            yield tuple(token_ids[i * self.block_size:(i + 1) * self.block_size])
+
+    def _root(self, namespace: Optional[str]) -> _PrefixNode:
+        root = self.roots.get(namespace)
+        if root is None:
+            root = self.roots[namespace] = _PrefixNode()
+        return root
+
+    def match(self, token_ids: List[int], namespace: Optional[str] = None) -> List[int]:
+        """Return the blocks holding the longest cached prefix of `token_ids` (whole blocks only)."""
+        node, blocks = self._root(namespace), []
+        now = time.monotonic()
+        for key in self._keys(token_ids):
+            node = node.children.get(key)
+            if node is None:
+                break
+            node.last_access = now
+            blocks.append(node.block)
+        self.num_queries += 1
+        self.num_query_tokens += len(token_ids)
+        if blocks:
+            self.num_hits += 1
+            self.num_hit_tokens += len(blocks) * self.block_size
+        return blocks
+
+    def insert(self, token_ids: List[int], blocks: List[int], namespace: Optional[str] = None):
+        """Cache the full blocks of a sequence, `blocks[i]` holding the i-th block of `token_ids`."""
+        node = self._root(namespace)
+        now = time.monotonic()
+        for key, block in zip(self._keys(token_ids), blocks):
+            child = node.children.get(key)
+            if child is None:
+                child = _PrefixNode(key, block, node)
+                node.children[key] = child
+                self.nodes[block] = child
+                self.kv_cache.ref_counts[block] += 1
+            child.last_access = now
+            node = child
+        if len(self.nodes) > self.max_blocks:
+            self.evict(len(self.nodes) - self.max_blocks)
+
+    def _is_evictable(self, node: _PrefixNode) -> bool:
+        return not node.children and self.kv_cache.ref_counts[node.block] == 1
+
+    def num_evictable(self) -> int:
+        # a block referenced by a sequence keeps all its ancestors referenced as well,
+        # so every block held by the cache alone can be reached by evicting leaves
+        return sum(1 for block in self.nodes if self.kv_cache.ref_counts[block] == 1)
+
+    def evict(self, num_blocks: int) -> int:
+        """Evict up to `num_blocks` unreferenced blocks, least recently used leaves first."""
+        heap = [(node.last_access, node.block) for node in self.nodes.values() if self._is_evictable(node)]
+        heapq.heapify(heap)
+        evicted = 0
+        while heap and evicted < num_blocks:
+            _, block = heapq.heappop(heap)
+            node = self.nodes.pop(block)
+            parent = node.parent
+            del parent.children[node.key]
+            self.kv_cache.release(block)
+            evicted += 1
+            if parent.parent is not None and self._is_evictable(parent):
+                heapq.heappush(heap, (parent.last_access, parent.block))
+        self.num_evicted += evicted
+        return evicted
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'cached_blocks': len(self.nodes),
+            'max_blocks': self.max_blocks,
+            'cached_bytes': len(self.nodes) * self.kv_cache.block_bytes,
+            'evicted_blocks': self.num_evicted,
+            'hit_rate': self.num_hits / self.num_queries if self.num_queries else 0.0,
+            'token_hit_rate': self.num_hit_tokens / self.num_query_tokens if self.num_query_tokens else 0.0,
+            'hit_tokens': self.num_hit_tokens,
+        }
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+@description: Serve many LoRA adapters on top of one base model.
+
+The base model is loaded once; the targeted `nn.Linear` layers are wrapped by `LoRALinear`,
+which adds the low-rank update of each row's own adapter. Rows of a batch are grouped by
+adapter (segmented LoRA matmul), so requests for different adapters share the forward pass.
+
+Adapters are PEFT checkpoints (`adapter_config.json` + `adapter_model.safetensors`/`.bin`, as
+saved by supervised_finetuning.py / dpo_training.py). They are loaded from disk on first use and
+kept in an LRU of at most `max_loaded_adapters`; adapters used by running requests are pinned.
+"""
+import json
+import math
+import os
+from collections import OrderedDict
+from threading import RLock
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from loguru import logger
+from torch import nn
+
+from quantization import QuantizedLinear
+
+
+class LoRAAdapter:
+    """Weights of one PEFT LoRA checkpoint, keyed by the base model module name."""
+
+    def __init__(self, name: str, path: str):
+        self.name = name
+        self.path = path
+        # module name -> (lora_A [r, in], lora_B [out, r], scaling)
+        self.weights: Dict[str, Tuple[torch.Tensor, torch.Tensor, float]] = {}
+        self.ref_count = 0
+
+    @property
+    def num_bytes(self) -> int:
+        return sum(a.numel() * a.element_size() + b.numel() * b.element_size() for a, b, _ in self.weights.values())
+
+    @staticmethod
+    def _module_name(key: str) -> Tuple[str, str]:
+        """Split a PEFT state dict key into the base module name and 'lora_A' / 'lora_B'."""
+        if key.startswith('base_model.model.'):
+            key = key[len('base_model.model.'):]
+        for part in ('lora_A', 'lora_B'):
+            marker = f'.{part}.'
+            if marker in key:
+                return key.split(marker)[0], part
+        return key, ''
+
+    @classmethod
+    def from_pretrained(cls, name: str, path: str, modules: Dict[str, nn.Module]) -> 'LoRAAdapter':
+        """
+        Load an adapter checkpoint, moving every weight to the device and dtype of its base layer.
+        :param modules: named modules of the base model
+        """
+        with open(os.path.join(path, 'adapter_config.json'), 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        safetensors_file = os.path.join(path, 'adapter_model.safetensors')
+        if os.path.exists(safetensors_file):
+            from safetensors.torch import load_file
+            state_dict = load_file(safetensors_file)
+        else:
+            state_dict = torch.load(os.path.join(path, 'adapter_model.bin'), map_location='cpu')
+        pairs: Dict[str, Dict[str, torch.Tensor]] = {}
+        for key, value in state_dict.items():
+            module_name, part = cls._module_name(key)
+            if not part:
+                logger.warning(f'Adapter {name}: ignoring non-LoRA weight {key}')
+                continue
+            pairs.setdefault(module_name, {})[part] = value
+        adapter = cls(name, path)
+        alpha_pattern = config.get('alpha_pattern') or {}
+        for module_name, pair in pairs.items():
+            base_layer = modules.get(module_name)
+            if isinstance(base_layer, LoRALinear):
+                base_layer = base_layer.base_layer
+            if not isinstance(base_layer, (nn.Linear, QuantizedLinear)):
+                raise ValueError(f'Adapter {name}: {module_name} is not a linear layer of the base model')
+            lora_a, lora_b = pair['lora_A'], pair['lora_B']
+            rank = lora_a.shape[0]
+            alpha = next((v for k, v in alpha_pattern.items() if module_name.endswith(k)), config['lora_alpha'])
+            scaling = alpha / math.sqrt(rank) if config.get('use_rslora') else alpha / rank
+            if isinstance(base_layer, QuantizedLinear):
+                device, dtype = base_layer.device, base_layer.dtype
+            else:
+                device, dtype = base_layer.weight.device, base_layer.weight.dtype
+            adapter.weights[module_name] = (
+                lora_a.to(device=device, dtype=dtype),
+                lora_b.to(device=device, dtype=dtype),
+                scaling,
+            )
+        return adapter
+
+
+class LoRALinear(nn.Module):
+    """`nn.Linear` (or `QuantizedLinear`) plus the LoRA update of the adapters active for each row of the batch."""
+
+    def __init__(self, base_layer: nn.Module, name: str, manager: 'LoRAManager'):
+        super().__init__()
+        self.base_layer = base_layer
+        self.name = name
+        self.manager = manager
+
+    @property
+    def weight(self):
+        return self.base_layer.weight
+
+    @property
+    def bias(self):
+        return self.base_layer.bias
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        output = self.base_layer(x)
+        for adapter, rows in self.manager.segments:
+            weights = adapter.weights.get(self.name)
+            if weights is None:
+                continue
+            lora_a, lora_b = weights[0], weights[1]
+            if rows is None:  # the whole batch uses this adapter
+                output = output + (x @ lora_a.T) @ lora_b.T * weights[2]
+            else:
+                rows = rows.to(x.device)
+                update = (x.index_select(0, rows) @ lora_a.T) @ lora_b.T * weights[2]
+                output = output.index_add(0, rows, update.to(output.dtype))
+        return output
+
+
+class LoRAManager:
+    """
+    LRU of LoRA adapters resident in memory, loaded lazily from `adapter_paths`.
+
+    The engine calls `activate` with the adapter of every batch row before each forward pass;
+    `acquire` / `release` pin an adapter for the lifetime of a request.
+    """
+
+    def __init__(self, model: nn.Module, adapter_paths: Dict[str, str], max_loaded_adapters: int = 4):
+        self.model = model
+        self.adapter_paths = dict(adapter_paths)
+        self.max_loaded_adapters = max_loaded_adapters
+        self.loaded: 'OrderedDict[str, LoRAAdapter]' = OrderedDict()
+        self.segments: List[Tuple[LoRAAdapter, Optional[torch.Tensor]]] = []
+        self.num_loads = 0
+        self.num_evictions = 0
+        self._lock = RLock()
+
+    @property
+    def names(self) -> List[str]:
+        return list(self.adapter_paths)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.adapter_paths
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self.loaded
+
+    def load(self, name: str) -> LoRAAdapter:
+        """Return the adapter `name`, reading it from disk and evicting the LRU unpinned one if needed."""
+        with self._lock:
+            adapter = self.loaded.get(name)
+            if adapter is not None:
+                self.loaded.move_to_end(name)
+                return adapter
+            if name not in self.adapter_paths:
+                raise KeyError(f'Unknown LoRA adapter: {name}')
+            modules = dict(self.model.named_modules())
+            adapter = LoRAAdapter.from_pretrained(name, self.adapter_paths[name], modules)
+            for module_name in adapter.weights:
+                self._wrap(module_name, modules)
+            self.loaded[name] = adapter
+            self.num_loads += 1
+            logger.info(f'Loaded LoRA adapter {name} from {adapter.path}: {len(adapter.weights)} layers, '
+                        f'{adapter.num_bytes / 2 ** 20:.1f} MiB')
+            self._evict(keep=name)
+            return adapter
+
+    def _wrap(self, module_name: str, modules: Dict[str, nn.Module]):
+        if isinstance(modules[module_name], LoRALinear):
+            return
+        parent_name, _, child_name = module_name.rpartition('.')
+        parent = modules[parent_name] if parent_name else self.model
+        wrapper = LoRALinear(modules[module_name], module_name, self)
+        setattr(parent, child_name, wrapper)
+        modules[module_name] = wrapper
+
+    def _evict(self, keep: Optional[str] = None):
+        while len(self.loaded) > self.max_loaded_adapters:
+            name = next((name for name, adapter in self.loaded.items() if adapter.ref_count == 0 and name != keep),
+                        None)
+            if name is None:
+                logger.warning(f'All {len(self.loaded)} resident LoRA adapters are in use, '
+                               f'exceeding max_loaded_adapters={self.max_loaded_adapters}')
+                return
+            del self.loaded[name]
+            self.num_evictions += 1
+            logger.info(f'Evicted LoRA adapter {name}')
+
+    def acquire(self, name: str) -> LoRAAdapter:
+        with self._lock:
+            adapter = self.load(name)
+            adapter.ref_count += 1
+            return adapter
+
+    def release(self, name: str):
+        with self._lock:
+            adapter = self.loaded.get(name)
+            if adapter is not None:
+                adapter.ref_count -= 1
+            self._evict()
+
+    def activate(self, names: List[Optional[str]]):
+        """Select the adapter of each batch row (None for the base model) for the next forward pass."""
+        rows: Dict[str, List[int]] = {}
+        for i, name in enumerate(names):
+            if name is not None:
+                rows.setdefault(name, []).append(i)
+        self.segments = [
+            (self.loaded[name], None if len(index) == len(names) else torch.tensor(index))
+            for name, index in rows.items()
+        ]
+
+    def stats(self) -> Dict:
+        return {
+            'adapters': self.names,
+            'loaded': list(self.loaded),
+            'max_loaded_adapters': self.max_loaded_adapters,
+            'loaded_bytes': sum(adapter.num_bytes for adapter in self.loaded.values()),
+            'num_loads': self.num_loads,
+            'num_evictions': self.num_evictions,
+        }
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+@description: Fast model startup shared by the servers: memory-mapped safetensors loading,
+tokenizer loading overlapped with weight loading, and warmup generations.
+
+On CPU the checkpoint shards are memory-mapped and their tensors are assigned to a model skeleton
+built without allocating weights, so nothing is read or copied until a weight is first used (the
+page cache is shared between processes serving the same checkpoint). Checkpoints the skeleton
+does not match (renamed keys, remote code with custom loading, dtype conversion) and GPU device
+maps go through `from_pretrained`.
+"""
+import json
+import mmap
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import torch
+from loguru import logger
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer, GenerationConfig
+
+DEFAULT_WARMUP_LENGTHS = (16, 128, 512)
+
+_SAFETENSORS_DTYPES = {
+    'F64': torch.float64,
+    'F32': torch.float32,
+    'F16': torch.float16,
+    'BF16': torch.bfloat16,
+    'I64': torch.int64,
+    'I32': torch.int32,
+    'I16': torch.int16,
+    'I8': torch.int8,
+    'U8': torch.uint8,
+    'BOOL': torch.bool,
+    'F8_E4M3': getattr(torch, 'float8_e4m3fn', None),
+    'F8_E5M2': getattr(torch, 'float8_e5m2', None),
+}
+
+
+def build_empty_model(config, model_class=AutoModelForCausalLM, trust_remote_code: bool = False):
+    """Model from `config` with its parameters on the meta device; buffers (rotary tables) stay real."""
+    from accelerate import init_empty_weights
+
+    with init_empty_weights(include_buffers=False):
+        if hasattr(model_class, 'from_config'):  # Auto classes
+            return model_class.from_config(config, trust_remote_code=trust_remote_code)
+        return model_class(config)
+
+
+def mmap_safetensors(filename: str) -> Dict[str, torch.Tensor]:
+    """
+    Tensors of a safetensors file backed by a private memory map of it, no data is read until used.
+    The tensors are writable (copy-on-write), changes never reach the file.
+    """
+    with open(filename, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    header_size = struct.unpack('<Q', buffer[:8])[0]
+    header = json.loads(buffer[8:8 + header_size])
+    data_offset = 8 + header_size
+    tensors = {}
+    for name, info in header.items():
+        if name == '__metadata__':
+            continue
+        dtype = _SAFETENSORS_DTYPES.get(info['dtype'])
+        if dtype is None:
+            raise ValueError(f'Unsupported safetensors dtype {info["dtype"]} of {name} in {filename}')
+        begin, end = info['data_offsets']
+        if begin == end:
+            tensors[name] = torch.empty(info['shape'], dtype=dtype)
+            continue
+        tensors[name] = torch.frombuffer(
+            buffer, dtype=dtype, count=(end - begin) // dtype.itemsize, offset=data_offset + begin,
+        ).view(info['shape'])
+    return tensors
+
+
+def _local_checkpoint_dir(model_name_or_path: str, revision: Optional[str] = None) -> Optional[str]:
+    """Local directory of the checkpoint, a hub snapshot only if it is already downloaded."""
+    if os.path.isdir(model_name_or_path):
+        return model_name_or_path
+    try:
+        from huggingface_hub import snapshot_download
+
+        return snapshot_download(model_name_or_path, revision=revision, local_files_only=True)
+    except Exception:
+        return None
+
+
+def checkpoint_fingerprint(model_name_or_path: str, revision: Optional[str] = None) -> Dict[str, List[int]]:
+    """
+    [size, mtime_ns] of the config and weight files of a local or downloaded checkpoint (or adapter),
+    they change whenever it is saved again. Empty if the checkpoint is not on disk.
+    """
+    checkpoint_dir = _local_checkpoint_dir(model_name_or_path, revision)
+    if checkpoint_dir is None:
+        return {}
+    files = {}
+    for name in sorted(os.listdir(checkpoint_dir)):
+        if name.endswith(('config.json', '.safetensors', '.bin', '.index.json')):
+            stat = os.stat(os.path.join(checkpoint_dir, name))
+            files[name] = [stat.st_size, stat.st_mtime_ns]
+    return files
+
+
+def _safetensors_files(checkpoint_dir: str) -> Optional[list]:
+    index_file = os.path.join(checkpoint_dir, 'model.safetensors.index.json')
+    if os.path.exists(index_file):
+        with open(index_file, 'r', encoding='utf-8') as f:
+            weight_map = json.load(f)['weight_map']
+        return [os.path.join(checkpoint_dir, name) for name in sorted(set(weight_map.values()))]
+    single_file = os.path.join(checkpoint_dir, 'model.safetensors')
+    if os.path.exists(single_file):
+        return [single_file]
+    return None
+
+
+def _is_cpu_device_map(device_map) -> bool:
+    if device_map is None:
+        return not torch.cuda.is_available()
+    if isinstance(device_map, (str, torch.device)):
+        return str(device_map) == 'cpu' or (str(device_map) == 'auto' and not torch.cuda.is_available())
+    return all(str(device) == 'cpu' for device in device_map.values())
+
+
+def load_mmap_model(
+        model_name_or_path: str,
+        model_class=AutoModelForCausalLM,
+        torch_dtype=None,
+        trust_remote_code: bool = False,
+        revision: Optional[str] = None,
+):
+    """
+    Load a CPU model with its weights memory-mapped from the safetensors shards,
+    None if the checkpoint can not be loaded that way.
+    """
+    checkpoint_dir = _local_checkpoint_dir(model_name_or_path, revision)
+    shards = _safetensors_files(checkpoint_dir) if checkpoint_dir else None
+    if not shards:
+        return None
+    config = AutoConfig.from_pretrained(checkpoint_dir, trust_remote_code=trust_remote_code)
+    model = build_empty_model(config, model_class, trust_remote_code=trust_remote_code)
+    state_dict = {}
+    for shard in shards:
+        state_dict.update(mmap_safetensors(shard))
+    if torch_dtype != 'auto':
+        # memory-mapped weights are only kept as they are in their checkpoint dtype, which must be the one
+        # from_pretrained would load: the default dtype (float32) when none is given
+        if torch_dtype is None:
+            dtype = torch.get_default_dtype()
+        else:
+            dtype = getattr(torch, torch_dtype) if isinstance(torch_dtype, str) else torch_dtype
+        if any(t.is_floating_point() and t.dtype != dtype for t in state_dict.values()):
+            logger.info(f'Checkpoint dtype differs from {dtype}, loading {model_name_or_path} with from_pretrained')
+            return None
+    missing, unexpected = model.load_state_dict(state_dict, strict=False, assign=True)
+    model.tie_weights()
+    on_meta = [name for name, param in model.named_parameters() if param.is_meta]
+    if unexpected or on_meta:
+        logger.info(f'Checkpoint keys do not match the model ({len(unexpected)} unexpected, '
+                    f'{len(on_meta)} missing), loading {model_name_or_path} with from_pretrained')
+        return None
+    try:
+        model.generation_config = GenerationConfig.from_pretrained(checkpoint_dir)
+    except OSError:
+        pass
+    return model.eval()
+
+
+def load_model(
+        model_name_or_path: str,
+        model_class=AutoModelForCausalLM,
+        device_map=None,
+        torch_dtype=None,
+        mmap_weights: bool = True,
+        **kwargs,
+):
+    """
+    Load a pretrained model, memory-mapping its safetensors weights when it runs on CPU.
+    :param mmap_weights: False to always load with `from_pretrained`
+    :param kwargs: passed to `from_pretrained` (trust_remote_code, revision, low_cpu_mem_usage, ...)
+    """
+    start = time.time()
+    model = None
+    if mmap_weights and _is_cpu_device_map(device_map) and not kwargs.get('load_in_8bit') \
+            and not kwargs.get('load_in_4bit'):
+        try:
+            model = load_mmap_model(
+                model_name_or_path,
+                model_class,
+                torch_dtype=torch_dtype,
+                trust_remote_code=kwargs.get('trust_remote_code', False),
+                revision=kwargs.get('revision'),
+            )
+        except Exception as e:
+            logger.warning(f'Memory-mapped loading of {model_name_or_path} failed, using from_pretrained: {e}')
+            model = None
+    if model is None:
+        if torch_dtype is not None:
+            kwargs['torch_dtype'] = torch_dtype
+        model = model_class.from_pretrained(model_name_or_path, device_map=device_map, **kwargs)
+        logger.info(f'Loaded {model_name_or_path} in {time.time() - start:.2f}s')
+    else:
+        logger.info(f'Memory-mapped {model_name_or_path} in {time.time() - start:.2f}s')
+    return model
+
+
+def load_model_and_tokenizer(
+        model_name_or_path: str,
+        tokenizer_name_or_path: Optional[str] = None,
+        tokenizer_class=AutoTokenizer,
+        tokenizer_kwargs: Optional[Dict] = None,
+        load_fn: Callable = load_model,
+        **kwargs,
+) -> Tuple[torch.nn.Module, object]:
+    """
+    Load the tokenizer in a thread while the weights load, return (model, tokenizer).
+    :param load_fn: called as `load_fn(model_name_or_path, **kwargs)` to load the model,
+        e.g. `quantization.load_quantized_model`
+    :param kwargs: passed to `load_fn` (model_class, device_map, torch_dtype, trust_remote_code, ...)
+    """
+    tokenizer_kwargs = dict(tokenizer_kwargs or {})
+    tokenizer_kwargs.setdefault('trust_remote_code', kwargs.get('trust_remote_code', False))
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='tokenizer-loader') as executor:
+        tokenizer_future = executor.submit(
+            tokenizer_class.from_pretrained, tokenizer_name_or_path or model_name_or_path, **tokenizer_kwargs)
+        model = load_fn(model_name_or_path, **kwargs)
+        tokenizer = tokenizer_future.result()
+    return model, tokenizer
+
+
+def warmup_inputs(tokenizer, length: int, max_length: Optional[int] = None) -> torch.Tensor:
+    """[1, length] prompt token ids, a sentence repeated and cut to `length` (and `max_length`)."""
+    token_ids = tokenizer('The quick brown fox jumps over the lazy dog. ', add_special_tokens=False).input_ids
+    token_ids = token_ids or [tokenizer.eos_token_id or 0]
+    if max_length:
+        length = min(length, max_length)
+    return torch.tensor([(token_ids * (length // len(token_ids) + 1))[:length]])
+
+
+@torch.inference_mode()
+def warmup_model(
+        model,
+        tokenizer,
+        lengths: Iterable[int] = DEFAULT_WARMUP_LENGTHS,
+        max_new_tokens: int = 2,
+) -> Dict[int, float]:
+    """
+    Run a short greedy generation at every prompt length, so kernels, allocator pools and lazily
+    mapped weights are ready before the first request. Return the seconds taken per length.
+    """
+    max_length = getattr(model.config, 'max_position_embeddings', None)
+    timings = {}
+    if not lengths:
+        return timings
+    for length in lengths:
+        input_ids = warmup_inputs(tokenizer, length, max_length and max_length - max_new_tokens)
+        start = time.time()
+        model.generate(
+            input_ids.to(model.device),
+            attention_mask=torch.ones_like(input_ids).to(model.device),
+            max_new_tokens=max_new_tokens,
+            min_new_tokens=max_new_tokens,
+            do_sample=False,
+            pad_token_id=tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id,
+        )
+        timings[length] = time.time() - start
+    logger.info('Warmup: ' + ', '.join(f'{length} tokens {seconds:.2f}s' for length, seconds in timings.items()))
+    return timings
@@ -4,27 +4,49 @@
 #   python openai_api.py
 # Visit http://localhost:8000/docs for documents.
 
+import asyncio
 import base64
-import copy
+import hashlib
 import json
+import math
+import sys
 import time
 from argparse import ArgumentParser
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
-from threading import Thread
+from functools import partial
 from typing import Dict, List, Literal, Optional, Union, Any
 
-import torch
 import uvicorn
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from loguru import logger
 from pydantic import BaseModel, Field
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.requests import Request
 from starlette.responses import Response
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from transformers import GenerationConfig, TextIteratorStreamer
+from transformers import AutoModelForCausalLM
+from transformers import GenerationConfig, StoppingCriteriaList
+
+from gc_policy import AdaptiveGC
+from lora_adapters import LoRAManager
+from model_loader import checkpoint_fingerprint, load_model, load_model_and_tokenizer, warmup_inputs
+from prompt_cache import ChatInputCache
+from quantization import load_quantized_model
+from replica_router import serve_replicas
+from response_cache import ResponseCache
+from serving_engine import (
+    AsyncTextIteratorStreamer,
+    CancelledCriteria,
+    ContinuousBatchingEngine,
+    DeadlineExceededError,
+    EmbeddingBatcher,
+    GenerationSequence,
+    PRIORITY_CLASSES,
+    StopWordsStreamer,
+)
 
 
 class BasicAuthMiddleware(BaseHTTPMiddleware):
@@ -35,6 +57,8 @@ class BasicAuthMiddleware(BaseHTTPMiddleware):
             f'{username}:{password}'.encode()).decode()
 
     async def dispatch(self, request: Request, call_next):
+        if request.url.path == '/health':  # probes carry no credentials
+            return await call_next(request)
         authorization: str = request.headers.get('Authorization')
         if authorization:
             try:
@@ -48,22 +72,111 @@ class BasicAuthMiddleware(BaseHTTPMiddleware):
         return Response(status_code=401, headers=headers)
 
 
-def _gc(forced: bool = False):
-    global args
-    if args.disable_gc and not forced:
-        return
+class GenerationExecutor:
+    """
+    Dedicated thread pool for blocking generation calls with a bounded admission queue.
 
-    import gc
+    Keeps `model_chat` off the event loop, so `/v1/models` and health probes stay responsive,
+    and rejects requests with 429 + Retry-After instead of queueing without limit.
+    Only touched from the event loop thread, so the counters need no lock.
+    """
 
-    gc.collect()
-    if torch.cuda.is_available():
-        torch.cuda.empty_cache()
+    def __init__(self, max_workers: int, max_queue_size: int):
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='generation')
+        self.num_pending = 0
+        self.num_rejected = 0
+        self.avg_latency = 1.0  # seconds, moving average used for Retry-After
+
+    @property
+    def queue_depth(self) -> int:
+        return max(0, self.num_pending - self.max_workers)
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.avg_latency * (self.queue_depth + 1) / self.max_workers))
+
+    async def submit(self, fn, *args, **kwargs):
+        if self.queue_depth >= self.max_queue_size:
+            self.num_rejected += 1
+            raise HTTPException(
+                status_code=429,
+                detail='Too many requests: the generation queue is full, please retry later.',
+                headers={'Retry-After': str(self.retry_after())},
+            )
+        self.num_pending += 1
+        start = time.time()
+        try:
+            # only the scheduling is guarded, errors of the generation itself are server errors
+            try:
+                future = asyncio.get_running_loop().run_in_executor(self.executor, partial(fn, *args, **kwargs))
+            except RuntimeError as e:  # executor shut down
+                raise HTTPException(
+                    status_code=503,
+                    detail=f'Service unavailable: {e}',
+                    headers={'Retry-After': str(self.retry_after())},
+                )
+            return await future
+        finally:
+            self.num_pending -= 1
+            self.avg_latency = 0.9 * self.avg_latency + 0.1 * (time.time() - start)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'workers': self.max_workers,
+            'pending': self.num_pending,
+            'queue_depth': self.queue_depth,
+            'max_queue_size': self.max_queue_size,
+            'rejected': self.num_rejected,
+        }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):  # collects GPU memory
+    idle_gc_task = asyncio.create_task(idle_gc_loop())
+    warmup_task = asyncio.create_task(warmup())
     yield
-    _gc(forced=True)
+    warmup_task.cancel()
+    idle_gc_task.cancel()
+    generation_executor.shutdown()
+    embedding_batcher.shutdown()
+    if response_cache is not None:
+        response_cache.close()
+    gc_policy.collect('shutdown')
+
+
+def warmup_engine(engine, tokenizer, lengths: List[int], max_new_tokens: int = 2) -> Dict[int, float]:
+    """Generate a few tokens for a prompt of every length through the engine, return the seconds per length."""
+    timings = {}
+    for length in lengths:
+        input_ids = warmup_inputs(tokenizer, length, engine.kv_cache.num_blocks * engine.kv_cache.block_size // 2)
+        start = time.time()
+        engine.add_request(input_ids[0].tolist(), {'max_new_tokens': max_new_tokens, 'do_sample': False}).wait()
+        timings[length] = time.time() - start
+    return timings
+
+
+async def warmup():
+    """Warm the engine up in the background, /health reports ready once done."""
+    global server_state, engine, tokenizer, args
+    try:
+        if args.warmup_lengths:
+            timings = await asyncio.to_thread(warmup_engine, engine, tokenizer, args.warmup_lengths)
+            logger.info('Warmup: ' + ', '.join(f'{length} tokens {seconds:.2f}s' for length, seconds in timings.items()))
+    except Exception as e:  # a failed warmup only costs first-request latency
+        logger.warning(f'Warmup failed: {e}')
+    server_state['status'] = 'ready'
+    server_state['ready_time'] = time.time()
+
+
+async def idle_gc_loop(interval: float = 1.0):
+    global gc_policy
+    while True:
+        await asyncio.sleep(interval)
+        gc_policy.on_idle_tick()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -101,6 +214,7 @@ class ChatMessage(BaseModel):
 class DeltaMessage(BaseModel):
     role: Optional[Literal['user', 'assistant', 'system']] = None
     content: Optional[str] = None
+    function_call: Optional[Dict] = None
 
 
 class ChatCompletionRequest(BaseModel):
@@ -111,8 +225,13 @@ class ChatCompletionRequest(BaseModel):
     top_p: Optional[float] = None
     top_k: Optional[int] = None
     max_length: Optional[int] = None
+    # new tokens at most, overrides max_length
+    max_tokens: Optional[int] = None
     stream: Optional[bool] = False
     stop: Optional[List[str]] = None
+    # seconds the whole request may take, generation ends with what it has by then
+    timeout: Optional[float] = None
+    priority: Optional[Literal['interactive', 'batch']] = None
 
 
 class ChatCompletionResponseChoice(BaseModel):
@@ -124,7 +243,13 @@ class ChatCompletionResponseChoice(BaseModel):
 class ChatCompletionResponseStreamChoice(BaseModel):
     index: int
     delta: DeltaMessage
-    finish_reason: Optional[Literal['stop', 'length']]
+    finish_reason: Optional[Literal['stop', 'length', 'function_call']]
+
+
+class UsageInfo(BaseModel):
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    total_tokens: int = 0
 
 
 class ChatCompletionResponse(BaseModel):
@@ -133,13 +258,106 @@ class ChatCompletionResponse(BaseModel):
     choices: List[Union[ChatCompletionResponseChoice,
     ChatCompletionResponseStreamChoice]]
     created: Optional[int] = Field(default_factory=lambda: int(time.time()))
+    usage: Optional[UsageInfo] = None
+
+
+class CompletionRequest(BaseModel):
+    model: str
+    prompt: Union[str, List[str]]
+    max_tokens: Optional[int] = 16
+    temperature: Optional[float] = None
+    top_p: Optional[float] = None
+    top_k: Optional[int] = None
+    stop: Optional[List[str]] = None
+    timeout: Optional[float] = None
+    priority: Optional[Literal['interactive', 'batch']] = None
+
+
+class CompletionResponseChoice(BaseModel):
+    index: int
+    text: str
+    finish_reason: Literal['stop', 'length']
+
+
+class CompletionResponse(BaseModel):
+    model: str
+    object: Literal['text_completion'] = 'text_completion'
+    choices: List[CompletionResponseChoice]
+    created: Optional[int] = Field(default_factory=lambda: int(time.time()))
+    usage: UsageInfo
+
+
+class EmbeddingRequest(BaseModel):
+    model: str
+    input: Union[str, List[str]]
+
+
+class EmbeddingData(BaseModel):
+    object: Literal['embedding'] = 'embedding'
+    embedding: List[float]
+    index: int
+
+
+class EmbeddingResponse(BaseModel):
+    object: Literal['list'] = 'list'
+    data: List[EmbeddingData]
+    model: str
+    usage: UsageInfo
+
+
+@app.get('/health')
+async def health():
+    """200 once the model is loaded and warmed up, 503 before."""
+    global server_state
+    status_code = 200 if server_state['status'] == 'ready' else 503
+    return JSONResponse(server_state, status_code=status_code)
+
+
+@app.get('/v1/queue')
+async def queue_status():
+    global generation_executor, engine, gc_policy, embedding_batcher, chat_input_cache, response_cache
+    return {
+        'executor': generation_executor.stats(),
+        'engine': engine.stats(),
+        'embeddings': embedding_batcher.stats(),
+        'chat_input_cache': chat_input_cache.stats(),
+        'response_cache': response_cache.stats() if response_cache is not None else None,
+        'gc': gc_policy.stats(),
+    }
+
+
+@app.get('/metrics', response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus metrics in the text exposition format."""
+    global engine
+    return PlainTextResponse(engine.metrics.render(), media_type='text/plain; version=0.0.4')
 
 
 @app.get('/v1/models', response_model=ModelList)
 async def list_models():
-    global model_args
-    model_card = ModelCard(id='gpt-3.5-turbo')
-    return ModelList(data=[model_card])
+    global engine, args
+    model_cards = [ModelCard(id=args.served_model_name)]
+    if engine.lora_manager is not None:
+        for name in engine.lora_manager.names:
+            model_cards.append(ModelCard(id=name, root=args.served_model_name, parent=args.served_model_name))
+    return ModelList(data=model_cards)
+
+
+async def resolve_adapter(model_id: str) -> Optional[str]:
+    """
+    LoRA adapter named by the request's `model` field, None for the base model.
+    Without adapters any name goes to the base model, with adapters an unknown name is a 404 as in the OpenAI API.
+    """
+    global engine, args
+    lora_manager = engine.lora_manager
+    if lora_manager is None or model_id == args.served_model_name:
+        return None
+    if model_id not in lora_manager:
+        raise HTTPException(status_code=404, detail=f'The model `{model_id}` does not exist.')
+    if not lora_manager.is_loaded(model_id):
+        # read it from disk off the event loop, the engine then finds it resident
+        await asyncio.get_running_loop().run_in_executor(None, lora_manager.load, model_id)
+    return model_id
 
 
 # To work around that unpleasant leading-\n tokenization issue!
@@ -154,15 +372,6 @@ def add_extra_stop_words(stop_words):
     return _stop_words
 
 
-def trim_stop_words(response, stop_words):
-    if stop_words:
-        for stop in stop_words:
-            idx = response.find(stop)
-            if idx != -1:
-                response = response[:idx]
-    return response
-
-
 TOOL_DESC = (
     '{name_for_model}: Call this tool to interact with the {name_for_human} API.'
     ' What is the {name_for_human} API useful for? {description_for_model} Parameters: {parameters}'
@@ -187,6 +396,52 @@ Begin!"""
 
 _TEXT_COMPLETION_CMD = object()
 
+_react_instructions: 'OrderedDict[str, str]' = OrderedDict()
+
+
+def build_react_instruction(functions) -> str:
+    """REACT instruction listing `functions`, memoized by a hash of the functions schema."""
+    global chat_input_cache
+    key = hashlib.sha256(json.dumps(functions, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+    instruction = _react_instructions.get(key)
+    if instruction is not None:
+        _react_instructions.move_to_end(key)
+        return instruction
+
+    tools_text = []
+    tools_name_text = []
+    for func_info in functions:
+        name = func_info.get('name', '')
+        name_m = func_info.get('name_for_model', name)
+        name_h = func_info.get('name_for_human', name)
+        desc = func_info.get('description', '')
+        desc_m = func_info.get('description_for_model', desc)
+        params = func_info.get('parameters', {})
+        tool = TOOL_DESC.format(
+            name_for_model=name_m,
+            name_for_human=name_h,
+            # Hint: You can add the following format requirements in description:
+            #   "Format the arguments as a JSON object."
+            #   "Enclose the code within triple backticks (`) at the beginning and end of the code."
+            description_for_model=desc_m,
+            parameters=json.dumps(params, ensure_ascii=False),
+        )
+        tools_text.append(tool)
+        tools_name_text.append(name_m)
+    tools_text = '\n\n'.join(tools_text)
+    tools_name_text = ', '.join(tools_name_text)
+    instruction = (REACT_INSTRUCTION.format(
+        tools_text=tools_text,
+        tools_name_text=tools_name_text,
+    ).lstrip('\n').rstrip())
+
+    _react_instructions[key] = instruction
+    if len(_react_instructions) > 256:
+        _react_instructions.popitem(last=False)
+    # its token ids are reused in every prompt built with these functions
+    chat_input_cache.register_segment(instruction)
+    return instruction
+
 
 def parse_messages(messages, functions):
     if all(m.role != 'user' for m in messages):
@@ -195,39 +450,15 @@ def parse_messages(messages, functions):
             detail='Invalid request: Expecting at least one user message.',
         )
 
-    messages = copy.deepcopy(messages)
+    # the loop below only mutates the ChatMessage objects it creates itself
+    messages = list(messages)
     if messages[0].role == 'system':
         system = messages.pop(0).content.lstrip('\n').rstrip()
     else:
         system = 'You are a helpful assistant.'
 
     if functions:
-        tools_text = []
-        tools_name_text = []
-        for func_info in functions:
-            name = func_info.get('name', '')
-            name_m = func_info.get('name_for_model', name)
-            name_h = func_info.get('name_for_human', name)
-            desc = func_info.get('description', '')
-            desc_m = func_info.get('description_for_model', desc)
-            params = func_info.get('parameters', {})
-            tool = TOOL_DESC.format(
-                name_for_model=name_m,
-                name_for_human=name_h,
-                # Hint: You can add the following format requirements in description:
-                #   "Format the arguments as a JSON object."
-                #   "Enclose the code within triple backticks (`) at the beginning and end of the code."
-                description_for_model=desc_m,
-                parameters=json.dumps(params, ensure_ascii=False),
-            )
-            tools_text.append(tool)
-            tools_name_text.append(name_m)
-        tools_text = '\n\n'.join(tools_text)
-        tools_name_text = ', '.join(tools_name_text)
-        instruction = (REACT_INSTRUCTION.format(
-            tools_text=tools_text,
-            tools_name_text=tools_name_text,
-        ).lstrip('\n').rstrip())
+        instruction = build_react_instruction(functions)
     else:
         instruction = ''
 
@@ -305,52 +536,110 @@ def parse_messages(messages, functions):
     return query, history, system
 
 
-def parse_response(response):
-    func_name, func_args = '', ''
-    i = response.find('\nAction:')
-    j = response.find('\nAction Input:')
-    k = response.find('\nObservation:')
-    if 0 <= i < j:  # If the text has `Action` and `Action input`,
-        if k < j:  # but does not contain `Observation`,
-            # then it is likely that `Observation` is omitted by the LLM,
-            # because the output text may have discarded the stop word.
-            response = response.rstrip() + '\nObservation:'  # Add it back.
-        k = response.find('\nObservation:')
-        func_name = response[i + len('\nAction:'):j].strip()
-        func_args = response[j + len('\nAction Input:'):k].strip()
-
-    if func_name:
-        response = response[:i]
-        t = response.find('Thought: ')
-        if t >= 0:
-            response = response[t + len('Thought: '):]
-        response = response.strip()
-        choice_data = ChatCompletionResponseChoice(
-            index=0,
-            message=ChatMessage(
-                role='assistant',
-                content=response,
-                function_call={
-                    'name': func_name,
-                    'arguments': func_args
-                },
-            ),
-            finish_reason='function_call',
-        )
-        return choice_data
+class ReActStreamParser:
+    """
+    Incremental parser of a ReAct response (`Thought:` ... `Action:` ... `Action Input:` ... or
+    `Thought:` ... `Final Answer:` ...), fed with text pieces as they are generated.
+
+    `feed` returns the deltas to send right away: the thought and the function name as soon as
+    `Action Input:` appears, then the arguments as they stream in; or everything after
+    `Final Answer:` as content. Only the new text is scanned for the field markers.
+    """
+
+    def __init__(self):
+        self.buffer = ''
+        self.scanned = 0
+        self.state = 'thought'  # -> 'function_call' | 'answer' | 'done'
+        self.arguments_started = False
+        # tail of the arguments held back: whitespace, dropped if they end there,
+        # or the start of an `Observation:` marker split across pieces
+        self.pending = ''
+
+    @property
+    def finish_reason(self) -> str:
+        return 'function_call' if self.state in ('function_call', 'done') else 'stop'
+
+    def _find(self, marker: str) -> int:
+        return self.buffer.find(marker, max(0, self.scanned - len(marker) + 1))
+
+    def feed(self, text: str) -> List[DeltaMessage]:
+        if self.state == 'answer':
+            return [DeltaMessage(content=text)] if text else []
+        if self.state == 'function_call':
+            return self._arguments(text)
+        if self.state == 'done':
+            return []
+
+        self.buffer += text
+        j = self._find('\nAction Input:')
+        z = self._find('\nFinal Answer: ')
+        self.scanned = len(self.buffer)
+        if j >= 0 and not 0 <= z < j:
+            i = self.buffer.find('\nAction:')
+            func_name = self.buffer[i + len('\nAction:'):j].strip() if 0 <= i < j else ''
+            if func_name:
+                thought = self.buffer[:i]
+                t = thought.find('Thought: ')
+                if t >= 0:
+                    thought = thought[t + len('Thought: '):]
+                self.state = 'function_call'
+                delta = DeltaMessage(content=thought.strip(), function_call={'name': func_name, 'arguments': ''})
+                return [delta] + self._arguments(self.buffer[j + len('\nAction Input:'):])
+        if z >= 0:
+            self.state = 'answer'
+            return self.feed(self.buffer[z + len('\nFinal Answer: '):])
+        return []
+
+    def _arguments(self, text: str) -> List[DeltaMessage]:
+        text = self.pending + text
+        marker = '\nObservation:'
+        k = text.find(marker)
+        if k >= 0:  # the stop word did not end generation, drop what follows
+            text = text[:k]
+            self.state = 'done'
+        if not self.arguments_started:
+            text = text.lstrip()
+            self.arguments_started = bool(text)
+        held = next((n for n in range(min(len(marker) - 1, len(text)), 0, -1) if marker.startswith(text[-n:])), 0)
+        arguments = text[:len(text) - held].rstrip()
+        self.pending = text[len(arguments):]
+        return [DeltaMessage(function_call={'arguments': arguments})] if arguments else []
+
+    def finish(self) -> List[DeltaMessage]:
+        """Deltas left once generation ended; a response without ReAct fields is sent as is."""
+        if self.state == 'thought':
+            self.state = 'answer'
+            return [DeltaMessage(content=self.buffer)] if self.buffer else []
+        if self.state == 'function_call' and self.pending.strip():
+            arguments, self.pending = self.pending.rstrip(), ''
+            return [DeltaMessage(function_call={'arguments': arguments})]
+        return []
 
-    z = response.rfind('\nFinal Answer: ')
-    if z >= 0:
-        response = response[z + len('\nFinal Answer: '):]
-    choice_data = ChatCompletionResponseChoice(
+
+def parse_response(response):
+    parser = ReActStreamParser()
+    content, function_call = '', None
+    for delta in parser.feed(response) + parser.finish():
+        content += delta.content or ''
+        if delta.function_call is None:
+            continue
+        if function_call is None:
+            function_call = dict(delta.function_call)
+        else:
+            function_call['arguments'] += delta.function_call['arguments']
+    return ChatCompletionResponseChoice(
         index=0,
-        message=ChatMessage(role='assistant', content=response),
-        finish_reason='stop',
+        message=ChatMessage(role='assistant', content=content, function_call=function_call),
+        finish_reason=parser.finish_reason,
     )
-    return choice_data
 
 
-def model_chat(model, tokenizer, query, history, gen_kwargs, system):
+def build_chat_input(tokenizer, query, history, system):
+    global chat_input_cache
+    prefill = ''
+    if query is _TEXT_COMPLETION_CMD:
+        # the last assistant turn ends with a function result and '\nThought:', continue it
+        *history, (query, prefill) = history
     messages = [
         {"role": "system", "content": system}
     ]
@@ -360,51 +649,124 @@ def model_chat(model, tokenizer, query, history, gen_kwargs, system):
         messages.append({"role": "user", "content": question})
         messages.append({"role": "assistant", "content": response})
     messages.append({"role": "user", "content": query})
-    text = tokenizer.apply_chat_template(
-        messages,
-        tokenize=False,
-        add_generation_prompt=True
-    )
-    model_inputs = tokenizer([text], return_tensors='pt').to(model.device)
-    generated_ids = model.generate(model_inputs.input_ids, **gen_kwargs)
-    generated_ids = [
-        output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
-    ]
-    response = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
-    return response
+    # only the turns not seen in an earlier request of this conversation are tokenized
+    input_ids = chat_input_cache.encode(messages)
+    if prefill:
+        input_ids = input_ids + tokenizer(prefill, add_special_tokens=False).input_ids
+    return input_ids
+
+
+def usage_info(seq) -> UsageInfo:
+    prompt_tokens, completion_tokens = len(seq.input_ids), len(seq.output_ids)
+    return UsageInfo(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens,
+    )
 
 
-def stream_model_chat(model, tokenizer, query, history, gen_kwargs, system):
-    messages = [
-        {"role": "system", "content": system}
-    ]
-    for i, (question, response) in enumerate(history):
-        question = question.lstrip('\n').rstrip()
-        response = response.lstrip('\n').rstrip()
-        messages.append({"role": "user", "content": question})
-        messages.append({"role": "assistant", "content": response})
-    messages.append({"role": "user", "content": query})
-
-    text = tokenizer.apply_chat_template(
-        messages,
-        tokenize=False,
-        add_generation_prompt=True
+def add_chat_request(
+        engine, tokenizer, query, history, gen_kwargs, system, streamer, adapter=None, deadline=None, priority=0,
+):
+    """
+    Tokenize a chat and queue it for generation into `streamer`, return its sequence handle.
+    Raises ValueError for a prompt the engine can not serve and DeadlineExceededError.
+    """
+    input_ids = build_chat_input(tokenizer, query, history, system)
+    return engine.add_request(
+        input_ids,
+        gen_kwargs,
+        streamer=streamer,
+        stopping_criteria=StoppingCriteriaList([CancelledCriteria(streamer.stopped)]),
+        adapter=adapter,
+        deadline=deadline,
+        priority=priority,
     )
-    model_inputs = tokenizer([text], return_tensors='pt').to(model.device)
-    gen_kwargs['inputs'] = model_inputs.input_ids
-
-    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
-    gen_kwargs['streamer'] = streamer
-    thread = Thread(target=model.generate, kwargs=gen_kwargs, daemon=True)
-    thread.start()
 
-    yield from streamer
 
+def model_chat(
+        engine, tokenizer, query, history, gen_kwargs, system, stop_words=None, adapter=None, deadline=None, priority=0,
+):
+    """Generate a full response, return it with its token usage and finish reason."""
+    # The streamer cuts the text at the first stop word and stops generation right there.
+    streamer = StopWordsStreamer(tokenizer, stop_words, skip_special_tokens=True)
+    seq = add_chat_request(engine, tokenizer, query, history, gen_kwargs, system, streamer,
+                           adapter=adapter, deadline=deadline, priority=priority)
+    seq.wait()
+    return streamer.text, usage_info(seq), seq.finish_reason
+
+
+async def stream_model_chat(engine, streamer, seq, usage=None, outcome=None):
+    """
+    Yield the response text pieces of a request queued by `add_chat_request`, `usage` (a UsageInfo)
+    is filled in once generation ended, and `outcome` (a dict) with its 'finish_reason'.
+    """
+    try:
+        async for new_text in streamer:
+            yield new_text
+    finally:
+        # The client went away: stop decoding at the next token,
+        # or drop the request right away if it is still queued.
+        streamer.cancel()
+        engine.abort(seq)
+        if usage is not None:
+            usage.prompt_tokens = len(seq.input_ids)
+            usage.completion_tokens = len(seq.output_ids)
+            usage.total_tokens = usage.prompt_tokens + usage.completion_tokens
+        if outcome is not None:
+            outcome['finish_reason'] = seq.finish_reason
+
+
+def model_complete(engine, tokenizer, prompts, gen_kwargs, stop_words=None, adapter=None, deadline=None, priority=0):
+    """Complete every prompt, return (text, sequence) pairs in prompt order."""
+    batch_input_ids = [tokenizer(prompt).input_ids for prompt in prompts]
+    requests = {}
+    try:
+        # shortest first, so the sequences admitted into a decode batch together have similar lengths
+        for i in sorted(range(len(prompts)), key=lambda x: len(batch_input_ids[x])):
+            streamer = StopWordsStreamer(tokenizer, stop_words, skip_special_tokens=True)
+            seq = engine.add_request(
+                batch_input_ids[i],
+                gen_kwargs,
+                streamer=streamer,
+                stopping_criteria=StoppingCriteriaList([CancelledCriteria(streamer.stopped)]),
+                adapter=adapter,
+                deadline=deadline,
+                priority=priority,
+            )
+            requests[i] = (streamer, seq)
+        results = []
+        for i in range(len(prompts)):
+            streamer, seq = requests[i]
+            seq.wait()
+            results.append((streamer.text, seq))
+    except (ValueError, DeadlineExceededError):
+        for _, seq in requests.values():
+            engine.abort(seq)
+        raise
+    return results
+
+
+def request_deadline(request, arrival_time: float) -> Optional[float]:
+    """Deadline of a request from its `timeout`, capped by --max-request-time."""
+    global args
+    timeout = request.timeout
+    if args.max_request_time:
+        timeout = min(timeout or args.max_request_time, args.max_request_time)
+    return arrival_time + timeout if timeout else None
+
+
+def deadline_exceeded(e: DeadlineExceededError) -> HTTPException:
+    global engine
+    # the server is too loaded to serve the request in time, shed it
+    return HTTPException(
+        status_code=503,
+        detail=f'Service unavailable: {e}',
+        headers={'Retry-After': str(max(1, math.ceil(engine.avg_step_time * len(engine.waiting))))},
+    )
 
-@app.post('/v1/chat/completions', response_model=ChatCompletionResponse)
-async def create_chat_completion(request: ChatCompletionRequest):
-    global model, tokenizer
 
+def build_gen_kwargs(request) -> Dict[str, Any]:
     gen_kwargs = {}
     if request.top_k is not None:
         gen_kwargs['top_k'] = request.top_k
@@ -416,7 +778,27 @@ async def create_chat_completion(request: ChatCompletionRequest):
             gen_kwargs['temperature'] = request.temperature
     if request.top_p is not None:
         gen_kwargs['top_p'] = request.top_p
-    if request.max_length is not None:
+    return gen_kwargs
+
+
+def is_deterministic(gen_kwargs: Dict[str, Any]) -> bool:
+    """Whether decoding is greedy, so the same request always gets the same answer."""
+    global engine
+    if gen_kwargs.get('top_k') == 1:
+        return True
+    return not gen_kwargs.get('do_sample', engine.model.generation_config.do_sample)
+
+
+@app.post('/v1/chat/completions', response_model=ChatCompletionResponse)
+async def create_chat_completion(request: ChatCompletionRequest, raw_request: Request):
+    global engine, tokenizer, generation_executor, gc_policy, response_cache, model_fingerprints
+
+    deadline = request_deadline(request, time.time())
+    priority = PRIORITY_CLASSES[request.priority or 'interactive']
+    gen_kwargs = build_gen_kwargs(request)
+    if request.max_tokens is not None:
+        gen_kwargs['max_new_tokens'] = request.max_tokens
+    elif request.max_length is not None:
         gen_kwargs['max_length'] = request.max_length
 
     stop_words = add_extra_stop_words(request.stop)
@@ -426,35 +808,69 @@ async def create_chat_completion(request: ChatCompletionRequest):
             stop_words.append('Observation:')
 
     query, history, system = parse_messages(request.messages, request.functions)
+    adapter = await resolve_adapter(request.model)
+
+    cache_key = None
+    if response_cache is not None and is_deterministic(gen_kwargs):
+        # a function result continues the last answer, the query is then the text completion sentinel
+        key_query = {'text_completion': True} if query is _TEXT_COMPLETION_CMD else query
+        weights = {'model': model_fingerprints[None], 'adapter': model_fingerprints.get(adapter)}
+        cache_key = ResponseCache.make_key(request.model, system, history, key_query, gen_kwargs, stop_words, weights)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            response, usage = cached
+            if request.stream:
+                return StreamingResponse(areplay(response, UsageInfo(**usage), request.model, bool(request.functions)),
+                                         media_type='text/event-stream')
+            return chat_completion_response(response, UsageInfo(**usage), request.model, bool(request.functions))
 
     if request.stream:
-        if request.functions:
-            raise HTTPException(
-                status_code=400,
-                detail='Invalid request: Function calling is not yet implemented for stream mode.',
-            )
-        generate = apredict(query,
-                            history,
+        # queued before the response starts, so a request the engine can not serve gets an error status
+        streamer = AsyncTextIteratorStreamer(tokenizer, stop_words, skip_special_tokens=True)
+        try:
+            seq = add_chat_request(engine, tokenizer, query, history, gen_kwargs, system, streamer,
+                                   adapter=adapter, deadline=deadline, priority=priority)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f'Invalid request: {e}')
+        except DeadlineExceededError as e:
+            raise deadline_exceeded(e)
+        generate = apredict(streamer,
+                            seq,
                             request.model,
-                            stop_words,
-                            gen_kwargs,
-                            system=system)
+                            raw_request=raw_request,
+                            react=bool(request.functions),
+                            cache_key=cache_key)
         return StreamingResponse(generate, media_type='text/event-stream')
 
-    response = model_chat(
-        model,
-        tokenizer,
-        query,
-        history,
-        gen_kwargs=gen_kwargs,
-        system=system
-    )
+    try:
+        response, usage, finish_reason = await generation_executor.submit(
+            model_chat,
+            engine,
+            tokenizer,
+            query,
+            history,
+            gen_kwargs=gen_kwargs,
+            system=system,
+            stop_words=stop_words,
+            adapter=adapter,
+            deadline=deadline,
+            priority=priority,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f'Invalid request: {e}')
+    except DeadlineExceededError as e:
+        raise deadline_exceeded(e)
     logger.debug(f'*** history begin ***\n{history}\n*** history end ***\n'
                  f'question: {query}\nresponse: {response}\n')
-    _gc()
+    gc_policy.request_finished()
+    # answers cut by the deadline or a cancellation are not what the request would normally get
+    if cache_key is not None and finish_reason in ('stop', 'length'):
+        response_cache.put(cache_key, response, dictify(usage))
+    return chat_completion_response(response, usage, request.model, bool(request.functions))
 
-    response = trim_stop_words(response, stop_words)
-    if request.functions:
+
+def chat_completion_response(response: str, usage: UsageInfo, model_id: str, react: bool) -> ChatCompletionResponse:
+    if react:
         choice_data = parse_response(response)
     else:
         choice_data = ChatCompletionResponseChoice(
@@ -462,9 +878,77 @@ async def create_chat_completion(request: ChatCompletionRequest):
             message=ChatMessage(role='assistant', content=response),
             finish_reason='stop',
         )
-    return ChatCompletionResponse(model=request.model,
+    return ChatCompletionResponse(model=model_id,
                                   choices=[choice_data],
-                                  object='chat.completion')
+                                  object='chat.completion',
+                                  usage=usage)
+
+
+@app.post('/v1/completions', response_model=CompletionResponse)
+async def create_completion(request: CompletionRequest):
+    global engine, tokenizer, generation_executor, gc_policy
+
+    deadline = request_deadline(request, time.time())
+    prompts = [request.prompt] if isinstance(request.prompt, str) else request.prompt
+    if not prompts:
+        raise HTTPException(status_code=400, detail='Invalid request: prompt is empty.')
+    gen_kwargs = build_gen_kwargs(request)
+    if request.max_tokens is not None:
+        gen_kwargs['max_new_tokens'] = request.max_tokens
+    adapter = await resolve_adapter(request.model)
+    try:
+        results = await generation_executor.submit(
+            model_complete,
+            engine,
+            tokenizer,
+            prompts,
+            gen_kwargs,
+            stop_words=add_extra_stop_words(request.stop),
+            adapter=adapter,
+            deadline=deadline,
+            priority=PRIORITY_CLASSES[request.priority or 'interactive'],
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f'Invalid request: {e}')
+    except DeadlineExceededError as e:
+        raise deadline_exceeded(e)
+    gc_policy.request_finished()
+
+    choices, usage = [], UsageInfo()
+    for i, (text, seq) in enumerate(results):
+        choices.append(CompletionResponseChoice(
+            index=i,
+            text=text,
+            # cut by max_tokens or by the deadline
+            finish_reason='length' if seq.finish_reason in ('length', 'timeout') else 'stop',
+        ))
+        usage.prompt_tokens += len(seq.input_ids)
+        usage.completion_tokens += len(seq.output_ids)
+    usage.total_tokens = usage.prompt_tokens + usage.completion_tokens
+    return CompletionResponse(model=request.model, choices=choices, usage=usage)
+
+
+@app.post('/v1/embeddings', response_model=EmbeddingResponse)
+async def create_embeddings(request: EmbeddingRequest):
+    global tokenizer, embedding_batcher
+
+    inputs = [request.input] if isinstance(request.input, str) else request.input
+    batch_input_ids = [
+        tokenizer(text, truncation=True, max_length=embedding_batcher.max_batched_tokens).input_ids
+        for text in inputs
+    ]
+    if not batch_input_ids or not all(batch_input_ids):
+        raise HTTPException(status_code=400, detail='Invalid request: input is empty.')
+    adapter = await resolve_adapter(request.model)
+    # concurrent requests are coalesced into length-sorted padded batches by the batcher
+    futures = [asyncio.wrap_future(embedding_batcher.submit(ids, adapter)) for ids in batch_input_ids]
+    embeddings = await asyncio.gather(*futures)
+    num_tokens = sum(len(ids) for ids in batch_input_ids)
+    return EmbeddingResponse(
+        data=[EmbeddingData(embedding=embedding.tolist(), index=i) for i, embedding in enumerate(embeddings)],
+        model=request.model,
+        usage=UsageInfo(prompt_tokens=num_tokens, total_tokens=num_tokens),
+    )
 
 
 def dictify(data: BaseModel) -> Dict[str, Any]:
@@ -481,54 +965,93 @@ def jsonify(data: BaseModel) -> str:
         return data.json(exclude_unset=True, ensure_ascii=False)
 
 
+def sse_event(data: str) -> str:
+    return f'data: {data}\n\n'
+
+
 async def apredict(
-        query: str,
-        history: List[List[str]],
+        streamer: AsyncTextIteratorStreamer,
+        seq: GenerationSequence,
         model_id: str,
-        stop_words: List[str],
-        gen_kwargs: Dict,
-        system: str,
+        raw_request: Optional[Request] = None,
+        react: bool = False,
+        cache_key: Optional[str] = None,
 ):
-    global model, tokenizer
+    global engine, gc_policy, response_cache
     choice_data = ChatCompletionResponseStreamChoice(
         index=0, delta=DeltaMessage(role='assistant'), finish_reason=None)
     chunk = ChatCompletionResponse(model=model_id,
                                    choices=[choice_data],
                                    object='chat.completion.chunk')
-    yield jsonify(chunk)
-
-    stop_words = [x for x in stop_words if x]
-    response_generator = stream_model_chat(
-        model,
-        tokenizer,
-        query,
-        history,
-        gen_kwargs,
-        system
-    )
-    for token_output in response_generator:
-        # Check if any stop word is in the token output
-        if any(stop_word in token_output for stop_word in stop_words):
-            break
+    yield sse_event(jsonify(chunk))
+
+    usage = UsageInfo()
+    outcome = {}
+    pieces = []
+    # with functions, text pieces are turned into content / function_call deltas as the fields complete
+    parser = ReActStreamParser() if react else None
+    response_generator = stream_model_chat(engine, streamer, seq, usage=usage, outcome=outcome)
+    try:
+        async for token_output in response_generator:
+            if raw_request is not None and await raw_request.is_disconnected():
+                logger.debug('Client disconnected, cancelling generation.')
+                break
+            pieces.append(token_output)
+
+            # Send the current token as part of the response
+            deltas = parser.feed(token_output) if parser else [DeltaMessage(content=token_output)]
+            for delta in deltas:
+                choice_data = ChatCompletionResponseStreamChoice(index=0, delta=delta, finish_reason=None)
+                chunk = ChatCompletionResponse(model=model_id,
+                                               choices=[choice_data],
+                                               object='chat.completion.chunk')
+                yield sse_event(jsonify(chunk))
+    finally:
+        await response_generator.aclose()
+
+    if parser is not None:
+        for delta in parser.finish():
+            choice_data = ChatCompletionResponseStreamChoice(index=0, delta=delta, finish_reason=None)
+            chunk = ChatCompletionResponse(model=model_id,
+                                           choices=[choice_data],
+                                           object='chat.completion.chunk')
+            yield sse_event(jsonify(chunk))
 
-        # Send the current token as part of the response
-        choice_data = ChatCompletionResponseStreamChoice(
-            index=0, delta=DeltaMessage(content=token_output), finish_reason=None)
+    choice_data = ChatCompletionResponseStreamChoice(index=0,
+                                                     delta=DeltaMessage(),
+                                                     finish_reason=parser.finish_reason if parser else 'stop')
+    chunk = ChatCompletionResponse(model=model_id,
+                                   choices=[choice_data],
+                                   object='chat.completion.chunk',
+                                   usage=usage)
+    yield sse_event(jsonify(chunk))
+    yield sse_event('[DONE]')
+
+    if cache_key is not None and outcome.get('finish_reason') in ('stop', 'length'):
+        response_cache.put(cache_key, ''.join(pieces), dictify(usage))
+    gc_policy.request_finished()
+
+
+async def areplay(response: str, usage: UsageInfo, model_id: str, react: bool = False):
+    """Stream a cached response as `apredict` would have, in one content (or function call) delta."""
+    parser = ReActStreamParser() if react else None
+    deltas = [DeltaMessage(role='assistant')]
+    deltas += (parser.feed(response) + parser.finish()) if parser else [DeltaMessage(content=response)]
+    for delta in deltas:
+        choice_data = ChatCompletionResponseStreamChoice(index=0, delta=delta, finish_reason=None)
         chunk = ChatCompletionResponse(model=model_id,
                                        choices=[choice_data],
                                        object='chat.completion.chunk')
-        yield jsonify(chunk)
-
+        yield sse_event(jsonify(chunk))
     choice_data = ChatCompletionResponseStreamChoice(index=0,
                                                      delta=DeltaMessage(),
-                                                     finish_reason='stop')
+                                                     finish_reason=parser.finish_reason if parser else 'stop')
     chunk = ChatCompletionResponse(model=model_id,
                                    choices=[choice_data],
-                                   object='chat.completion.chunk')
-    yield jsonify(chunk)
-    yield '[DONE]'
-
-    _gc()
+                                   object='chat.completion.chunk',
+                                   usage=usage)
+    yield sse_event(jsonify(chunk))
+    yield sse_event('[DONE]')
 
 
 def _get_args():
@@ -555,24 +1078,245 @@ def _get_args():
         help='Demo server name. Default: 127.0.0.1, which is only visible from the local computer.'
              ' If you want other computers to access your server, use 0.0.0.0 instead.',
     )
+    parser.add_argument(
+        '--quantize',
+        type=str,
+        choices=['int8', 'int4'],
+        default=None,
+        help='Weight-only quantization of the linear layers for CPU inference (with --cpu-only), default to %(default)r',
+    )
+    parser.add_argument(
+        '--quantize-group-size',
+        type=int,
+        default=128,
+        help='Input channels sharing one int4 scale and zero point, default to %(default)r',
+    )
+    parser.add_argument(
+        '--quantize-cache-dir',
+        type=str,
+        default=None,
+        help='Where quantized weights are cached after the first load, default to ~/.cache/quantized_models',
+    )
+    parser.add_argument(
+        '--warmup-lengths',
+        type=int,
+        nargs='*',
+        default=[16, 128, 512],
+        help='Prompt lengths generated for once at startup before /health reports ready,'
+             ' none to skip warmup, default to %(default)r',
+    )
+    parser.add_argument(
+        '--disable-mmap',
+        action='store_true',
+        help='Load weights with from_pretrained instead of memory-mapping the safetensors shards on CPU',
+    )
+    parser.add_argument(
+        '--server-uds',
+        type=str,
+        default=None,
+        help='Listen on this unix domain socket instead of --server-name/--server-port',
+    )
+    parser.add_argument(
+        '--num-replicas',
+        type=int,
+        default=1,
+        help='Model worker processes, one per GPU (or group of GPUs) or CPU NUMA node, behind a router'
+             ' doing least-loaded dispatch with session affinity, default to %(default)r',
+    )
+    parser.add_argument(
+        '--affinity-slack',
+        type=int,
+        default=4,
+        help='In-flight requests a replica may have over the least loaded one and still get the requests'
+             ' of its conversations, default to %(default)r',
+    )
     parser.add_argument(
         '--disable-gc',
         action='store_true',
-        help='Disable GC after each response generated.',
+        help='Disable GC after responses and in idle gaps.',
+    )
+    parser.add_argument(
+        '--gc-cuda-watermark',
+        type=float,
+        default=0.9,
+        help='Release cached CUDA memory once torch reserves this share of the GPU, default to %(default)r',
+    )
+    parser.add_argument(
+        '--gc-heap-growth',
+        type=int,
+        default=1_000_000,
+        help='Run gc.collect() once the Python heap grew by this many allocated blocks, default to %(default)r',
+    )
+    parser.add_argument(
+        '--gc-idle-seconds',
+        type=float,
+        default=5.0,
+        help='Collect after this many seconds without requests, 0 to disable, default to %(default)r',
+    )
+    parser.add_argument(
+        '--max-request-time',
+        type=float,
+        default=None,
+        help='Seconds a request may take at most, also the default of its timeout field. Queued requests'
+             ' that can no longer meet their deadline are answered with 503. Default to %(default)r',
+    )
+    parser.add_argument(
+        '--response-cache-size',
+        type=int,
+        default=0,
+        help='Answers of greedy (temperature < 0.01) chat requests kept to replay to identical requests,'
+             ' stream or not, 0 to disable. Default to %(default)r',
+    )
+    parser.add_argument(
+        '--response-cache-ttl',
+        type=float,
+        default=3600.0,
+        help='Seconds a cached answer stays valid, default to %(default)r',
+    )
+    parser.add_argument(
+        '--response-cache-path',
+        type=str,
+        default=None,
+        help='JSON lines file the response cache is persisted to and reloaded from, default to %(default)r',
+    )
+    parser.add_argument(
+        '--max-batch-size',
+        type=int,
+        default=8,
+        help='Max number of sequences decoded together in one step, default to %(default)r',
+    )
+    parser.add_argument(
+        '--max-batched-tokens',
+        type=int,
+        default=4096,
+        help='Max number of tokens (prefill + decode) fed to the model in one step, default to %(default)r',
+    )
+    parser.add_argument(
+        '--kv-cache-blocks',
+        type=int,
+        default=1024,
+        help='Number of blocks in the shared paged KV cache pool, default to %(default)r',
+    )
+    parser.add_argument(
+        '--kv-block-size',
+        type=int,
+        default=16,
+        help='Number of tokens per KV cache block, default to %(default)r',
+    )
+    parser.add_argument(
+        '--generation-workers',
+        type=int,
+        default=16,
+        help='Threads serving non-stream requests, default to %(default)r',
+    )
+    parser.add_argument(
+        '--max-queue-size',
+        type=int,
+        default=64,
+        help='Non-stream requests allowed to wait for a worker before answering 429, default to %(default)r',
+    )
+    parser.add_argument(
+        '--prefix-cache-blocks',
+        type=int,
+        default=512,
+        help='Max number of KV blocks kept for reuse across requests sharing a prompt prefix'
+             ' (system prompt, tool instructions, chat history), 0 to disable. Default to %(default)r',
+    )
+    parser.add_argument(
+        '--draft-checkpoint-path',
+        type=str,
+        default=None,
+        help='Small model sharing the tokenizer of the main model, enables speculative decoding, default to %(default)r',
+    )
+    parser.add_argument(
+        '--num-speculative-tokens',
+        type=int,
+        default=4,
+        help='Tokens proposed by the draft model per decode step, default to %(default)r',
+    )
+    parser.add_argument(
+        '--embedding-batch-size',
+        type=int,
+        default=32,
+        help='Max number of /v1/embeddings inputs embedded in one forward pass, default to %(default)r',
+    )
+    parser.add_argument(
+        '--embedding-batch-window',
+        type=float,
+        default=0.005,
+        help='Seconds to wait for more embedding inputs to batch with the first one, default to %(default)r',
+    )
+    parser.add_argument(
+        '--served-model-name',
+        type=str,
+        default='gpt-3.5-turbo',
+        help='Model id of the base model in /v1/models, default to %(default)r',
+    )
+    parser.add_argument(
+        '--lora-adapters',
+        type=str,
+        nargs='*',
+        default=[],
+        help='LoRA adapters served on top of the base model as name=path, selected by the request model field',
+    )
+    parser.add_argument(
+        '--max-loaded-adapters',
+        type=int,
+        default=4,
+        help='Max number of LoRA adapters kept in memory, loaded lazily, default to %(default)r',
     )
 
     args = parser.parse_args()
+    if args.quantize and not args.cpu_only:
+        parser.error('--quantize runs on the CPU kernels of torch, use it with --cpu-only')
     return args
 
 
 if __name__ == '__main__':
     args = _get_args()
 
-    tokenizer = AutoTokenizer.from_pretrained(
+    if args.num_replicas > 1:
+        # this process only routes, each replica is this script started with --num-replicas 1
+        # the router checks the credentials of every route but /health, as a single process does
+        middleware = []
+        if args.api_auth:
+            username, password = args.api_auth.split(':')[0], args.api_auth.split(':')[1]
+            middleware.append((BasicAuthMiddleware, {'username': username, 'password': password}))
+        serve_replicas(args, sys.argv[1:], script=__file__, middleware=middleware)
+        sys.exit(0)
+
+    server_state = {'status': 'loading', 'start_time': time.time()}
+
+    if args.cpu_only:
+        device_map = 'cpu'
+    else:
+        device_map = 'auto'
+
+    if args.quantize:
+        load_fn = partial(
+            load_quantized_model,
+            bits=8 if args.quantize == 'int8' else 4,
+            group_size=args.quantize_group_size,
+            cache_dir=args.quantize_cache_dir,
+        )
+    else:
+        load_fn = partial(load_model, device_map=device_map, mmap_weights=not args.disable_mmap)
+    # the tokenizer loads in a thread meanwhile
+    model, tokenizer = load_model_and_tokenizer(
         args.checkpoint_path,
+        tokenizer_kwargs={'trust_remote_code': True, 'resume_download': True},
+        load_fn=load_fn,
         trust_remote_code=True,
         resume_download=True,
     )
+    model.eval()
+    server_state['status'] = 'warming_up'
+    server_state['load_time'] = time.time()
+
+    chat_input_cache = ChatInputCache(tokenizer)
+    response_cache = None
+    if args.response_cache_size > 0:
+        response_cache = ResponseCache(args.response_cache_size, args.response_cache_ttl, args.response_cache_path)
 
     if args.api_auth:
         app.add_middleware(
@@ -581,22 +1325,67 @@ if __name__ == '__main__':
             password=args.api_auth.split(':')[1]
         )
 
-    if args.cpu_only:
-        device_map = 'cpu'
-    else:
-        device_map = 'auto'
-
-    model = AutoModelForCausalLM.from_pretrained(
-        args.checkpoint_path,
-        device_map=device_map,
-        trust_remote_code=True,
-        resume_download=True,
-    ).eval()
-
     model.generation_config = GenerationConfig.from_pretrained(
         args.checkpoint_path,
         trust_remote_code=True,
         resume_download=True,
     )
 
-    uvicorn.run(app, host=args.server_name, port=args.server_port, workers=1)
+    draft_model = None
+    if args.draft_checkpoint_path:
+        draft_model = AutoModelForCausalLM.from_pretrained(
+            args.draft_checkpoint_path,
+            device_map=device_map,
+            trust_remote_code=True,
+            resume_download=True,
+        ).eval()
+
+    lora_manager = None
+    if args.lora_adapters:
+        adapter_paths = dict(adapter.split('=', 1) for adapter in args.lora_adapters)
+        lora_manager = LoRAManager(model, adapter_paths, max_loaded_adapters=args.max_loaded_adapters)
+    # cached answers are keyed by the weights, a restart on another checkpoint does not replay them
+    model_fingerprints = {None: {'checkpoint': args.checkpoint_path, 'quantize': args.quantize,
+                                 'files': checkpoint_fingerprint(args.checkpoint_path)}}
+    for name, path in (lora_manager.adapter_paths if lora_manager is not None else {}).items():
+        model_fingerprints[name] = {'path': path, 'files': checkpoint_fingerprint(path)}
+
+    engine = ContinuousBatchingEngine(
+        model,
+        tokenizer,
+        max_batch_size=args.max_batch_size,
+        max_batched_tokens=args.max_batched_tokens,
+        num_kv_blocks=args.kv_cache_blocks,
+        kv_block_size=args.kv_block_size,
+        prefix_cache_blocks=args.prefix_cache_blocks,
+        draft_model=draft_model,
+        num_speculative_tokens=args.num_speculative_tokens,
+        lora_manager=lora_manager,
+    ).start()
+    generation_executor = GenerationExecutor(args.generation_workers, args.max_queue_size)
+    embedding_batcher = EmbeddingBatcher(
+        engine,
+        max_batch_size=args.embedding_batch_size,
+        max_batched_tokens=args.max_batched_tokens,
+        window=args.embedding_batch_window,
+    )
+    engine.metrics.add_gauge(
+        'llm_executor_queue_depth',
+        'Non-stream requests waiting for a generation worker.',
+        lambda: generation_executor.queue_depth,
+    )
+    gc_policy = AdaptiveGC(
+        cuda_memory_watermark=args.gc_cuda_watermark,
+        heap_growth_blocks=args.gc_heap_growth,
+        idle_seconds=args.gc_idle_seconds,
+        is_idle=lambda: not engine.waiting and not engine.running and not generation_executor.num_pending,
+        enabled=not args.disable_gc,
+    )
+    for metric in gc_policy.metrics:
+        engine.metrics.register(metric)
+    gc_policy.freeze()
+
+    if args.server_uds:
+        uvicorn.run(app, uds=args.server_uds, workers=1)
+    else:
+        uvicorn.run(app, host=args.server_name, port=args.server_port, workers=1)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+@description: Incremental tokenization of chat prompts.
+
+Multi-turn and agent clients resend the whole conversation on every call. The rendered chat
+template of a conversation is a text prefix of the rendering of any continuation of it, so the
+token ids of the conversation so far are cached and only the text of the new turns is tokenized.
+Long texts repeated across conversations (the REACT instruction of a functions list) can be
+registered as segments whose token ids are reused wherever they appear.
+"""
+import hashlib
+import json
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+
+
+class ChatInputCache:
+    """
+    LRU of (rendered text, token ids) per conversation prefix, keyed by a rolling hash of the messages.
+
+    Text is only split in front of a special token (e.g. `<|im_start|>`), which the tokenizer never
+    merges with its neighbours. The first incremental encodings are checked against a full
+    tokenization; on any mismatch (e.g. a tokenizer adding a prefix space to every call) the
+    cache switches itself off.
+    """
+
+    def __init__(self, tokenizer, max_entries: int = 4096, num_checks: int = 8):
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self.num_checks = num_checks
+        self.enabled = True
+        self.entries: 'OrderedDict[str, Tuple[str, List[int]]]' = OrderedDict()
+        self.segments: 'OrderedDict[str, List[int]]' = OrderedDict()
+        self.max_segments = 256
+        special_tokens = set(tokenizer.all_special_tokens) | set(getattr(tokenizer, 'added_tokens_encoder', {}))
+        self.boundary_tokens = tuple(sorted(token for token in special_tokens if token))
+        self.num_requests = 0
+        self.num_hits = 0
+        self.num_tokenized_chars = 0
+        self.num_total_chars = 0
+        # encode() runs in the event loop and in the generation workers
+        self._lock = Lock()
+
+    @staticmethod
+    def _keys(messages: List[Dict[str, str]]) -> List[str]:
+        """keys[n] identifies messages[:n + 1]."""
+        keys, digest = [], b''
+        for message in messages:
+            digest = hashlib.sha1(digest + json.dumps(message, sort_keys=True, ensure_ascii=False).encode()).digest()
+            keys.append(digest.hex())
+        return keys
+
+    def _render(self, messages: List[Dict[str, str]], add_generation_prompt: bool) -> str:
+        return self.tokenizer.apply_chat_template(
+            messages,
+            tokenize=False,
+            add_generation_prompt=add_generation_prompt,
+        )
+
+    def register_segment(self, text: str):
+        """Memoize the token ids of `text`, a piece reused verbatim in many prompts."""
+        if not self.enabled or text in self.segments:
+            return
+        segment_ids = self.tokenizer(text, add_special_tokens=False).input_ids
+        with self._lock:
+            self.segments[text] = segment_ids
+            while len(self.segments) > self.max_segments:
+                self.segments.popitem(last=False)
+            # make sure the next encoding, which likely splits around it, is checked
+            self.num_checks = max(self.num_checks, 1)
+
+    def _encode(self, text: str, first: bool) -> List[int]:
+        with self._lock:
+            segments = list(self.segments.items())
+        for segment, segment_ids in segments:
+            start = text.find(segment)
+            if start >= 0:
+                return (self._encode(text[:start], first) + segment_ids
+                        + self._encode(text[start + len(segment):], first=False))
+        self.num_tokenized_chars += len(text)
+        return self.tokenizer(text, add_special_tokens=first).input_ids
+
+    def _splittable(self, text: str, offset: int) -> bool:
+        return offset == len(text) or text.startswith(self.boundary_tokens, offset)
+
+    def encode(self, messages: List[Dict[str, str]]) -> List[int]:
+        """Token ids of the chat template rendering of `messages` followed by the generation prompt."""
+        self.num_requests += 1
+        text = self._render(messages, add_generation_prompt=True)
+        self.num_total_chars += len(text)
+        if not self.enabled or not self.boundary_tokens:
+            self.num_tokenized_chars += len(text)
+            return self.tokenizer(text).input_ids
+        conversation = self._render(messages, add_generation_prompt=False)
+        if not text.startswith(conversation) or not self._splittable(text, len(conversation)):
+            conversation = ''
+
+        keys = self._keys(messages)
+        prefix_text, prefix_ids = '', []
+        with self._lock:
+            for key in reversed(keys[:-1]):
+                entry = self.entries.get(key)
+                if entry is not None and conversation.startswith(entry[0]) \
+                        and self._splittable(conversation, len(entry[0])):
+                    self.entries.move_to_end(key)
+                    prefix_text, prefix_ids = entry
+                    self.num_hits += 1
+                    break
+        conversation_ids = prefix_ids + self._encode(conversation[len(prefix_text):], first=not prefix_text)
+        input_ids = conversation_ids + self._encode(text[len(conversation):], first=False)
+
+        with self._lock:
+            check = self.num_checks > 0
+            self.num_checks -= check
+        if check:
+            expected = self.tokenizer(text).input_ids
+            if input_ids != expected:
+                logger.warning('Incremental chat tokenization differs from full tokenization, disabling it')
+                with self._lock:
+                    self.enabled = False
+                    self.entries.clear()
+                    self.segments.clear()
+                return expected
+
+        if conversation:
+            with self._lock:
+                self.entries[keys[-1]] = (conversation, conversation_ids)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return input_ids
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        return {
+            'enabled': self.enabled,
+            'entries': len(self.entries),
+            'hit_rate': self.num_hits / self.num_requests if self.num_requests else 0.0,
+            # share of the prompt text that actually went through the tokenizer
+            'tokenized_ratio': self.num_tokenized_chars / self.num_total_chars if self.num_total_chars else 0.0,
+        }
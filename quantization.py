@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+@description: Weight-only int8/int4 quantization for CPU inference.
+
+The `nn.Linear` layers of the decoder are replaced by `QuantizedLinear` at load time:
+- int8: symmetric, one scale per output channel,
+- int4: asymmetric, one scale and zero point per group of `group_size` input channels.
+Matmuls run on torch's weight-only CPU kernels when available (`torch._weight_int8pack_mm`,
+`torch._weight_int4pack_mm_for_cpu`) with bfloat16 activations, the dtype those kernels are
+vectorized for (float32 activations are more than 10x slower than a dense float32 matmul);
+otherwise on dequantized float32 weights.
+
+The quantized state dict (int4 weights already in the kernel layout) is cached to disk after the
+first quantization, a restart builds the model skeleton without allocating its float weights and
+memory-maps the cache.
+"""
+import hashlib
+import json
+import os
+from typing import Iterable, Optional
+
+import torch
+from loguru import logger
+from torch import nn
+from transformers import AutoConfig, AutoModelForCausalLM
+
+from model_loader import build_empty_model, checkpoint_fingerprint
+
+QUANTIZATION_BITS = (8, 4)
+DEFAULT_CACHE_DIR = os.path.expanduser('~/.cache/quantized_models')
+
+
+def _has_int8_kernel() -> bool:
+    return hasattr(torch, '_weight_int8pack_mm')
+
+
+def _has_int4_kernel() -> bool:
+    return hasattr(torch, '_weight_int4pack_mm_for_cpu') and hasattr(torch, '_convert_weight_to_int4pack_for_cpu')
+
+
+class QuantizedLinear(nn.Module):
+    """`nn.Linear` with int8 (per-channel) or int4 (per-group) weights."""
+
+    def __init__(self, in_features: int, out_features: int, bits: int = 8, group_size: int = 128,
+                 bias: bool = True, dtype: torch.dtype = torch.float32, device=None):
+        super().__init__()
+        if bits not in QUANTIZATION_BITS:
+            raise ValueError(f'Unsupported quantization bits: {bits}, choose from {QUANTIZATION_BITS}')
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        # dtype of the layer inputs and outputs, the dtype of the replaced layer
+        self.dtype = dtype
+        if bits == 8:
+            self.group_size = in_features
+            self.register_buffer('qweight', torch.empty(out_features, in_features, dtype=torch.int8, device=device))
+            self.register_buffer('scales', torch.empty(out_features, dtype=torch.float32, device=device))
+        else:
+            if in_features % group_size:
+                raise ValueError(f'in_features={in_features} is not a multiple of group_size={group_size}')
+            self.group_size = group_size
+            # two 4 bit values per byte, the low nibble holds the even input channel
+            self.register_buffer('qweight', torch.empty(out_features, in_features // 2, dtype=torch.uint8, device=device))
+            # [groups, out, 2]: scale and zero, w = (q - 8) * scale + zero, the layout of the int4 kernel
+            self.register_buffer('scales_and_zeros', torch.empty(
+                in_features // group_size, out_features, 2, dtype=torch.float32, device=device))
+            # whether qweight holds the tiled layout of the CPU kernel (same shape) instead of plain nibbles
+            self.register_buffer('packed', torch.zeros((), dtype=torch.bool, device=device))
+        if bias:
+            self.register_buffer('bias', torch.empty(out_features, dtype=dtype, device=device))
+        else:
+            self.bias = None
+        # set by `prepare`, not part of the state dict: kernel activation dtype and scales in that dtype
+        self.compute_dtype: Optional[torch.dtype] = None
+        self._kernel_scales: Optional[torch.Tensor] = None
+
+    @property
+    def device(self) -> torch.device:
+        return self.qweight.device
+
+    @classmethod
+    def from_linear(cls, linear: nn.Linear, bits: int = 8, group_size: int = 128) -> 'QuantizedLinear':
+        weight = linear.weight.detach().float()
+        layer = cls(linear.in_features, linear.out_features, bits, group_size,
+                    bias=linear.bias is not None, dtype=linear.weight.dtype, device='cpu')
+        if bits == 8:
+            scales = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+            layer.qweight.copy_(torch.round(weight / scales[:, None]).clamp(-128, 127).to(torch.int8))
+            layer.scales.copy_(scales)
+        else:
+            groups = weight.reshape(linear.out_features, -1, layer.group_size)
+            w_min, w_max = groups.amin(dim=-1), groups.amax(dim=-1)
+            scales = (w_max - w_min).clamp(min=1e-8) / 15
+            q = torch.round((groups - w_min[..., None]) / scales[..., None]).clamp(0, 15).to(torch.uint8)
+            q = q.reshape(linear.out_features, linear.in_features)
+            layer.qweight.copy_(q[:, 0::2] | (q[:, 1::2] << 4))
+            layer.scales_and_zeros.copy_(torch.stack([scales, w_min + 8 * scales], dim=-1).transpose(0, 1))
+        if linear.bias is not None:
+            layer.bias.copy_(linear.bias.detach())
+        return layer
+
+    def _unpack_int4(self) -> torch.Tensor:
+        q = torch.stack([self.qweight & 0x0F, self.qweight >> 4], dim=-1)
+        return q.reshape(self.out_features, self.in_features)
+
+    def dequantize(self) -> torch.Tensor:
+        """Float32 weight, [out_features, in_features]."""
+        if self.bits == 8:
+            return self.qweight.float() * self.scales[:, None]
+        if self.packed:
+            raise RuntimeError('int4 weights are packed for the CPU kernel of another torch build, quantize again')
+        groups = self._unpack_int4().float().reshape(self.out_features, -1, self.group_size)
+        scales, zeros = self.scales_and_zeros.transpose(0, 1).unbind(-1)
+        return ((groups - 8) * scales[..., None] + zeros[..., None]).reshape(self.out_features, self.in_features)
+
+    def prepare(self, compute_dtype: torch.dtype = torch.bfloat16):
+        """
+        Set the layer up for the CPU kernel. int4 weights are repacked in place into the layout of
+        the kernel, which depends on the torch build.
+        """
+        if self.compute_dtype is not None or self.device.type != 'cpu':
+            return
+        if self.bits == 8 and _has_int8_kernel():
+            self._kernel_scales = self.scales.to(compute_dtype)
+        elif self.bits == 4 and _has_int4_kernel():
+            if not self.packed:
+                try:
+                    self.qweight = torch._convert_weight_to_int4pack_for_cpu(self._unpack_int4().to(torch.int32), 2)
+                except RuntimeError as e:  # shape not supported by the kernel
+                    logger.debug(f'int4 kernel unavailable for a {self.out_features}x{self.in_features} layer: {e}')
+                    return
+                self.packed.fill_(True)
+            self._kernel_scales = self.scales_and_zeros.to(compute_dtype)
+        else:
+            return
+        self.compute_dtype = compute_dtype
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        shape = x.shape
+        x_2d = x.reshape(-1, self.in_features)
+        if self.compute_dtype is None:
+            output = x_2d.float() @ self.dequantize().T
+        elif self.bits == 8:
+            output = torch._weight_int8pack_mm(x_2d.to(self.compute_dtype).contiguous(), self.qweight,
+                                               self._kernel_scales)
+        else:
+            output = torch._weight_int4pack_mm_for_cpu(x_2d.to(self.compute_dtype).contiguous(), self.qweight,
+                                                       self.group_size, self._kernel_scales)
+        if self.bias is not None:
+            output = output + self.bias.to(output.dtype)
+        return output.to(x.dtype).reshape(*shape[:-1], self.out_features)
+
+    def extra_repr(self) -> str:
+        return (f'in_features={self.in_features}, out_features={self.out_features}, bits={self.bits}, '
+                f'group_size={self.group_size}, bias={self.bias is not None}')
+
+
+def _quantizable(name: str, module: nn.Module, skip_modules: Iterable[str]) -> bool:
+    return isinstance(module, nn.Linear) and not any(name == s or name.endswith('.' + s) for s in skip_modules)
+
+
+def quantize_model(model: nn.Module, bits: int = 8, group_size: int = 128,
+                   skip_modules: Iterable[str] = ('lm_head',), empty: bool = False) -> int:
+    """
+    Replace the linear layers of `model` by `QuantizedLinear` in place, return how many were replaced.
+    :param skip_modules: module names kept in float, the output projection by default
+    :param empty: only build the quantized layers (weights loaded afterwards), for a model on the meta device
+    """
+    num_layers = 0
+    for name, module in list(model.named_modules()):
+        if not _quantizable(name, module, skip_modules):
+            continue
+        if bits == 4 and module.in_features % group_size:
+            logger.warning(f'{name}: in_features={module.in_features} is not a multiple of {group_size}, kept in float')
+            continue
+        if empty:
+            layer = QuantizedLinear(module.in_features, module.out_features, bits, group_size,
+                                    bias=module.bias is not None, dtype=module.weight.dtype, device='meta')
+        else:
+            layer = QuantizedLinear.from_linear(module, bits, group_size)
+        parent_name, _, child_name = name.rpartition('.')
+        setattr(model.get_submodule(parent_name) if parent_name else model, child_name, layer)
+        num_layers += 1
+    return num_layers
+
+
+def prepare_model(model: nn.Module, compute_dtype: torch.dtype = torch.bfloat16):
+    for module in model.modules():
+        if isinstance(module, QuantizedLinear):
+            module.prepare(compute_dtype)
+
+
+def _cache_path(checkpoint_path: str, bits: int, group_size: int, cache_dir: str) -> str:
+    key = hashlib.sha1(os.path.abspath(checkpoint_path).encode() if os.path.isdir(checkpoint_path)
+                       else checkpoint_path.encode()).hexdigest()[:16]
+    name = os.path.basename(os.path.normpath(checkpoint_path))
+    return os.path.join(cache_dir, f'{name}-{key}-int{bits}-g{group_size}.pt')
+
+
+def load_quantized_model(
+        checkpoint_path: str,
+        bits: int = 8,
+        group_size: int = 128,
+        cache_dir: Optional[str] = None,
+        skip_modules: Iterable[str] = ('lm_head',),
+        compute_dtype: torch.dtype = torch.bfloat16,
+        **kwargs,
+) -> nn.Module:
+    """
+    Load a causal LM on CPU with quantized linear layers, reusing the quantized weights cached on disk.
+    :param cache_dir: where quantized state dicts are cached, default ~/.cache/quantized_models
+    :param compute_dtype: activation dtype of the quantized matmul kernels
+    :param kwargs: passed to `from_pretrained` / `from_config` (trust_remote_code, torch_dtype, ...)
+    """
+    cache_dir = cache_dir or DEFAULT_CACHE_DIR
+    cache_file = _cache_path(checkpoint_path, bits, group_size, cache_dir)
+    # the int4 kernel layout is specific to the torch build, the checkpoint files may be replaced in place
+    meta = {'checkpoint_path': checkpoint_path, 'bits': bits, 'group_size': group_size,
+            'skip_modules': sorted(skip_modules), 'torch_version': torch.__version__,
+            'checkpoint_files': checkpoint_fingerprint(checkpoint_path, kwargs.get('revision'))}
+    meta_file = cache_file[:-len('.pt')] + '.json'
+    if os.path.exists(cache_file) and os.path.exists(meta_file):
+        with open(meta_file, 'r', encoding='utf-8') as f:
+            cached_meta = json.load(f)
+        if cached_meta == meta:
+            config_kwargs = {k: v for k, v in kwargs.items() if k in ('trust_remote_code', 'revision')}
+            config = AutoConfig.from_pretrained(checkpoint_path, **config_kwargs)
+            # no float weights are allocated
+            model = build_empty_model(config, trust_remote_code=kwargs.get('trust_remote_code', False))
+            quantize_model(model, bits, group_size, skip_modules, empty=True)
+            state_dict = torch.load(cache_file, map_location='cpu', mmap=True, weights_only=True)
+            # the cached tensors keep their dtype, whatever the skeleton was built with
+            model.load_state_dict(state_dict, assign=True)
+            model.tie_weights()
+            dtype = model.get_input_embeddings().weight.dtype
+            for module in model.modules():
+                if isinstance(module, QuantizedLinear):
+                    module.dtype = dtype
+            prepare_model(model, compute_dtype)
+            logger.info(f'Loaded int{bits} quantized model from cache {cache_file}')
+            return model
+        logger.info(f'Quantization cache {cache_file} is stale, quantizing again')
+
+    kwargs.pop('device_map', None)
+    model = AutoModelForCausalLM.from_pretrained(checkpoint_path, device_map='cpu', **kwargs)
+    num_layers = quantize_model(model, bits, group_size, skip_modules)
+    prepare_model(model, compute_dtype)
+    os.makedirs(cache_dir, exist_ok=True)
+    torch.save(model.state_dict(), cache_file + '.tmp')
+    os.replace(cache_file + '.tmp', cache_file)
+    # a hub checkpoint may only have been downloaded by from_pretrained
+    meta['checkpoint_files'] = checkpoint_fingerprint(checkpoint_path, kwargs.get('revision'))
+    with open(meta_file, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    logger.info(f'Quantized {num_layers} linear layers to int{bits}, cached to {cache_file}')
+    return model
+
+
+def model_memory_bytes(model: nn.Module) -> int:
+    """Bytes of the parameters and buffers of `model`, shared tensors counted once."""
+    seen, total = set(), 0
+    tensors = list(model.parameters()) + list(model.buffers())
+    tensors += [m._kernel_scales for m in model.modules()
+                if isinstance(m, QuantizedLinear) and m._kernel_scales is not None]
+    for tensor in tensors:
+        if tensor.device.type == 'meta' or tensor.data_ptr() in seen:
+            continue
+        seen.add(tensor.data_ptr())
+        total += tensor.numel() * tensor.element_size()
+    return total
@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+"""
+@description: Multi-replica serving for openai_api.py: N model worker processes behind one router.
+
+Each worker is a full openai_api.py server (engine, KV cache, prefix cache) listening on a unix
+socket, pinned to its own GPU(s) or to its own slice of the CPUs (one NUMA node when there are
+as many nodes as replicas). The router only parses the request JSON to pick a worker and relays
+the bytes, streaming responses included:
+- least-loaded dispatch on the number of in-flight requests per worker,
+- session affinity: requests of the same conversation (same system prompt and first user turn)
+  go to the same worker, so its prefix cache holds their history, unless that worker is more
+  than `affinity_slack` requests busier than the least loaded one.
+"""
+import asyncio
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+import torch
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from loguru import logger
+from starlette.requests import Request
+
+from serving_metrics import Counter
+
+# not forwarded, they describe a single connection
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'transfer-encoding', 'upgrade', 'host', 'content-length'}
+
+
+def _parse_cpu_list(text: str) -> List[int]:
+    """'0-3,8-11' -> [0, 1, 2, 3, 8, 9, 10, 11]"""
+    cpus = []
+    for part in text.strip().split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.extend(range(int(start), int(end) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def replica_placements(num_replicas: int, cpu_only: bool) -> List[Dict]:
+    """
+    Devices of every replica: {'env': extra environment, 'cpus': CPU affinity or None}.
+    GPUs are split evenly between replicas; on CPU, the available CPUs are ordered by NUMA node
+    and cut into equal contiguous slices.
+    """
+    if not cpu_only and torch.cuda.is_available():
+        visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+        devices = visible.split(',') if visible else [str(i) for i in range(torch.cuda.device_count())]
+        if len(devices) < num_replicas:
+            logger.warning(f'{num_replicas} replicas share {len(devices)} GPUs')
+            return [{'env': {'CUDA_VISIBLE_DEVICES': devices[i % len(devices)]}, 'cpus': None}
+                    for i in range(num_replicas)]
+        per_replica = len(devices) // num_replicas
+        return [{'env': {'CUDA_VISIBLE_DEVICES': ','.join(devices[i * per_replica:(i + 1) * per_replica])},
+                 'cpus': None} for i in range(num_replicas)]
+
+    available = os.sched_getaffinity(0)
+    cpus = []
+    for path in sorted(glob.glob('/sys/devices/system/node/node*/cpulist'),
+                       key=lambda p: int(p.split('/node')[-1].split('/')[0])):
+        with open(path) as f:
+            cpus.extend(cpu for cpu in _parse_cpu_list(f.read()) if cpu in available and cpu not in cpus)
+    cpus.extend(sorted(available - set(cpus)))
+    if len(cpus) < num_replicas:
+        logger.warning(f'{num_replicas} replicas share {len(cpus)} CPUs')
+        return [{'env': {'OMP_NUM_THREADS': '1'}, 'cpus': [cpus[i % len(cpus)]]} for i in range(num_replicas)]
+    per_replica = len(cpus) // num_replicas
+    placements = []
+    for i in range(num_replicas):
+        replica_cpus = cpus[i * per_replica:(i + 1) * per_replica]
+        placements.append({'env': {'OMP_NUM_THREADS': str(len(replica_cpus))}, 'cpus': replica_cpus})
+    return placements
+
+
+class Replica:
+    """One openai_api.py worker process serving on a unix socket."""
+
+    def __init__(self, index: int, script: str, argv: List[str], socket_path: str, placement: Dict):
+        self.index = index
+        self.socket_path = socket_path
+        self.placement = placement
+        self.in_flight = 0
+        self.num_requests = 0
+        self.ready = False
+        self.exited = False
+        env = dict(os.environ, **placement['env'])
+        cpus = placement['cpus']
+        self.process = subprocess.Popen(
+            [sys.executable, script, *argv, '--num-replicas', '1', '--server-uds', socket_path],
+            env=env,
+            preexec_fn=(lambda: os.sched_setaffinity(0, cpus)) if cpus else None,
+        )
+        self.client = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(uds=socket_path),
+            base_url='http://replica',
+            timeout=httpx.Timeout(None),
+        )
+        logger.info(f'Started replica {index} (pid {self.process.pid}) on {socket_path}: {placement}')
+
+    @property
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    @property
+    def available(self) -> bool:
+        return self.ready and self.alive
+
+    async def probe(self) -> bool:
+        try:
+            response = await self.client.get('/health', timeout=5)
+        except (httpx.TransportError, OSError):
+            return False
+        # 503 while the replica warms up
+        return response.status_code == 200
+
+    def stats(self) -> Dict:
+        return {
+            'replica': self.index,
+            'pid': self.process.pid,
+            'alive': self.alive,
+            'ready': self.ready,
+            'in_flight': self.in_flight,
+            'num_requests': self.num_requests,
+            'placement': self.placement,
+        }
+
+    def terminate(self, timeout: float = 30):
+        if self.alive:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def session_key(path: str, body: Dict) -> Optional[str]:
+    """Identify the conversation of a request by what stays the same across its turns."""
+    if not isinstance(body, dict):
+        return None
+    if path.endswith('/chat/completions'):
+        messages = body.get('messages') or []
+        first_user = next((i for i, m in enumerate(messages) if isinstance(m, dict) and m.get('role') == 'user'), None)
+        if first_user is None:
+            return None
+        stable = [body.get('model'), body.get('functions'), messages[:first_user + 1]]
+    elif path.endswith('/completions'):
+        prompt = body.get('prompt')
+        if isinstance(prompt, list):
+            prompt = prompt[0] if prompt else None
+        if not isinstance(prompt, str):
+            return None
+        # requests sharing the beginning of a prompt share its prefix cache blocks
+        stable = [body.get('model'), prompt[:512]]
+    else:
+        return None
+    return hashlib.sha1(json.dumps(stable, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+class ReplicaRouter:
+    def __init__(self, replicas: List[Replica], max_sessions: int = 65536, affinity_slack: int = 4):
+        """
+        :param max_sessions: conversations whose worker is remembered, least recently used are forgotten
+        :param affinity_slack: extra in-flight requests a worker may have over the least loaded one
+            and still receive the requests of its conversations
+        """
+        self.replicas = replicas
+        self.max_sessions = max_sessions
+        self.affinity_slack = affinity_slack
+        self.sessions: 'OrderedDict[str, Replica]' = OrderedDict()
+        self.dispatched = Counter('llm_router_requests_total', 'Requests dispatched, by replica.', 'replica')
+        self.affinity_hits = Counter('llm_router_affinity_hits_total',
+                                     'Requests sent to the replica that served their conversation before.')
+
+    def pick(self, key: Optional[str]) -> Replica:
+        available = [replica for replica in self.replicas if replica.available]
+        if not available:
+            raise HTTPException(status_code=503, detail='Service unavailable: no model replica is ready.',
+                                headers={'Retry-After': '5'})
+        # ties go to the replica that served fewer requests so far
+        least_loaded = min(available, key=lambda replica: (replica.in_flight, replica.num_requests))
+        if key is None:
+            return least_loaded
+        replica = self.sessions.get(key)
+        if replica is not None and replica.available \
+                and replica.in_flight <= least_loaded.in_flight + self.affinity_slack:
+            self.sessions.move_to_end(key)
+            self.affinity_hits.inc()
+            return replica
+        self.sessions[key] = least_loaded
+        self.sessions.move_to_end(key)
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+        return least_loaded
+
+    async def forward(self, request: Request) -> StreamingResponse:
+        body = await request.body()
+        key = None
+        if request.method == 'POST' and body:
+            try:
+                key = session_key(request.url.path, json.loads(body))
+            except ValueError:
+                pass
+        replica = self.pick(key)
+        headers = [(k, v) for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS]
+        upstream_request = replica.client.build_request(
+            request.method, request.url.path, params=request.query_params, headers=headers, content=body)
+        replica.in_flight += 1
+        replica.num_requests += 1
+        self.dispatched.inc(label=str(replica.index))
+        try:
+            upstream = await replica.client.send(upstream_request, stream=True)
+        except httpx.TransportError as e:
+            replica.in_flight -= 1
+            raise HTTPException(status_code=502, detail=f'Replica {replica.index} failed: {e}')
+
+        async def relay():
+            # closing the upstream response when the client goes away cancels generation on the worker
+            try:
+                async for chunk in upstream.aiter_raw():
+                    yield chunk
+            finally:
+                await upstream.aclose()
+                replica.in_flight -= 1
+
+        response_headers = {k: v for k, v in upstream.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+        return StreamingResponse(relay(), status_code=upstream.status_code, headers=response_headers)
+
+    async def gather(self, path: str, headers: Optional[Dict[str, str]] = None) -> List[Optional[httpx.Response]]:
+        async def get(replica):
+            if not replica.available:
+                return None
+            try:
+                return await replica.client.get(path, headers=headers, timeout=10)
+            except httpx.TransportError:
+                return None
+
+        return await asyncio.gather(*(get(replica) for replica in self.replicas))
+
+    async def wait_ready(self, interval: float = 1.0):
+        """Mark replicas ready once they answer, and report the ones that died."""
+        while True:
+            for replica in self.replicas:
+                if not replica.alive:
+                    if not replica.exited:
+                        logger.error(f'Replica {replica.index} exited with code {replica.process.returncode}, '
+                                     f'requests go to the other replicas')
+                        replica.exited = True
+                    replica.ready = False
+                elif not replica.ready and await replica.probe():
+                    replica.ready = True
+                    logger.info(f'Replica {replica.index} is ready')
+            await asyncio.sleep(interval)
+
+    def stats(self) -> Dict:
+        return {
+            'sessions': len(self.sessions),
+            'affinity_hits': self.affinity_hits.values.get(None, 0),
+            'dispatched': dict(self.dispatched.values),
+        }
+
+
+def merge_metrics(texts: List[Optional[str]]) -> str:
+    """Merge the Prometheus exposition of every replica, adding a `replica` label to each sample."""
+    families: 'OrderedDict[str, List[List[str]]]' = OrderedDict()  # name -> [header lines, samples]
+    for index, text in enumerate(texts):
+        if text is None:
+            continue
+        name = None
+        for line in text.splitlines():
+            if line.startswith('# HELP ') or line.startswith('# TYPE '):
+                name = line.split()[2]
+                header, _ = families.setdefault(name, [[], []])
+                if not any(h.startswith(line[:7]) for h in header):
+                    header.append(line)
+            elif line and not line.startswith('#'):
+                metric, _, labels_and_value = line.partition('{')
+                if labels_and_value:
+                    line = f'{metric}{{replica="{index}",{labels_and_value}'
+                else:
+                    metric, _, value = line.partition(' ')
+                    line = f'{metric}{{replica="{index}"}} {value}'
+                families.setdefault(name or metric, [[], []])[1].append(line)
+    lines = []
+    for header, samples in families.values():
+        lines.extend(header)
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+def _auth_headers(request: Request) -> Dict[str, str]:
+    # the replicas check the same credentials as the router
+    authorization = request.headers.get('authorization')
+    return {'Authorization': authorization} if authorization else {}
+
+
+def serve_replicas(args, argv: List[str], script: str, middleware: Optional[List[Tuple[type, Dict]]] = None):
+    """
+    Start `args.num_replicas` workers of `script` with the command line `argv` and route requests to them.
+    :param middleware: (class, kwargs) added to the router app, e.g. the authentication of the workers
+    """
+    socket_dir = tempfile.mkdtemp(prefix='openai-api-')
+    placements = replica_placements(args.num_replicas, args.cpu_only)
+    replicas = [
+        Replica(i, script, argv, os.path.join(socket_dir, f'replica-{i}.sock'), placement)
+        for i, placement in enumerate(placements)
+    ]
+    router = ReplicaRouter(replicas, affinity_slack=args.affinity_slack)
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        ready_task = asyncio.create_task(router.wait_ready())
+        yield
+        ready_task.cancel()
+        for replica in replicas:
+            await replica.client.aclose()
+            replica.terminate()
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+    app = FastAPI(lifespan=lifespan)
+    for middleware_class, kwargs in middleware or []:
+        app.add_middleware(middleware_class, **kwargs)
+
+    @app.get('/health')
+    async def health():
+        """200 as soon as one replica is ready to serve."""
+        ready = sum(replica.available for replica in replicas)
+        return JSONResponse({'status': 'ready' if ready else 'warming_up', 'ready_replicas': ready,
+                             'replicas': len(replicas)}, status_code=200 if ready else 503)
+
+    @app.get('/v1/queue')
+    async def queue_status(request: Request):
+        responses = await router.gather('/v1/queue', headers=_auth_headers(request))
+        return JSONResponse({
+            'router': router.stats(),
+            'replicas': [
+                dict(replica.stats(), queue=response.json() if response is not None and response.is_success else None)
+                for replica, response in zip(replicas, responses)
+            ],
+        })
+
+    @app.get('/metrics', response_class=PlainTextResponse)
+    async def metrics(request: Request):
+        responses = await router.gather('/metrics', headers=_auth_headers(request))
+        texts = [response.text if response is not None and response.is_success else None for response in responses]
+        router_metrics = []
+        for metric in (router.dispatched, router.affinity_hits):
+            router_metrics.extend(metric.render())
+        return '\n'.join(router_metrics) + '\n' + merge_metrics(texts)
+
+    @app.api_route('/{path:path}', methods=['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS', 'HEAD', 'PATCH'])
+    async def proxy(request: Request):
+        return await router.forward(request)
+
+    try:
+        uvicorn.run(app, host=args.server_name, port=args.server_port, workers=1)
+    finally:
+        for replica in replicas:
+            replica.terminate()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+@description: Cache of the answers to deterministic (greedy) chat requests.
+
+Greedy decoding gives the same answer to the same request, so dashboards polling with identical
+requests can be answered from memory. Entries are keyed by the normalized request (model, system
+prompt, history, query, generation arguments, stop words) and the weights answering it, evicted
+least recently used first and after a TTL, and optionally persisted to a JSON lines file that is
+replayed on startup.
+"""
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from loguru import logger
+
+
+class ResponseCache:
+    """LRU of (response text, usage) with a TTL, optionally persisted to `persist_path`."""
+
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = 3600.0, persist_path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.persist_path = persist_path
+        # key -> (created time, text, usage)
+        self.entries: 'OrderedDict[str, Tuple[float, str, Dict[str, int]]]' = OrderedDict()
+        self.num_requests = 0
+        self.num_hits = 0
+        self._num_persisted = 0
+        self._lock = Lock()
+        if persist_path:
+            os.makedirs(os.path.dirname(os.path.abspath(persist_path)), exist_ok=True)
+            if os.path.exists(persist_path):
+                self._load()
+
+    @staticmethod
+    def make_key(
+            model: str,
+            system: str,
+            history: List[List[str]],
+            query: Union[str, Dict[str, Any]],
+            gen_kwargs: Dict[str, Any],
+            stop_words: Optional[List[str]] = None,
+            weights: Optional[Dict[str, Any]] = None,
+    ) -> str:
+        """
+        :param weights: identity of the checkpoint (and adapter) answering, so that the persisted answers
+            of other weights served under the same model name never match
+        """
+        request = [model, system, history, query, gen_kwargs, sorted(stop_words or []), weights]
+        return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+    def _expired(self, created: float, now: float) -> bool:
+        return self.ttl is not None and now - created > self.ttl
+
+    def get(self, key: str) -> Optional[Tuple[str, Dict[str, int]]]:
+        """(text, usage) of a cached response, None on a miss."""
+        with self._lock:
+            self.num_requests += 1
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if self._expired(entry[0], time.time()):
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            self.num_hits += 1
+            return entry[1], dict(entry[2])
+
+    def put(self, key: str, text: str, usage: Dict[str, int]):
+        entry = (time.time(), text, dict(usage))
+        with self._lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            if self.persist_path:
+                self._append(key, entry)
+
+    def _append(self, key: str, entry: Tuple[float, str, Dict[str, int]]):
+        # the log is rewritten with the live entries once it holds twice as many lines
+        if self._num_persisted >= 2 * self.max_entries:
+            self._compact()
+            return
+        with open(self.persist_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'key': key, 'created': entry[0], 'text': entry[1], 'usage': entry[2]},
+                               ensure_ascii=False) + '\n')
+        self._num_persisted += 1
+
+    def _compact(self):
+        tmp_path = self.persist_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for key, (created, text, usage) in self.entries.items():
+                f.write(json.dumps({'key': key, 'created': created, 'text': text, 'usage': usage},
+                                   ensure_ascii=False) + '\n')
+        os.replace(tmp_path, self.persist_path)
+        self._num_persisted = len(self.entries)
+
+    def _load(self):
+        now = time.time()
+        with open(self.persist_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:  # torn last line of a crashed process
+                    continue
+                self._num_persisted += 1
+                if not self._expired(record['created'], now):
+                    self.entries[record['key']] = (record['created'], record['text'], record['usage'])
+                    self.entries.move_to_end(record['key'])
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        logger.info(f'Loaded {len(self.entries)} cached responses from {self.persist_path}')
+
+    def close(self):
+        if self.persist_path:
+            with self._lock:
+                self._compact()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'entries': len(self.entries),
+            'hit_rate': self.num_hits / self.num_requests if self.num_requests else 0.0,
+        }
@@ -0,0 +1,940 @@
+# -*- coding: utf-8 -*-
+"""
+@description: Continuous batching (iteration-level scheduling) engine for the API servers.
+
+Requests are admitted into the running decode batch at every step and evicted as soon as
+they finish, so concurrent clients share the forward passes instead of queueing on
+`model.generate`.
+"""
+import asyncio
+import copy
+import itertools
+import queue
+import time
+from collections import deque
+from concurrent.futures import Future
+from threading import Condition, Event, Lock, Thread
+from typing import Dict, List, Optional
+
+import torch
+import torch.nn.functional as F
+from loguru import logger
+from transformers import (
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+from transformers.generation.streamers import BaseStreamer
+
+from kv_cache import PagedKVCache, PrefixCache, from_legacy_cache, to_legacy_cache
+from serving_metrics import EngineMetrics
+from speculative_decoding import DraftModelProposer, verify_draft
+
+# scheduling classes of `add_request(priority=...)`, lower values are admitted first
+PRIORITY_CLASSES = {'interactive': 0, 'batch': 1}
+
+
+class DeadlineExceededError(TimeoutError):
+    """The request can not get its first token before its deadline and was dropped."""
+
+
+class StopWordMatcher:
+    """
+    Aho-Corasick automaton over stop words, fed with text incrementally.
+
+    `feed` returns the text that can no longer be part of a stop word and holds back only the
+    minimal ambiguous suffix (the longest suffix that is a prefix of some stop word). Once a stop
+    word completes, the text before it is released and everything after is dropped.
+    """
+
+    def __init__(self, stop_words: List[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail = [0]
+        self.depth = [0]
+        self.match_len = [0]  # length of the longest stop word ending in this state
+        for word in stop_words:
+            if word:
+                self._add_word(word)
+        self._build_fail_links()
+        self.state = 0
+        self.held = ''
+        self.stopped = False
+
+    def _add_word(self, word: str):
+        state = 0
+        for ch in word:
+            if ch not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.depth.append(self.depth[state] + 1)
+                self.match_len.append(0)
+                self.goto[state][ch] = len(self.goto) - 1
+            state = self.goto[state][ch]
+        self.match_len[state] = len(word)
+
+    def _build_fail_links(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, child in self.goto[state].items():
+                queue.append(child)
+                fail = self.fail[state]
+                while fail and ch not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(ch, 0)
+                self.match_len[child] = max(self.match_len[child], self.match_len[self.fail[child]])
+
+    def feed(self, text: str) -> str:
+        """Consume `text`, return the part that is safe to emit."""
+        if self.stopped:
+            return ''
+        buffer = self.held + text
+        offset = len(self.held)
+        state = self.state
+        for i, ch in enumerate(text):
+            while state and ch not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(ch, 0)
+            if self.match_len[state]:
+                self.stopped = True
+                self.held = ''
+                return buffer[:offset + i + 1 - self.match_len[state]]
+        self.state = state
+        split = len(buffer) - self.depth[state]
+        self.held = buffer[split:]
+        return buffer[:split]
+
+    def flush(self) -> str:
+        """Release the held back suffix, once no more text will come."""
+        held, self.held = self.held, ''
+        return held
+
+
+class StopWordsStreamer(BaseStreamer):
+    """
+    Streamer that incrementally detokenizes generated tokens and cuts the text at stop words.
+
+    Text is decoded with a sliding window over the token ids, so each step costs O(1) decodes,
+    and passed through a `StopWordMatcher`. When a stop word completes, `stopped` is set;
+    pair it with `CancelledCriteria(streamer.stopped)` to end generation at that very token.
+    The collected text is in `text`; subclasses forward pieces elsewhere via `on_text`.
+    """
+
+    def __init__(self, tokenizer, stop_words: Optional[List[str]] = None, **decode_kwargs):
+        self.tokenizer = tokenizer
+        self.decode_kwargs = decode_kwargs
+        self.matcher = StopWordMatcher(stop_words) if stop_words else None
+        self.token_ids: List[int] = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self.pieces: List[str] = []
+        self.stopped = Event()
+
+    @property
+    def text(self) -> str:
+        return ''.join(self.pieces)
+
+    def _decode(self, token_ids: List[int]) -> str:
+        return self.tokenizer.decode(token_ids, **self.decode_kwargs)
+
+    def _decode_new_text(self, final: bool = False) -> str:
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        # an unfinished multi-byte character decodes to U+FFFD, wait for the next token
+        if len(new_text) > len(prefix_text) and (final or not new_text.endswith('\ufffd')):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.token_ids)
+            return new_text[len(prefix_text):]
+        return ''
+
+    def _emit(self, text: str):
+        if self.matcher is not None:
+            text = self.matcher.feed(text)
+            if self.matcher.stopped:
+                self.stopped.set()
+        if text:
+            self.pieces.append(text)
+            self.on_text(text)
+
+    def put(self, value):
+        if self.matcher is not None and self.matcher.stopped:
+            return
+        self.token_ids.extend(value.reshape(-1).tolist())
+        self._emit(self._decode_new_text())
+
+    def end(self):
+        if self.matcher is None or not self.matcher.stopped:
+            self._emit(self._decode_new_text(final=True))
+            if self.matcher is not None and self.matcher.held:
+                text = self.matcher.flush()
+                self.pieces.append(text)
+                self.on_text(text)
+        self.on_end()
+
+    def cancel(self):
+        """Ask the producer to stop, see `CancelledCriteria`."""
+        self.stopped.set()
+
+    def on_text(self, text: str):
+        pass
+
+    def on_end(self):
+        pass
+
+
+class AsyncTextIteratorStreamer(StopWordsStreamer):
+    """
+    Streamer whose text pieces are consumed with `async for` on the event loop.
+
+    The engine thread hands every piece to the loop with `call_soon_threadsafe`, so the
+    consumer awaits an `asyncio.Queue` instead of blocking the loop on `queue.get`.
+    Must be created on the event loop that consumes it.
+    """
+
+    def __init__(self, tokenizer, stop_words: Optional[List[str]] = None, **decode_kwargs):
+        super().__init__(tokenizer, stop_words, **decode_kwargs)
+        self.loop = asyncio.get_running_loop()
+        self.text_queue = asyncio.Queue()
+        self.stop_signal = None
+
+    def _put_threadsafe(self, value):
+        try:
+            self.loop.call_soon_threadsafe(self.text_queue.put_nowait, value)
+        except RuntimeError:  # event loop already closed, nobody is listening
+            self.stopped.set()
+
+    def on_text(self, text: str):
+        self._put_threadsafe(text)
+
+    def on_end(self):
+        self._put_threadsafe(self.stop_signal)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        value = await self.text_queue.get()
+        if value is self.stop_signal:
+            raise StopAsyncIteration()
+        return value
+
+
+class CancelledCriteria(StoppingCriteria):
+    """Stop generation once `event` is set, e.g. when the client went away or a stop word hit."""
+
+    def __init__(self, event: Event):
+        self.event = event
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        return self.event.is_set()
+
+
+class GenerationSequence:
+    """State of one request inside the engine."""
+
+    def __init__(
+            self,
+            request_id: int,
+            input_ids: List[int],
+            generation_config,
+            max_new_tokens: int,
+            eos_token_ids: List[int],
+            streamer=None,
+            stopping_criteria: Optional[StoppingCriteriaList] = None,
+            adapter: Optional[str] = None,
+            deadline: Optional[float] = None,
+            priority: int = 0,
+    ):
+        self.request_id = request_id
+        self.input_ids = list(input_ids)
+        self.output_ids: List[int] = []
+        self.generation_config = generation_config
+        self.max_new_tokens = max_new_tokens
+        self.eos_token_ids = set(eos_token_ids)
+        self.streamer = streamer
+        self.stopping_criteria = stopping_criteria or StoppingCriteriaList()
+        self.logits_processor = _build_logits_processor(generation_config)
+        self.adapter = adapter
+        self.deadline = deadline
+        self.priority = priority
+        self.finish_reason: Optional[str] = None
+        self.error: Optional[BaseException] = None
+        self.aborted = False
+        self.arrival_time = time.time()
+        self.scheduled_time: Optional[float] = None
+        self.first_token_time: Optional[float] = None
+        self.last_token_time: Optional[float] = None
+        self.finish_time: Optional[float] = None
+        self.num_draft_tokens = 0
+        self.num_accepted_tokens = 0
+        self._done = Event()
+
+    @property
+    def num_tokens(self) -> int:
+        return len(self.input_ids) + len(self.output_ids)
+
+    @property
+    def last_token_id(self) -> int:
+        return self.output_ids[-1] if self.output_ids else self.input_ids[-1]
+
+    @property
+    def finished(self) -> bool:
+        return self.finish_reason is not None
+
+    @property
+    def acceptance_rate(self) -> Optional[float]:
+        """Share of speculative draft tokens the target model accepted, None without speculation."""
+        return self.num_accepted_tokens / self.num_draft_tokens if self.num_draft_tokens else None
+
+    @property
+    def queue_time(self) -> float:
+        """Seconds spent waiting for a batch slot before prefill started."""
+        scheduled_time = self.scheduled_time or self.finish_time or time.time()
+        return scheduled_time - self.arrival_time
+
+    def wait(self, timeout: Optional[float] = None) -> List[int]:
+        """Block until the sequence finished, return generated token ids."""
+        self._done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.output_ids
+
+
+def _build_logits_processor(generation_config) -> LogitsProcessorList:
+    processors = LogitsProcessorList()
+    repetition_penalty = getattr(generation_config, 'repetition_penalty', None)
+    if repetition_penalty is not None and repetition_penalty != 1.0:
+        processors.append(RepetitionPenaltyLogitsProcessor(penalty=repetition_penalty))
+    if _is_greedy(generation_config):
+        return processors
+    temperature = generation_config.temperature
+    if temperature is not None and temperature != 1.0:
+        processors.append(TemperatureLogitsWarper(temperature))
+    if generation_config.top_k:
+        processors.append(TopKLogitsWarper(top_k=generation_config.top_k))
+    if generation_config.top_p is not None and generation_config.top_p < 1.0:
+        processors.append(TopPLogitsWarper(top_p=generation_config.top_p))
+    return processors
+
+
+def _is_greedy(generation_config) -> bool:
+    return not generation_config.do_sample or generation_config.top_k == 1
+
+
+class ContinuousBatchingEngine:
+    """
+    Iteration-level scheduler around a HF causal LM.
+
+    Every step admits waiting requests (bounded by `max_batch_size` running sequences,
+    `max_batched_tokens` tokens fed to the model in that step and the free KV blocks), prefills
+    them, runs a single batched decode step for all running sequences and evicts the finished
+    ones. When the KV pool runs dry mid-decode, the latest admitted sequence is preempted:
+    its blocks are freed and it is re-queued to be recomputed later.
+
+    With `prefix_cache_blocks > 0`, the full KV blocks of finished sequences are kept in a
+    prefix trie and prefill starts after the longest cached prefix of the prompt.
+
+    With a `draft_model`, every decode step is speculative: the draft proposes
+    `num_speculative_tokens` tokens per sequence, the target scores them in one batched forward
+    pass and keeps the accepted prefix (identical output to plain decoding when greedy).
+
+    With a `lora_manager`, every request may name a LoRA adapter; rows of different adapters
+    are decoded in the same batch and the prefix cache is kept per adapter.
+
+    Waiting requests are admitted by priority class, then in arrival order. A request with a
+    deadline is finished with reason 'timeout' once it passes; a queued one is dropped (with a
+    `DeadlineExceededError`) as soon as it could not be prefilled in time anymore.
+    """
+
+    def __init__(
+            self,
+            model,
+            tokenizer,
+            max_batch_size: int = 8,
+            max_batched_tokens: int = 4096,
+            num_kv_blocks: int = 1024,
+            kv_block_size: int = 16,
+            prefix_cache_blocks: int = 0,
+            draft_model=None,
+            num_speculative_tokens: int = 4,
+            lora_manager=None,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_batched_tokens = max_batched_tokens
+        self.kv_cache = PagedKVCache(num_blocks=num_kv_blocks, block_size=kv_block_size)
+        self.prefix_cache = PrefixCache(self.kv_cache, prefix_cache_blocks) if prefix_cache_blocks > 0 else None
+        self.proposer = DraftModelProposer(draft_model, num_speculative_tokens) if draft_model is not None else None
+        # tokens every running sequence may add to the KV cache in one decode step
+        self.num_decode_tokens = num_speculative_tokens + 1 if self.proposer is not None else 1
+        self.num_draft_tokens = 0
+        self.num_accepted_tokens = 0
+        self.num_shed = 0
+        # moving average of the duration of an engine step, the earliest a queued request can get a token
+        self.avg_step_time = 0.0
+        self.lora_manager = lora_manager
+        self.metrics = EngineMetrics(max_batch_size)
+        self.metrics.add_gauge('llm_num_requests_waiting', 'Requests queued for a batch slot.', lambda: len(self.waiting))
+        self.metrics.add_gauge('llm_num_requests_running', 'Requests in the decode batch.', lambda: len(self.running))
+        self.metrics.add_gauge(
+            'llm_kv_cache_used_bytes', 'Memory of the KV cache blocks in use.',
+            lambda: (self.kv_cache.num_blocks - len(self.kv_cache.free_blocks)) * self.kv_cache.block_bytes,
+        )
+        self.waiting: List[GenerationSequence] = []
+        self.running: List[GenerationSequence] = []
+        self._counter = itertools.count()
+        self._cond = Condition()
+        # held around every forward pass, embedding batches run between decode steps
+        self._model_lock = Lock()
+        self._thread: Optional[Thread] = None
+        self._shutdown = False
+
+    @property
+    def device(self):
+        return self.model.device
+
+    def stats(self) -> Dict:
+        """Scheduler and KV cache block utilization snapshot."""
+        return {
+            'num_waiting': len(self.waiting),
+            'num_running': len(self.running),
+            'kv_cache': self.kv_cache.stats(),
+            'prefix_cache': self.prefix_cache.stats() if self.prefix_cache is not None else None,
+            'speculative': {
+                'num_speculative_tokens': self.proposer.num_speculative_tokens,
+                'num_draft_tokens': self.num_draft_tokens,
+                'num_accepted_tokens': self.num_accepted_tokens,
+                'acceptance_rate': self.num_accepted_tokens / self.num_draft_tokens if self.num_draft_tokens else 0.0,
+            } if self.proposer is not None else None,
+            'lora': self.lora_manager.stats() if self.lora_manager is not None else None,
+            'num_shed': self.num_shed,
+            'avg_step_time': self.avg_step_time,
+        }
+
+    def start(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._loop, name='batching-engine', daemon=True)
+            self._thread.start()
+        return self
+
+    def shutdown(self):
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def add_request(
+            self,
+            input_ids: List[int],
+            gen_kwargs: Optional[Dict] = None,
+            streamer=None,
+            stopping_criteria: Optional[StoppingCriteriaList] = None,
+            adapter: Optional[str] = None,
+            deadline: Optional[float] = None,
+            priority: int = 0,
+    ) -> GenerationSequence:
+        """
+        Queue a tokenized prompt for generation, return its sequence handle.
+        :param adapter: name of the LoRA adapter to generate with, None for the base model
+        :param deadline: `time.time()` by which generation must end, None for no limit
+        :param priority: scheduling class, see `PRIORITY_CLASSES`
+        """
+        if deadline is not None and not self.can_meet(deadline):
+            self.num_shed += 1
+            raise DeadlineExceededError('The request deadline can not be met')
+        generation_config = copy.deepcopy(self.model.generation_config)
+        gen_kwargs = dict(gen_kwargs or {})
+        max_length = gen_kwargs.pop('max_length', None)
+        generation_config.update(**gen_kwargs)
+        if max_length is not None:
+            max_new_tokens = max_length - len(input_ids)
+        elif generation_config.max_new_tokens is not None:
+            max_new_tokens = generation_config.max_new_tokens
+        else:
+            max_new_tokens = generation_config.max_length - len(input_ids)
+        if self.kv_cache.num_blocks_for(len(input_ids) + self.num_decode_tokens) > self.kv_cache.num_blocks:
+            raise ValueError(
+                f'Prompt of {len(input_ids)} tokens does not fit into the KV cache '
+                f'({self.kv_cache.num_blocks} blocks of {self.kv_cache.block_size} tokens)'
+            )
+        # a sequence must fit into the pool on its own up to its last token, or once preempted it is never resumed
+        capacity = self.kv_cache.num_blocks * self.kv_cache.block_size
+        max_new_tokens = min(max_new_tokens, capacity - len(input_ids) - self.num_decode_tokens + 1)
+        if adapter is not None:
+            if self.lora_manager is None or adapter not in self.lora_manager:
+                raise ValueError(f'Unknown LoRA adapter: {adapter}')
+            # loads the adapter from disk on first use, pinned until the request finishes
+            self.lora_manager.acquire(adapter)
+        seq = GenerationSequence(
+            request_id=next(self._counter),
+            input_ids=input_ids,
+            generation_config=generation_config,
+            max_new_tokens=max(max_new_tokens, 1),
+            eos_token_ids=self._eos_token_ids(generation_config),
+            streamer=streamer,
+            stopping_criteria=stopping_criteria,
+            adapter=adapter,
+            deadline=deadline,
+            priority=priority,
+        )
+        with self._cond:
+            self.waiting.append(seq)
+            self._cond.notify()
+        return seq
+
+    def abort(self, seq: GenerationSequence):
+        """Stop generating for `seq`, its slot is freed at the next step."""
+        with self._cond:
+            seq.aborted = True
+            self._cond.notify()
+
+    def can_meet(self, deadline: float) -> bool:
+        """Whether a request queued now could still get a token before `deadline`."""
+        return deadline > time.time() + self.avg_step_time
+
+    def _shed_expired(self):
+        """Finish running requests past their deadline and drop queued ones that can not make it anymore."""
+        now = time.time()
+        for seq in self.running:
+            if seq.deadline is not None and now >= seq.deadline and not seq.finished:
+                self._finish(seq, 'timeout')
+        for seq in self.waiting:
+            if seq.deadline is not None and not self.can_meet(seq.deadline) and not seq.finished:
+                if not seq.output_ids:  # a preempted request keeps what it generated so far
+                    seq.error = DeadlineExceededError(
+                        f'Request {seq.request_id} dropped after {now - seq.arrival_time:.3f}s in queue, '
+                        f'its deadline can not be met')
+                    self.num_shed += 1
+                self._finish(seq, 'timeout')
+
+    def _eos_token_ids(self, generation_config) -> List[int]:
+        eos = generation_config.eos_token_id
+        if eos is None:
+            eos = []
+        elif isinstance(eos, int):
+            eos = [eos]
+        eos = list(eos)
+        if self.tokenizer.eos_token_id is not None and self.tokenizer.eos_token_id not in eos:
+            eos.append(self.tokenizer.eos_token_id)
+        return eos
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._shutdown and not self.waiting and not self.running:
+                    self._cond.wait()
+                if self._shutdown:
+                    break
+                try:
+                    for seq in self.waiting + self.running:
+                        if seq.aborted and not seq.finished:
+                            self._finish(seq, 'abort')
+                    self._shed_expired()
+                    # finished sequences have freed their KV blocks, the scheduler must not count them
+                    self.waiting = [seq for seq in self.waiting if not seq.finished]
+                    self.running = [seq for seq in self.running if not seq.finished]
+                    admitted = self._schedule()
+                except Exception as e:
+                    # fail the pending requests rather than the engine thread, later requests still get served
+                    logger.exception(f'Batching engine scheduling failed: {e}')
+                    for seq in self.waiting + self.running:
+                        seq.error = e
+                        self._finish(seq, 'error')
+                    self.waiting, self.running = [], []
+                    continue
+            start = time.time()
+            try:
+                with self._model_lock:
+                    self._step(admitted)
+                self.avg_step_time = 0.9 * self.avg_step_time + 0.1 * (time.time() - start)
+            except Exception as e:
+                logger.exception(f'Batching engine step failed: {e}')
+                for seq in admitted + self.running:
+                    seq.error = e
+                    self._finish(seq, 'error')
+            self.running = [seq for seq in self.running if not seq.finished]
+        for seq in self.waiting + self.running:
+            self._finish(seq, 'abort')
+
+    def _schedule(self) -> List[GenerationSequence]:
+        """Pop the waiting requests that fit into this step's batch, token budget and KV pool."""
+        admitted = []
+        # stable: within a priority class, preempted requests (re-queued at the front) and then arrival order
+        self.waiting.sort(key=lambda seq: seq.priority)
+        budget = self.max_batched_tokens - len(self.running) * self.num_decode_tokens
+        # keep the blocks every running sequence needs for its next decode step in reserve
+        free_blocks = self.kv_cache.num_free_blocks() - sum(
+            self.kv_cache.blocks_needed(seq.request_id, self.num_decode_tokens)
+            for seq in self.running if not seq.finished
+        )
+        while self.waiting and len(self.running) + len(admitted) < self.max_batch_size:
+            seq = self.waiting[0]
+            num_tokens = seq.num_tokens
+            if num_tokens > budget and (self.running or admitted):
+                break
+            blocks = self.kv_cache.num_blocks_for(num_tokens + 1)
+            if blocks > free_blocks:
+                break
+            self.waiting.pop(0)
+            budget -= num_tokens
+            free_blocks -= blocks
+            if seq.scheduled_time is None:
+                seq.scheduled_time = time.time()
+                self.metrics.queue_wait.observe(seq.queue_time)
+            admitted.append(seq)
+        return admitted
+
+    @torch.inference_mode()
+    def _step(self, admitted: List[GenerationSequence]):
+        decoding = [seq for seq in self.running if not seq.finished]
+        for seq in admitted:
+            self._prefill(seq)
+            self.running.append(seq)
+        decoding = self._reserve_decode_slots(decoding)
+        self.metrics.kv_cache_usage.observe(1 - len(self.kv_cache.free_blocks) / self.kv_cache.num_blocks)
+        if decoding:
+            self.metrics.batch_size.observe(len(decoding))
+            self.metrics.batch_occupancy.observe(len(decoding) / self.max_batch_size)
+        if decoding and self.proposer is not None:
+            self._decode_speculative(decoding)
+        elif decoding:
+            self._decode(decoding)
+
+    def _reserve_decode_slots(self, seqs: List[GenerationSequence]) -> List[GenerationSequence]:
+        """
+        Preempt sequences until every remaining one can grow by a decode step:
+        the lowest priority class first, the latest admitted first within a class.
+        A sequence that outgrows the whole pool is finished ('length') instead.
+        """
+        seqs = list(seqs)
+        for seq in list(seqs):
+            # not even the whole pool holds its next step: preempting it would block the waiting queue for good
+            length = self.kv_cache.seq_lengths[seq.request_id]
+            if self.kv_cache.num_blocks_for(length + self.num_decode_tokens) > self.kv_cache.num_blocks:
+                seqs.remove(seq)
+                self._finish(seq, 'length')
+        while seqs:
+            needed = sum(self.kv_cache.blocks_needed(seq.request_id, self.num_decode_tokens) for seq in seqs)
+            if needed <= self.kv_cache.num_free_blocks():
+                break
+            victim = max(seqs, key=lambda x: (x.priority, x.scheduled_time))
+            seqs.remove(victim)
+            self.running.remove(victim)
+            self.kv_cache.free(victim.request_id)
+            if self.proposer is not None:
+                self.proposer.free(victim.request_id)
+            logger.warning(f'KV cache exhausted, preempting request {victim.request_id}')
+            with self._cond:
+                self.waiting.insert(0, victim)
+        return seqs
+
+    def _prefill(self, seq: GenerationSequence):
+        if seq.output_ids:
+            # resumed after preemption: rebuild the cache, the last token is fed by the next decode
+            token_ids = (seq.input_ids + seq.output_ids)[:-1]
+        else:
+            token_ids = seq.input_ids
+        prefix_len, past_key_values = 0, None
+        if self.prefix_cache is not None:
+            # keep at least one token to run through the model for the next-token logits
+            blocks = self.prefix_cache.match(token_ids[:-1], namespace=seq.adapter)
+            if blocks:
+                self.kv_cache.share(seq.request_id, blocks)
+                prefix_len = len(blocks) * self.kv_cache.block_size
+                past_key_values, _ = self.kv_cache.gather([seq.request_id])
+        self._activate_adapters([seq])
+        outputs = self.model(
+            input_ids=torch.tensor([token_ids[prefix_len:]], device=self.device),
+            attention_mask=torch.ones(1, len(token_ids), dtype=torch.long, device=self.device),
+            position_ids=torch.arange(prefix_len, len(token_ids), device=self.device).unsqueeze(0),
+            past_key_values=from_legacy_cache(past_key_values),
+            use_cache=True,
+        )
+        self.kv_cache.write(seq.request_id, to_legacy_cache(outputs.past_key_values), start=prefix_len)
+        if not seq.output_ids:
+            self._append_token(seq, outputs.logits[:, -1, :])
+
+    def _decode(self, seqs: List[GenerationSequence]):
+        """Run one forward step for all `seqs` at once, on a left-padded batch gathered from the KV pool."""
+        past_key_values, lengths = self.kv_cache.gather([seq.request_id for seq in seqs])
+        max_len = max(lengths)
+        attention_mask = torch.zeros(len(seqs), max_len + 1, dtype=torch.long, device=self.device)
+        for i, length in enumerate(lengths):
+            attention_mask[i, max_len - length:] = 1
+        input_ids = torch.tensor([[seq.last_token_id] for seq in seqs], device=self.device)
+        position_ids = torch.tensor([[length] for length in lengths], device=self.device)
+        self._activate_adapters(seqs)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=from_legacy_cache(past_key_values),
+            use_cache=True,
+        )
+        self.kv_cache.append([seq.request_id for seq in seqs], to_legacy_cache(outputs.past_key_values))
+        for i, seq in enumerate(seqs):
+            self._append_token(seq, outputs.logits[i:i + 1, -1, :])
+
+    def _decode_speculative(self, seqs: List[GenerationSequence]):
+        """
+        Draft `k` tokens per sequence, score `[last token] + draft` for all `seqs` in one forward
+        pass and commit the accepted tokens; only their KV positions are kept in the pool.
+        """
+        k = self.proposer.num_speculative_tokens
+        drafts = []
+        for seq in seqs:
+            draft_ids, draft_probs = self.proposer.propose(
+                seq.request_id,
+                seq.input_ids + seq.output_ids,
+                logits_processor=seq.logits_processor,
+                greedy=_is_greedy(seq.generation_config),
+            )
+            drafts.append((draft_ids, draft_probs))
+        past_key_values, lengths = self.kv_cache.gather([seq.request_id for seq in seqs])
+        max_len = max(lengths)
+        attention_mask = torch.zeros(len(seqs), max_len + k + 1, dtype=torch.long, device=self.device)
+        for i, length in enumerate(lengths):
+            attention_mask[i, max_len - length:] = 1
+        input_ids = torch.tensor(
+            [[seq.last_token_id] + draft_ids for seq, (draft_ids, _) in zip(seqs, drafts)], device=self.device
+        )
+        position_ids = torch.stack([torch.arange(length, length + k + 1, device=self.device) for length in lengths])
+        self._activate_adapters(seqs)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=from_legacy_cache(past_key_values),
+            use_cache=True,
+        )
+        accepted = []
+        for i, (seq, (draft_ids, draft_probs)) in enumerate(zip(seqs, drafts)):
+            accepted.append(verify_draft(
+                seq.input_ids + seq.output_ids,
+                draft_ids,
+                outputs.logits[i],
+                logits_processor=seq.logits_processor,
+                greedy=_is_greedy(seq.generation_config),
+                draft_probs=draft_probs,
+            ))
+        # the last accepted token of every row is fed by the next step, like in `_decode`
+        self.kv_cache.append(
+            [seq.request_id for seq in seqs],
+            to_legacy_cache(outputs.past_key_values),
+            num_tokens=[len(token_ids) for token_ids in accepted],
+            window=k + 1,
+        )
+        for i, (seq, token_ids) in enumerate(zip(seqs, accepted)):
+            seq.num_draft_tokens += k
+            seq.num_accepted_tokens += len(token_ids) - 1
+            self.num_draft_tokens += k
+            self.num_accepted_tokens += len(token_ids) - 1
+            self.proposer.rollback(seq.request_id, seq.num_tokens + len(token_ids) - 1)
+            for j, token_id in enumerate(token_ids):
+                self._commit_token(seq, token_id, outputs.logits[i, j:j + 1])
+                if seq.finished:
+                    break
+
+    @torch.inference_mode()
+    def embed(self, batch_input_ids: List[List[int]], adapters: Optional[List[Optional[str]]] = None) -> torch.Tensor:
+        """
+        Mean-pooled, L2-normalized last hidden states of a right-padded batch, [batch, hidden].
+        :param adapters: LoRA adapter per row, None for the base model
+        """
+        max_len = max(len(ids) for ids in batch_input_ids)
+        pad_token_id = self.tokenizer.pad_token_id or 0
+        input_ids = torch.tensor(
+            [ids + [pad_token_id] * (max_len - len(ids)) for ids in batch_input_ids], device=self.device)
+        attention_mask = torch.tensor(
+            [[1] * len(ids) + [0] * (max_len - len(ids)) for ids in batch_input_ids], device=self.device)
+        # the decoder alone skips the lm_head projection over the vocabulary
+        decoder = self.model.get_decoder() if hasattr(self.model, 'get_decoder') else None
+        with self._model_lock:
+            if self.lora_manager is not None:
+                self.lora_manager.activate(adapters or [None] * len(batch_input_ids))
+            if decoder is not None and decoder is not self.model:
+                hidden_states = decoder(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+            else:
+                outputs = self.model(input_ids=input_ids, attention_mask=attention_mask, output_hidden_states=True)
+                hidden_states = outputs.hidden_states[-1]
+        mask = attention_mask.unsqueeze(-1).to(hidden_states.dtype)
+        embeddings = (hidden_states * mask).sum(dim=1) / mask.sum(dim=1)
+        return F.normalize(embeddings.float(), dim=-1).cpu()
+
+    def _activate_adapters(self, seqs: List[GenerationSequence]):
+        if self.lora_manager is not None:
+            self.lora_manager.activate([seq.adapter for seq in seqs])
+
+    def _sample(self, seq: GenerationSequence, scores: torch.Tensor) -> int:
+        if seq.logits_processor:
+            input_ids = torch.tensor([seq.input_ids + seq.output_ids], device=scores.device)
+            scores = seq.logits_processor(input_ids, scores)
+        if _is_greedy(seq.generation_config):
+            return int(torch.argmax(scores, dim=-1))
+        probs = torch.softmax(scores.float(), dim=-1)
+        return int(torch.multinomial(probs, num_samples=1))
+
+    def _append_token(self, seq: GenerationSequence, scores: torch.Tensor):
+        self._commit_token(seq, self._sample(seq, scores), scores)
+
+    def _commit_token(self, seq: GenerationSequence, token_id: int, scores: torch.Tensor):
+        now = time.time()
+        if seq.first_token_time is None:
+            seq.first_token_time = now
+            self.metrics.time_to_first_token.observe(now - seq.arrival_time)
+        else:
+            self.metrics.inter_token_latency.observe(now - seq.last_token_time)
+        seq.last_token_time = now
+        if token_id in seq.eos_token_ids:
+            self._finish(seq, 'stop')
+            return
+        seq.output_ids.append(token_id)
+        self.metrics.generation_tokens.inc()
+        if seq.streamer is not None:
+            seq.streamer.put(torch.tensor([token_id]))
+        if len(seq.output_ids) >= seq.max_new_tokens:
+            self._finish(seq, 'length')
+        elif seq.deadline is not None and now >= seq.deadline:
+            self._finish(seq, 'timeout')
+        elif seq.aborted:
+            self._finish(seq, 'abort')
+        elif seq.stopping_criteria:
+            input_ids = torch.tensor([seq.input_ids + seq.output_ids], device=scores.device)
+            if bool(torch.as_tensor(seq.stopping_criteria(input_ids, scores)).any()):
+                self._finish(seq, 'stop')
+
+    def _finish(self, seq: GenerationSequence, reason: str):
+        if seq.finished:
+            return
+        seq.finish_reason = reason
+        seq.finish_time = time.time()
+        self.metrics.requests.inc(label=reason)
+        self.metrics.prompt_tokens.inc(len(seq.input_ids))
+        self.metrics.request_latency.observe(seq.finish_time - seq.arrival_time)
+        if len(seq.output_ids) > 1 and seq.last_token_time > seq.first_token_time:
+            self.metrics.request_throughput.observe(
+                (len(seq.output_ids) - 1) / (seq.last_token_time - seq.first_token_time))
+        if self.prefix_cache is not None and reason != 'error' and seq.request_id in self.kv_cache.block_tables:
+            num_cached = self.kv_cache.seq_lengths[seq.request_id]
+            self.prefix_cache.insert(
+                (seq.input_ids + seq.output_ids)[:num_cached],
+                self.kv_cache.block_tables[seq.request_id],
+                namespace=seq.adapter,
+            )
+        self.kv_cache.free(seq.request_id)
+        if self.proposer is not None:
+            self.proposer.free(seq.request_id)
+        if seq.adapter is not None:
+            self.lora_manager.release(seq.adapter)
+        if seq.streamer is not None:
+            seq.streamer.end()
+        speculative = ''
+        if seq.acceptance_rate is not None:
+            speculative = (f', draft tokens accepted {seq.num_accepted_tokens}/{seq.num_draft_tokens} '
+                           f'({seq.acceptance_rate:.1%})')
+        logger.debug(
+            f'request {seq.request_id} finished ({reason}): queue time {seq.queue_time:.3f}s, '
+            f'prompt tokens {len(seq.input_ids)}, completion tokens {len(seq.output_ids)}, '
+            f'kv blocks used {self.kv_cache.num_blocks - len(self.kv_cache.free_blocks)}/{self.kv_cache.num_blocks}'
+            f'{speculative}'
+        )
+        seq._done.set()
+
+
+class EmbeddingBatcher:
+    """
+    Micro-batching coalescer for embedding requests.
+
+    Requests arriving within `window` seconds of the first one are collected (up to
+    `max_batch_size`), sorted by length and cut into padded batches of at most
+    `max_batched_tokens` tokens (padding included), each embedded in one forward pass.
+    """
+
+    def __init__(
+            self,
+            engine: ContinuousBatchingEngine,
+            max_batch_size: int = 32,
+            max_batched_tokens: int = 8192,
+            window: float = 0.005,
+    ):
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+        self.max_batched_tokens = max_batched_tokens
+        self.window = window
+        self.num_requests = 0
+        self.num_batches = 0
+        self._queue = queue.Queue()
+        self._thread = Thread(target=self._loop, name='embedding-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, input_ids: List[int], adapter: Optional[str] = None) -> Future:
+        """Queue one input, the future resolves to its embedding ([hidden] float tensor)."""
+        future = Future()
+        if adapter is not None:
+            # pinned until its batch ran
+            self.engine.lora_manager.acquire(adapter)
+        self._queue.put((list(input_ids), adapter, future))
+        return future
+
+    def shutdown(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def stats(self) -> Dict:
+        return {
+            'num_requests': self.num_requests,
+            'num_batches': self.num_batches,
+            'avg_batch_size': self.num_requests / self.num_batches if self.num_batches else 0.0,
+        }
+
+    def _loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            items = [item]
+            deadline = time.monotonic() + self.window
+            while len(items) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                items.append(item)
+            items.sort(key=lambda x: len(x[0]))
+            batch = []
+            for item in items:
+                # sorted by length, so the new item sets the padded length of the batch
+                if batch and (len(batch) + 1) * len(item[0]) > self.max_batched_tokens:
+                    self._run(batch)
+                    batch = []
+                batch.append(item)
+            self._run(batch)
+
+    def _run(self, batch):
+        self.num_requests += len(batch)
+        self.num_batches += 1
+        try:
+            embeddings = self.engine.embed([ids for ids, _, _ in batch], [adapter for _, adapter, _ in batch])
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        finally:
+            for _, adapter, _ in batch:
+                if adapter is not None:
+                    self.engine.lora_manager.release(adapter)
+        for (_, _, future), embedding in zip(batch, embeddings):
+            future.set_result(embedding)
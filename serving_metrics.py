@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+@description: Prometheus metrics of the batching engine, rendered in the text exposition format.
+
+Every metric is written by a single thread (the engine loop, or the event loop for the GC
+metrics) and only read by `/metrics` scrapes, so updates are plain integer/float increments
+without locks; a scrape may see a histogram mid-update, which Prometheus tolerates.
+"""
+import bisect
+import math
+from typing import Callable, Dict, List, Optional, Sequence
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 0.75, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 1.0)
+THROUGHPUT_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, label_name: Optional[str] = None):
+        self.name = name
+        self.documentation = documentation
+        self.label_name = label_name
+        self.values: Dict[Optional[str], float] = {}
+
+    def inc(self, amount: float = 1, label: Optional[str] = None):
+        self.values[label] = self.values.get(label, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for label, value in list(self.values.items()) or [(None, 0)]:
+            labels = {self.label_name: label} if self.label_name and label is not None else {}
+            lines.append(f'{self.name}{_format_labels(labels)} {_format_value(value)}')
+        return lines
+
+
+class Gauge:
+    """Gauge read from `callback` at scrape time."""
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], float]):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+
+    def render(self) -> List[str]:
+        return [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} gauge',
+            f'{self.name} {_format_value(self.callback())}',
+        ]
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = list(buckets)
+        # per bucket counts (not cumulative), the last one is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + [math.inf], counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{_format_value(bound)}"}} {cumulative}')
+        lines.append(f'{self.name}_sum {_format_value(total)}')
+        lines.append(f'{self.name}_count {cumulative}')
+        return lines
+
+
+class EngineMetrics:
+    """Latency, throughput and occupancy metrics recorded by `ContinuousBatchingEngine`."""
+
+    def __init__(self, max_batch_size: int, prefix: str = 'llm'):
+        self.metrics = []
+        self.time_to_first_token = self.register(Histogram(
+            f'{prefix}_time_to_first_token_seconds', 'Time from request arrival to its first generated token.'))
+        self.inter_token_latency = self.register(Histogram(
+            f'{prefix}_inter_token_latency_seconds', 'Time between two consecutive tokens of a request.'))
+        self.queue_wait = self.register(Histogram(
+            f'{prefix}_queue_wait_seconds', 'Time a request waited before its prefill was scheduled.'))
+        self.request_latency = self.register(Histogram(
+            f'{prefix}_request_duration_seconds', 'Time from request arrival to its last token.'))
+        self.request_throughput = self.register(Histogram(
+            f'{prefix}_request_tokens_per_second', 'Decode speed of a single request after its first token.',
+            THROUGHPUT_BUCKETS))
+        batch_buckets = sorted({1, 2, 4, 8, 16, 32, 64, 128, max_batch_size})
+        self.batch_size = self.register(Histogram(
+            f'{prefix}_batch_size', 'Number of sequences in each decode step.',
+            [b for b in batch_buckets if b <= max_batch_size]))
+        self.batch_occupancy = self.register(Histogram(
+            f'{prefix}_batch_occupancy_ratio', 'Decode batch size over max_batch_size, per decode step.',
+            RATIO_BUCKETS))
+        self.kv_cache_usage = self.register(Histogram(
+            f'{prefix}_kv_cache_usage_ratio', 'Share of KV cache blocks in use, per engine step.', RATIO_BUCKETS))
+        self.prompt_tokens = self.register(Counter(
+            f'{prefix}_prompt_tokens_total', 'Prompt tokens of finished requests.'))
+        self.generation_tokens = self.register(Counter(
+            f'{prefix}_generation_tokens_total', 'Generated tokens, rate() gives tokens per second.'))
+        self.requests = self.register(Counter(
+            f'{prefix}_requests_total', 'Finished requests by finish reason.', label_name='finish_reason'))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_gauge(self, name: str, documentation: str, callback: Callable[[], float]):
+        self.register(Gauge(name, documentation, callback))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+@description: Speculative decoding helpers: draft proposers and draft-then-verify acceptance.
+
+A proposer guesses the next few tokens cheaply, the target model scores all of them in one
+forward pass and `verify_draft` keeps the longest prefix the target agrees with, plus one token
+chosen by the target itself. With greedy decoding the output is identical to plain greedy
+decoding of the target; with sampling, rejection sampling keeps the target distribution.
+"""
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+from kv_cache import from_legacy_cache, to_legacy_cache
+
+
+def verify_draft(
+        token_ids: List[int],
+        draft_ids: List[int],
+        target_logits: torch.Tensor,
+        logits_processor=None,
+        greedy: bool = True,
+        draft_probs: Optional[torch.Tensor] = None,
+) -> List[int]:
+    """
+    Accept draft tokens against the target model.
+    :param token_ids: tokens before the draft (prompt and generated so far)
+    :param draft_ids: proposed continuation, k tokens
+    :param target_logits: target logits at the last known token and at each draft token, [k + 1, vocab]
+    :param logits_processor: processors applied to the target scores (repetition penalty, warpers)
+    :param greedy: accept by argmax match instead of rejection sampling
+    :param draft_probs: draft distributions the draft tokens were sampled from, [k, vocab], sampling only;
+        None for deterministic drafts (prompt lookup), i.e. one-hot draft distributions
+    :return: tokens to append, the accepted draft prefix followed by one target token
+    """
+    accepted = []
+    for j in range(len(draft_ids) + 1):
+        scores = target_logits[j:j + 1]
+        if logits_processor:
+            input_ids = torch.tensor([token_ids + accepted], device=scores.device)
+            scores = logits_processor(input_ids, scores)
+        if greedy:
+            token_id = int(torch.argmax(scores, dim=-1))
+            accepted.append(token_id)
+            if j == len(draft_ids) or token_id != draft_ids[j]:
+                break
+            continue
+        probs = torch.softmax(scores.float(), dim=-1)[0]
+        if j == len(draft_ids):
+            accepted.append(int(torch.multinomial(probs, num_samples=1)))
+            break
+        draft_id = draft_ids[j]
+        if draft_probs is not None:
+            q = draft_probs[j].to(probs.device)
+            vocab_size = min(probs.shape[-1], q.shape[-1])
+            probs, q = probs[:vocab_size], q[:vocab_size]
+        else:
+            q = torch.zeros_like(probs)
+            q[draft_id] = 1.0
+        if torch.rand(()) * q[draft_id] <= probs[draft_id]:
+            accepted.append(draft_id)
+            continue
+        residual = torch.clamp(probs - q, min=0)
+        if residual.sum() <= 0:
+            residual = probs
+        accepted.append(int(torch.multinomial(residual / residual.sum(), num_samples=1)))
+        break
+    return accepted
+
+
+def crop_legacy_cache(past_key_values, num_tokens: int):
+    """Keep the first `num_tokens` positions of a legacy cache tuple."""
+    return tuple((k[:, :, :num_tokens], v[:, :, :num_tokens]) for k, v in past_key_values)
+
+
+class PromptLookupProposer:
+    """
+    Draft-free proposer: finds the latest earlier occurrence of the trailing n-gram of the
+    sequence and proposes the tokens that followed it.
+
+    Works well when the output copies spans of the prompt, e.g. RAG answers quoting the
+    retrieved references.
+    """
+
+    def __init__(self, num_speculative_tokens: int = 10, max_ngram_size: int = 3, min_ngram_size: int = 1):
+        self.num_speculative_tokens = num_speculative_tokens
+        self.max_ngram_size = max_ngram_size
+        self.min_ngram_size = min_ngram_size
+
+    def propose(self, token_ids: List[int]) -> List[int]:
+        """Return up to k tokens continuing `token_ids`, empty when the trailing n-gram has no match."""
+        for n in range(self.max_ngram_size, self.min_ngram_size - 1, -1):
+            if len(token_ids) <= n:
+                continue
+            ngram = token_ids[-n:]
+            for start in range(len(token_ids) - n - 1, -1, -1):
+                if token_ids[start:start + n] == ngram:
+                    return token_ids[start + n:start + n + self.num_speculative_tokens]
+        return []
+
+
+@torch.inference_mode()
+def prompt_lookup_generate(
+        model,
+        input_ids: torch.Tensor,
+        max_new_tokens: int,
+        proposer: PromptLookupProposer,
+        logits_processor=None,
+        greedy: bool = True,
+        eos_token_ids: Optional[List[int]] = None,
+        streamer=None,
+) -> Dict[str, int]:
+    """
+    Batch-1 generation loop verifying prompt lookup drafts in one forward pass per step.
+    :param input_ids: prompt ids, [1, length]
+    :param streamer: receives the prompt first, then every accepted token (like `model.generate`)
+    :return: step counters, `num_tokens / num_steps` is the number of tokens accepted per forward pass
+    """
+    eos_token_ids = set(eos_token_ids or [])
+    token_ids = input_ids[0].tolist()
+    stats = {'num_steps': 0, 'num_tokens': 0, 'num_draft_tokens': 0, 'num_accepted_tokens': 0}
+    past_key_values, num_cached = None, 0
+    if streamer is not None:
+        streamer.put(input_ids.cpu())
+    try:
+        while stats['num_tokens'] < max_new_tokens:
+            draft_ids = proposer.propose(token_ids)[:max_new_tokens - stats['num_tokens'] - 1]
+            new_ids = token_ids[num_cached:] + draft_ids
+            outputs = model(
+                input_ids=torch.tensor([new_ids], device=input_ids.device),
+                attention_mask=torch.ones(1, num_cached + len(new_ids), dtype=torch.long, device=input_ids.device),
+                past_key_values=from_legacy_cache(past_key_values),
+                use_cache=True,
+            )
+            accepted = verify_draft(
+                token_ids,
+                draft_ids,
+                outputs.logits[0, -len(draft_ids) - 1:],
+                logits_processor=logits_processor,
+                greedy=greedy,
+            )
+            # the last accepted token has not been through the model yet
+            num_cached = len(token_ids) + len(accepted) - 1
+            past_key_values = crop_legacy_cache(to_legacy_cache(outputs.past_key_values), num_cached)
+            stats['num_steps'] += 1
+            stats['num_draft_tokens'] += len(draft_ids)
+            stats['num_accepted_tokens'] += len(accepted) - 1
+            for token_id in accepted:
+                if token_id in eos_token_ids:
+                    return stats
+                token_ids.append(token_id)
+                stats['num_tokens'] += 1
+                if streamer is not None:
+                    streamer.put(torch.tensor([token_id]))
+    finally:
+        if streamer is not None:
+            streamer.end()
+    return stats
+
+
+class DraftModelProposer:
+    """
+    Proposes tokens with a small draft model sharing the target's tokenizer.
+
+    Every sequence keeps its own batch-1 draft cache; after verification it is cropped back to
+    the accepted tokens, and the tokens it misses are fed at the next proposal.
+    """
+
+    def __init__(self, draft_model, num_speculative_tokens: int = 4):
+        self.model = draft_model
+        self.num_speculative_tokens = num_speculative_tokens
+        self.caches: Dict[int, tuple] = {}
+        self.lengths: Dict[int, int] = {}
+
+    @property
+    def device(self):
+        return self.model.device
+
+    @torch.inference_mode()
+    def propose(
+            self,
+            seq_id: int,
+            token_ids: List[int],
+            logits_processor=None,
+            greedy: bool = True,
+    ) -> Tuple[List[int], Optional[torch.Tensor]]:
+        """Return k draft tokens continuing `token_ids` and, when sampling, their draft distributions."""
+        past_key_values = self.caches.get(seq_id)
+        num_cached = self.lengths.get(seq_id, 0)
+        new_ids = token_ids[num_cached:]
+        draft_ids, draft_probs = [], []
+        for _ in range(self.num_speculative_tokens):
+            outputs = self.model(
+                input_ids=torch.tensor([new_ids], device=self.device),
+                attention_mask=torch.ones(1, num_cached + len(new_ids), dtype=torch.long, device=self.device),
+                position_ids=torch.arange(num_cached, num_cached + len(new_ids), device=self.device).unsqueeze(0),
+                past_key_values=from_legacy_cache(past_key_values),
+                use_cache=True,
+            )
+            past_key_values = to_legacy_cache(outputs.past_key_values)
+            num_cached += len(new_ids)
+            scores = outputs.logits[:, -1, :]
+            if logits_processor:
+                scores = logits_processor(torch.tensor([token_ids + draft_ids], device=self.device), scores)
+            if greedy:
+                token_id = int(torch.argmax(scores, dim=-1))
+            else:
+                probs = torch.softmax(scores.float(), dim=-1)
+                token_id = int(torch.multinomial(probs, num_samples=1))
+                draft_probs.append(probs[0])
+            draft_ids.append(token_id)
+            new_ids = [token_id]
+        self.caches[seq_id] = past_key_values
+        self.lengths[seq_id] = num_cached
+        return draft_ids, torch.stack(draft_probs) if draft_probs else None
+
+    def rollback(self, seq_id: int, num_tokens: int):
+        """Keep only the first `num_tokens` positions of the draft cache of `seq_id`."""
+        if seq_id not in self.caches or self.lengths[seq_id] <= num_tokens:
+            return
+        self.caches[seq_id] = crop_legacy_cache(self.caches[seq_id], num_tokens)
+        self.lengths[seq_id] = num_tokens
+
+    def free(self, seq_id: int):
+        self.caches.pop(seq_id, None)
+        self.lengths.pop(seq_id, None)
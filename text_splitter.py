@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+@description: Text splitter of ChatPDF, cuts document text into retrieval chunks.
+"""
+import bisect
+import re
+from typing import List
+
+import jieba
+import numpy as np
+
+jieba.setLogLevel("ERROR")
+
+SPLIT_MODES = ('chars', 'spans', 'tokens')
+# end of a sentence: end punctuation with closing quotes or brackets, or a line break, and the spaces after
+SENTENCE_END_RE = re.compile(r'(?:[。！？；…!?;]+|\.(?=\s|$)|\n)[”’」』）)\]"\']*\s*')
+
+
+def _is_word_start(text: str, offset: int) -> bool:
+    """Whether a chunk can start at `offset` without cutting a word: at a space, or next to a Chinese character."""
+    prev, char = text[offset - 1], text[offset]
+    return prev.isspace() or char.isspace() or '\u4e00' <= prev <= '\u9fff' or '\u4e00' <= char <= '\u9fff'
+
+
+class SentenceSplitter:
+    def __init__(
+            self,
+            chunk_size: int = 250,
+            chunk_overlap: int = 50,
+            mode: str = 'chars',
+            tokenizer=None,
+            tokenize_block_chars: int = 65536,
+    ):
+        """
+        :param chunk_size: max chunk length, in characters ('chars', 'spans' mode) or tokens ('tokens' mode)
+        :param chunk_overlap: overlap of consecutive chunks, in the same unit
+        :param mode: 'chars', jieba words (Chinese) or sentences (English) concatenated up to chunk_size
+            characters, each chunk followed by the head of the next one;
+            'spans', sentences packed up to chunk_size characters as offset spans of the text, consecutive
+            chunks share up to chunk_overlap characters (sliding window, starting at a sentence boundary if any,
+            else at a word boundary, else without overlap);
+            'tokens', as 'spans' with lengths counted in tokens of `tokenizer`, so that chunks fit the
+            embedding model's window
+        :param tokenizer: fast transformers tokenizer (offset mapping needed) of the 'tokens' mode
+        :param tokenize_block_chars: text tokenized per tokenizer call in 'tokens' mode
+        """
+        if mode not in SPLIT_MODES:
+            raise ValueError(f'Unknown split mode {mode}, choose from {SPLIT_MODES}')
+        if mode == 'tokens' and tokenizer is None:
+            raise ValueError('The tokens split mode needs a tokenizer')
+        if mode != 'chars' and not 0 <= chunk_overlap < chunk_size:
+            raise ValueError(f'chunk_overlap {chunk_overlap} must be smaller than chunk_size {chunk_size}')
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.mode = mode
+        self.tokenizer = tokenizer
+        self.tokenize_block_chars = tokenize_block_chars
+
+    @property
+    def signature(self) -> str:
+        """Settings the chunks depend on."""
+        signature = f'{self.chunk_size}-{self.chunk_overlap}'
+        if self.mode != 'chars':
+            signature += f'-{self.mode}'
+        if self.mode == 'tokens':
+            signature += f'-{getattr(self.tokenizer, "name_or_path", type(self.tokenizer).__name__)}'
+        return signature
+
+    def split_text(self, text: str) -> List[str]:
+        if self.mode != 'chars':
+            return self._split_spans(text)
+        if self._is_has_chinese(text):
+            return self._split_chinese_text(text)
+        else:
+            return self._split_english_text(text)
+
+    def _split_chinese_text(self, text: str) -> List[str]:
+        sentence_endings = {'\n', '。', '！', '？', '；', '…'}  
+        chunks, current_chunk = [], ''
+        for word in jieba.cut(text):
+            if len(current_chunk) + len(word) > self.chunk_size:
+                chunks.append(current_chunk.strip())
+                current_chunk = word
+            else:
+                current_chunk += word
+            if word[-1] in sentence_endings and len(current_chunk) > self.chunk_size - self.chunk_overlap:
+                chunks.append(current_chunk.strip())
+                current_chunk = ''
+        if current_chunk:
+            chunks.append(current_chunk.strip())
+        if self.chunk_overlap > 0 and len(chunks) > 1:
+            chunks = self._handle_overlap(chunks)
+        return chunks
+
+    def _split_english_text(self, text: str) -> List[str]:
+       
+        sentences = re.split(r'(?<=[.!?])\s+', text.replace('\n', ' '))
+        chunks, current_chunk = [], ''
+        for sentence in sentences:
+            if len(current_chunk) + len(sentence) <= self.chunk_size or not current_chunk:
+                current_chunk += (' ' if current_chunk else '') + sentence
+            else:
+                chunks.append(current_chunk)
+                current_chunk = sentence
+        if current_chunk:  # Add the last chunk
+            chunks.append(current_chunk)
+
+        if self.chunk_overlap > 0 and len(chunks) > 1:
+            chunks = self._handle_overlap(chunks)
+
+        return chunks
+
+    def _is_has_chinese(self, text: str) -> bool:
+        # check if contains chinese characters
+        if any("\u4e00" <= ch <= "\u9fff" for ch in text):
+            return True
+        else:
+            return False
+
+    def _handle_overlap(self, chunks: List[str]) -> List[str]:
+        
+        overlapped_chunks = []
+        for i in range(len(chunks) - 1):
+            chunk = chunks[i] + ' ' + chunks[i + 1][:self.chunk_overlap]
+            overlapped_chunks.append(chunk.strip())
+        overlapped_chunks.append(chunks[-1])
+        return overlapped_chunks
+
+    def _unit_starts(self, text: str) -> np.ndarray:
+        """Start offset of every character ('spans' mode) or token ('tokens' mode) of the text."""
+        if self.mode == 'spans':
+            return np.arange(len(text))
+        # tokenized by blocks cut at line breaks, the offsets of a whole book at once would take GBs
+        blocks, start = [], 0
+        while start < len(text):
+            end = min(start + self.tokenize_block_chars, len(text))
+            if end < len(text):
+                newline = text.rfind('\n', start, end)
+                end = newline + 1 if newline > start else end
+            blocks.append((start, end))
+            start = end
+        starts = []
+        for i in range(0, len(blocks), 16):
+            batch = blocks[i:i + 16]
+            encodings = self.tokenizer([text[s:e] for s, e in batch], add_special_tokens=False,
+                                       return_offsets_mapping=True)
+            for (block_start, _), offsets in zip(batch, encodings['offset_mapping']):
+                starts.append(np.fromiter((o[0] for o in offsets), dtype=np.int64, count=len(offsets)) + block_start)
+        return np.concatenate(starts) if starts else np.empty(0, dtype=np.int64)
+
+    def _split_spans(self, text: str) -> List[str]:
+        """Chunks of at most chunk_size units cut at sentence ends, sliced once from the text."""
+        starts = self._unit_starts(text)
+        num_units = len(starts)
+        if not num_units:
+            return []
+        # index of the unit holding every sentence start (a token may start with the space before it),
+        # the end of the text closes the last sentence
+        sentence_ends = np.fromiter((m.end() for m in SENTENCE_END_RE.finditer(text)), dtype=np.int64)
+        sentence_ends = sentence_ends[sentence_ends < len(text)]
+        bounds = np.unique(np.searchsorted(starts, sentence_ends, side='right') - 1)
+        bounds = bounds[(bounds > 0) & (bounds < num_units)].tolist() + [num_units]
+
+        chunks, start = [], 0
+        while True:
+            limit = start + self.chunk_size
+            if limit >= num_units:
+                end = num_units
+            else:
+                i = bisect.bisect_right(bounds, limit) - 1
+                # a sentence longer than a chunk is cut at chunk_size
+                end = bounds[i] if i >= 0 and bounds[i] > start else limit
+            chunk = text[starts[start]:starts[end] if end < num_units else len(text)].strip()
+            if chunk:
+                chunks.append(chunk)
+            if end >= num_units:
+                return chunks
+            if self.chunk_overlap > 0:
+                # the next window starts chunk_overlap units back, at the first sentence start in that range,
+                # else at the first word start, else right after the chunk
+                overlap_start = max(end - self.chunk_overlap, start + 1)
+                i = bisect.bisect_left(bounds, overlap_start)
+                if bounds[i] < end:
+                    next_start = bounds[i]
+                else:
+                    next_start = next((u for u in range(overlap_start, end) if _is_word_start(text, starts[u])), end)
+                # a window that can not reach the next sentence end would end at this sentence end again
+                i = bisect.bisect_left(bounds, end)
+                if bounds[i] == end and bounds[i + 1] > next_start + self.chunk_size:
+                    next_start = end
+                start = next_start
+            else:
+                start = end
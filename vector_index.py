@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""
+@description: Persistent on-disk vector index of document chunks for ChatPDF.
+
+Embeddings are rows of a memory-mapped float16 (or int8 with one scale per row) matrix file,
+chunk and document metadata live in SQLite. Chunks are keyed by a hash of their text, so
+re-adding a modified document only embeds the chunks whose text changed, chunks shared by several
+documents are stored once, and removing a document frees its rows for reuse without a rebuild.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from loguru import logger
+
+from ann_index import create_ann_index
+
+INDEX_DTYPES = ('float16', 'int8')
+
+
+def chunk_hash(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class VectorIndex:
+    """
+    Cosine similarity index persisted in `index_dir`:
+    - vectors.bin: [capacity, dim] float16 or int8 matrix, grown by doubling,
+    - scales.bin: [capacity] float32 row scales of the int8 matrix,
+    - index.db: chunks (hash, row, text, number of documents referencing it), documents
+      (id, file hash, chunk hashes), free rows and settings.
+    """
+
+    def __init__(self, index_dir: str, dtype: str = 'float16', model_id: Optional[str] = None,
+                 search_block_rows: int = 65536, ann: Optional[str] = None, ann_kwargs: Optional[Dict] = None):
+        """
+        :param ann: approximate search backend, 'ivf' or 'hnsw' (see `ann_index`), default None, exact search
+        :param ann_kwargs: backend parameters, e.g. {'nprobe': 16} for ivf
+        """
+        if dtype not in INDEX_DTYPES:
+            raise ValueError(f'dtype must be one of {INDEX_DTYPES}, got {dtype}')
+        os.makedirs(index_dir, exist_ok=True)
+        self.index_dir = index_dir
+        self.search_block_rows = search_block_rows
+        self.db = sqlite3.connect(os.path.join(index_dir, 'index.db'), check_same_thread=False)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS chunks (hash TEXT PRIMARY KEY, row INTEGER UNIQUE, text TEXT, refs INTEGER);
+            CREATE TABLE IF NOT EXISTS documents (doc_id TEXT PRIMARY KEY, file_hash TEXT, chunk_hashes TEXT);
+            CREATE TABLE IF NOT EXISTS free_rows (row INTEGER PRIMARY KEY);
+        ''')
+        settings = dict(self.db.execute('SELECT key, value FROM settings'))
+        if settings and (settings.get('dtype') != dtype or settings.get('model_id') != str(model_id)):
+            logger.warning(f'Vector index {index_dir} was built with {settings.get("model_id")} '
+                           f'({settings.get("dtype")}), rebuilding it for {model_id} ({dtype})')
+            self.clear()
+            settings = {}
+        self.dtype = dtype
+        self.model_id = str(model_id)
+        self.dim = int(settings['dim']) if 'dim' in settings else None
+        self.num_rows = int(settings.get('num_rows', 0))
+        self._set_settings(dtype=dtype, model_id=self.model_id)
+        self.vectors: Optional[np.memmap] = None
+        self.scales: Optional[np.memmap] = None
+        if self.dim is not None:
+            self._map(self._capacity_on_disk())
+        # row -> chunk text, None for free rows; kept in memory for search results
+        self._row_texts: List[Optional[str]] = [None] * self.num_rows
+        for row, text in self.db.execute('SELECT row, text FROM chunks'):
+            self._row_texts[row] = text
+        self.ann = None
+        # the backend changed in memory since it was last saved
+        self._ann_dirty = False
+        if ann:
+            self.ann = create_ann_index(ann, index_dir, **(ann_kwargs or {}))
+            if not self.ann.consistent(len(self)) or self.ann.needs_training(len(self)):
+                self.build_ann()
+
+    def _set_settings(self, **settings):
+        self.db.executemany('INSERT OR REPLACE INTO settings VALUES (?, ?)',
+                            [(key, str(value)) for key, value in settings.items()])
+        self.db.commit()
+
+    @property
+    def _np_dtype(self):
+        return np.float16 if self.dtype == 'float16' else np.int8
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.index_dir, name)
+
+    def _capacity_on_disk(self) -> int:
+        path = self._path('vectors.bin')
+        if not os.path.exists(path):
+            return 0
+        return os.path.getsize(path) // (self.dim * np.dtype(self._np_dtype).itemsize)
+
+    def _map(self, capacity: int):
+        """(Re)map the matrix files with room for `capacity` rows, growing them if needed."""
+        if self.vectors is not None:
+            self.vectors.flush()
+        files = [('vectors.bin', self._np_dtype, (capacity, self.dim))]
+        if self.dtype == 'int8':
+            files.append(('scales.bin', np.float32, (capacity,)))
+        arrays = []
+        for name, dtype, shape in files:
+            path = self._path(name)
+            size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            if not os.path.exists(path) or os.path.getsize(path) < size:
+                with open(path, 'ab') as f:
+                    f.truncate(size)
+            arrays.append(np.memmap(path, dtype=dtype, mode='r+', shape=shape) if capacity else None)
+        self.vectors = arrays[0]
+        self.scales = arrays[1] if self.dtype == 'int8' else None
+
+    def _allocate_rows(self, count: int) -> List[int]:
+        rows = [row for row, in self.db.execute('SELECT row FROM free_rows ORDER BY row LIMIT ?', (count,))]
+        self.db.executemany('DELETE FROM free_rows WHERE row = ?', [(row,) for row in rows])
+        while len(rows) < count:
+            rows.append(self.num_rows)
+            self.num_rows += 1
+            self._row_texts.append(None)
+        capacity = self.vectors.shape[0] if self.vectors is not None else 0
+        if self.num_rows > capacity:
+            self._map(max(self.num_rows, 2 * capacity, 1024))
+        return rows
+
+    def _write(self, rows: List[int], embeddings: np.ndarray) -> np.ndarray:
+        """Store the normalized embeddings in `rows`, return them."""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings = embeddings / np.maximum(norms, 1e-12)
+        if self.dtype == 'int8':
+            scales = np.abs(embeddings).max(axis=1) / 127
+            scales = np.maximum(scales, 1e-12)
+            self.vectors[rows] = np.round(embeddings / scales[:, None]).astype(np.int8)
+            self.scales[rows] = scales
+        else:
+            self.vectors[rows] = embeddings.astype(np.float16)
+        return embeddings
+
+    def _vectors_at(self, rows: np.ndarray) -> np.ndarray:
+        """Float32 vectors of `rows`."""
+        vectors = self.vectors[rows].astype(np.float32)
+        if self.scales is not None:
+            vectors *= self.scales[rows][:, None]
+        return vectors
+
+    def document_hash(self, doc_id: str) -> Optional[str]:
+        """File hash the document was indexed with, None if it is not indexed."""
+        row = self.db.execute('SELECT file_hash FROM documents WHERE doc_id = ?', (doc_id,)).fetchone()
+        return row[0] if row else None
+
+    def documents(self) -> List[str]:
+        return [doc_id for doc_id, in self.db.execute('SELECT doc_id FROM documents')]
+
+    def _known_hashes(self, hashes: List[str]) -> Set[str]:
+        known = set()
+        for i in range(0, len(hashes), 500):
+            batch = hashes[i:i + 500]
+            known.update(h for h, in self.db.execute(
+                f'SELECT hash FROM chunks WHERE hash IN ({",".join("?" * len(batch))})', batch))
+        return known
+
+    def missing_chunks(self, chunks: List[str]) -> List[str]:
+        """Distinct chunks not in the index yet, i.e. the ones `update_document` would embed."""
+        chunk_texts = {}
+        for text in chunks:
+            chunk_texts.setdefault(chunk_hash(text), text)
+        known = self._known_hashes(list(chunk_texts))
+        return [text for h, text in chunk_texts.items() if h not in known]
+
+    def update_document(
+            self,
+            doc_id: str,
+            file_hash: str,
+            chunks: List[str],
+            embed_fn: Callable[[List[str]], np.ndarray],
+            batch_size: int = 256,
+    ) -> int:
+        """
+        Index `chunks` as the content of `doc_id`, replacing its previous chunks.
+        Only chunks not in the index yet are embedded with `embed_fn`; return their number.
+        The ANN backend is only updated in memory, `save_ann` persists it after a batch of documents.
+        """
+        chunk_texts = {}
+        for text in chunks:
+            chunk_texts.setdefault(chunk_hash(text), text)
+        row = self.db.execute('SELECT chunk_hashes FROM documents WHERE doc_id = ?', (doc_id,)).fetchone()
+        old_hashes = set(json.loads(row[0])) if row else set()
+        new_hashes = set(chunk_texts)
+
+        hashes = list(new_hashes - old_hashes)
+        known = self._known_hashes(hashes)
+        missing = [h for h in hashes if h not in known]
+        for i in range(0, len(missing), batch_size):
+            batch = missing[i:i + batch_size]
+            texts = [chunk_texts[h] for h in batch]
+            embeddings = np.asarray(embed_fn(texts), dtype=np.float32)
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+                self._set_settings(dim=self.dim)
+                self._map(0)
+            elif embeddings.shape[1] != self.dim:
+                raise ValueError(f'Embedding dim {embeddings.shape[1]} does not match the index dim {self.dim}')
+            rows = self._allocate_rows(len(batch))
+            embeddings = self._write(rows, embeddings)
+            if self.ann is not None:
+                self.ann.add(np.asarray(rows), embeddings)
+            self.db.executemany('INSERT INTO chunks VALUES (?, ?, ?, 0)',
+                                [(h, r, text) for h, r, text in zip(batch, rows, texts)])
+            for r, text in zip(rows, texts):
+                self._row_texts[r] = text
+
+        self.db.executemany('UPDATE chunks SET refs = refs + 1 WHERE hash = ?', [(h,) for h in new_hashes - old_hashes])
+        self._release(old_hashes - new_hashes)
+        self.db.execute('INSERT OR REPLACE INTO documents VALUES (?, ?, ?)',
+                        (doc_id, file_hash, json.dumps(sorted(new_hashes))))
+        self._commit()
+        return len(missing)
+
+    def remove_document(self, doc_id: str) -> bool:
+        """Drop a document, freeing the rows of the chunks no other document has."""
+        row = self.db.execute('SELECT chunk_hashes FROM documents WHERE doc_id = ?', (doc_id,)).fetchone()
+        if row is None:
+            return False
+        self._release(json.loads(row[0]))
+        self.db.execute('DELETE FROM documents WHERE doc_id = ?', (doc_id,))
+        self._commit()
+        return True
+
+    def _release(self, hashes: Iterable[str]):
+        hashes = [(h,) for h in hashes]
+        self.db.executemany('UPDATE chunks SET refs = refs - 1 WHERE hash = ?', hashes)
+        freed = [row for row, in self.db.execute('SELECT row FROM chunks WHERE refs <= 0')]
+        self.db.execute('DELETE FROM chunks WHERE refs <= 0')
+        self.db.executemany('INSERT OR IGNORE INTO free_rows VALUES (?)', [(row,) for row in freed])
+        for row in freed:
+            self._row_texts[row] = None
+        if self.ann is not None:
+            self.ann.remove(freed)
+
+    def _commit(self):
+        if self.vectors is not None:
+            self.vectors.flush()
+            if self.scales is not None:
+                self.scales.flush()
+        self._set_settings(num_rows=self.num_rows)
+        # saving the backend rewrites all of its state, it is left to `save_ann`; a backend not saved
+        # before a crash no longer matches the chunk count and is rebuilt on load
+        self._ann_dirty = self.ann is not None
+
+    def save_ann(self):
+        """Persist the ANN backend after a batch of updates, retraining it first if the index outgrew it."""
+        if self.ann is None or not self._ann_dirty:
+            return
+        if self.ann.needs_training(len(self)):
+            self.build_ann()
+        else:
+            self.ann.save(len(self))
+        self._ann_dirty = False
+
+    def build_ann(self):
+        """(Re)build the approximate search backend from all rows: train it on a sample, then add every row."""
+        rows = np.array([row for row, text in enumerate(self._row_texts) if text is not None], dtype=np.int64)
+        logger.info(f'Building the ANN index of {len(rows)} chunks in {self.index_dir}')
+        self.ann.reset()
+        if len(rows):
+            rng = np.random.default_rng(0)
+            sample = np.sort(rng.choice(rows, min(len(rows), getattr(self.ann, 'max_train_rows', 1024)), replace=False))
+            self.ann.train(self._vectors_at(sample), len(rows))
+            for start in range(0, len(rows), self.search_block_rows):
+                block = rows[start:start + self.search_block_rows]
+                self.ann.add(block, self._vectors_at(block))
+        self.ann.save(len(self))
+        self._ann_dirty = False
+
+    def clear(self):
+        self.db.executescript('DELETE FROM settings; DELETE FROM chunks; DELETE FROM documents; DELETE FROM free_rows;')
+        self.db.commit()
+        self.vectors = self.scales = None
+        for name in ('vectors.bin', 'scales.bin'):
+            if os.path.exists(self._path(name)):
+                os.remove(self._path(name))
+        self.dim, self.num_rows, self._row_texts = None, 0, []
+        if getattr(self, 'ann', None) is not None:
+            self.ann.reset()
+            self.ann.save(0)
+
+    def texts(self) -> List[str]:
+        return [text for text in self._row_texts if text is not None]
+
+    def __len__(self) -> int:
+        return len(self._row_texts) - self._row_texts.count(None)
+
+    def search(self, query_embedding: np.ndarray, topn: int = 5, exact: bool = False) -> List[Tuple[str, float]]:
+        """
+        (chunk text, cosine similarity) of the `topn` chunks most similar to the query.
+        :param exact: scan every row even with an ANN backend
+        """
+        if not len(self) or self.vectors is None:
+            return []
+        query = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        if self.ann is not None and not exact:
+            rows = self.ann.candidates(query, min(topn, len(self)))
+            if rows is not None:
+                # candidates are re-scored exactly, rows freed since they were listed are dropped
+                rows = np.asarray([row for row in rows.tolist() if self._row_texts[row] is not None], dtype=np.int64)
+                if not len(rows):
+                    return []
+                scores = self._vectors_at(rows) @ query
+                top = np.argsort(-scores)[:topn]
+                return [(self._row_texts[rows[i]], float(scores[i])) for i in top]
+        return self.search_batch(query[None], topn, exact=True)[0]
+
+    def search_batch(
+            self,
+            query_embeddings: np.ndarray,
+            topn: int = 5,
+            exact: bool = False,
+            query_block_size: int = 256,
+    ) -> List[List[Tuple[str, float]]]:
+        """
+        `search` of many queries: exact search scores every block of rows against a block of queries in one
+        matrix product, keeping the running `topn` of every query.
+        """
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1)
+        if not len(self) or self.vectors is None:
+            return [[] for _ in range(len(query_embeddings))]
+        if self.ann is not None and not exact:
+            return [self.search(query, topn) for query in query_embeddings]
+        queries = query_embeddings / np.maximum(np.linalg.norm(query_embeddings, axis=1, keepdims=True), 1e-12)
+        topn = min(topn, len(self))
+        free_rows = np.array([row for row, text in enumerate(self._row_texts) if text is None], dtype=np.int64)
+        results = []
+        for q_start in range(0, len(queries), query_block_size):
+            block_queries = queries[q_start:q_start + query_block_size].T
+            # running top rows and scores, [topn, queries]
+            best_rows = np.empty((0, block_queries.shape[1]), dtype=np.int64)
+            best_scores = np.empty((0, block_queries.shape[1]), dtype=np.float32)
+            # blocks keep the float32 copy of the matrix small
+            for start in range(0, self.num_rows, self.search_block_rows):
+                end = min(start + self.search_block_rows, self.num_rows)
+                scores = self.vectors[start:end].astype(np.float32) @ block_queries
+                if self.scales is not None:
+                    scores *= self.scales[start:end, None]
+                freed = free_rows[(free_rows >= start) & (free_rows < end)] - start
+                scores[freed] = -np.inf
+                k = min(topn, end - start)
+                top = np.argpartition(-scores, k - 1, axis=0)[:k]
+                rows = np.concatenate([best_rows, top + start])
+                scores = np.concatenate([best_scores, np.take_along_axis(scores, top, axis=0)])
+                keep = np.argpartition(-scores, topn - 1, axis=0)[:topn] if len(rows) > topn else None
+                if keep is not None:
+                    rows, scores = np.take_along_axis(rows, keep, axis=0), np.take_along_axis(scores, keep, axis=0)
+                best_rows, best_scores = rows, scores
+            order = np.argsort(-best_scores, axis=0)
+            best_rows = np.take_along_axis(best_rows, order, axis=0)
+            best_scores = np.take_along_axis(best_scores, order, axis=0)
+            for i in range(best_rows.shape[1]):
+                results.append([(self._row_texts[row], float(score))
+                                for row, score in zip(best_rows[:, i].tolist(), best_scores[:, i].tolist())])
+        return results
+
+    def stats(self) -> Dict:
+        return {
+            'documents': self.db.execute('SELECT COUNT(*) FROM documents').fetchone()[0],
+            'chunks': len(self),
+            'rows': self.num_rows,
+            'dim': self.dim,
+            'dtype': self.dtype,
+            'ann': self.ann.stats() if self.ann is not None else None,
+        }